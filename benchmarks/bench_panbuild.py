@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for panbuild's build-file parsing and command generation.
+#
+# Synthetic build files cover several shapes of real-world build files
+# (thousands of targets, deep subtarget nesting, long option strings,
+# options repeated across levels and dual mode). For each of them, the
+# main stages are timed separately:
+#
+#   parse_file            whole pipeline, including YAML loading
+#   parse_target          target tree expansion, from already-loaded YAML
+#   parse_pandoc_options  lexing of the options strings
+#   build_command         generation of the final pandoc commands
+#
+# The "end-to-end" case runs panbuild itself against a fake pandoc
+# executable that does nothing, so it measures process startup and
+# scheduling overhead.
+#
+# Results are compared against a baseline file (see --baseline), and the
+# script exits with status 1 if any benchmark is slower than the baseline
+# by more than the given threshold, or if the list commands of the
+# "startup" case exceed their time budget. Baselines depend on the machine, so
+# they are not kept in the repository: create one with --save-baseline
+# before making changes.
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import yaml
+import panbuild
+
+
+def many_targets(count):
+    targets = {}
+    for i in range(count):
+        targets["T%d" % i] = {"options": "-t html -s --toc -o out%d.html" % i}
+    return {"pandoc_common": {"input_files": ["a.md", "b.md"], "options": "-N"},
+            "pandoc_targets": targets}
+
+
+def deep_nesting(depth, width):
+    def subtree(level):
+        node = {"options": "-V level%d=%d" % (level, level),
+                "metadata": {"m%d" % level: "v"}}
+        if level < depth:
+            for i in range(width if level == depth - 1 else 1):
+                node["S%d" % i] = subtree(level + 1)
+        return node
+    targets = {}
+    for i in range(width):
+        targets["ROOT%d" % i] = subtree(0)
+        targets["ROOT%d" % i]["options"] = "-t latex -s"
+    return {"pandoc_common": {"input_files": ["a.md"]}, "pandoc_targets": targets}
+
+
+def large_options(count, options):
+    option_str = " ".join("--variable=v%d:x%d -M k%d=%d" % (i, i, i, i) for i in range(options))
+    targets = {}
+    for i in range(count):
+        targets["T%d" % i] = {"options": "-t docx " + option_str}
+    return {"pandoc_common": {"input_files": ["a.md"], "output_basename": "out"},
+            "pandoc_targets": targets}
+
+
+def repeated_options(count, repeats):
+    common = " ".join("-c style%d.css -H header%d.tex" % (i, i) for i in range(repeats))
+    targets = {}
+    for i in range(count):
+        node = {"options": "-t html " + common}
+        for j in range(3):
+            node["SUB%d" % j] = {"options": common}
+        targets["T%d" % i] = node
+    return {"pandoc_common": {"input_files": ["a.md"], "options": common,
+                              "output_basename": "out"},
+            "pandoc_targets": targets}
+
+
+def dual_mode(count):
+    # Dual mode supports two languages (lang1 and lang2)
+    data = many_targets(count)
+    data["dual"] = True
+    data["lang1"] = "ES"
+    data["lang2"] = "EN"
+    data["dual_filters_dir"] = "filters"
+    return data
+
+
+def generate_cases(quick):
+    scale = 10 if quick else 1
+    return [
+        ("many_targets", many_targets(3000 // scale)),
+        ("deep_nesting", deep_nesting(40 // (scale // 5 or 1), 20 // scale or 2)),
+        ("large_options", large_options(200 // scale, 200)),
+        ("repeated_options", repeated_options(500 // scale, 20)),
+        ("dual_mode", dual_mode(1000 // scale)),
+    ]
+
+
+min_duration = 0.05
+
+
+def measure(func, repeat, setup=None):
+    """Returns the best time per call of func over several runs, in seconds.
+
+    Fast functions are called in a loop until each run takes at least
+    min_duration, so timer resolution does not dominate the result. If
+    given, setup is called before each call and its return value is
+    passed to func, without being timed."""
+    best = None
+    for i in range(repeat):
+        calls = 0
+        elapsed = 0.0
+        while elapsed < min_duration:
+            arg = setup() if setup else None
+            start = time.time()
+            func(arg) if setup else func()
+            elapsed += time.time() - start
+            calls += 1
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+
+def expand(data):
+    lang_dict = panbuild.get_lang_vars(data) if data.get("dual") else None
+    common = panbuild.parse_target(data["pandoc_common"], "common", None, 0, lang_dict)[0]
+    targets = []
+    for name, value in data["pandoc_targets"].items():
+        targets.extend(panbuild.parse_target(value, name, common, 1, lang_dict))
+    return targets
+
+
+def collect_option_strings(node, strings):
+    for key, value in node.items():
+        if key == "options" and isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, dict):
+            collect_option_strings(value, strings)
+
+
+def bench_case(name, data, workdir, repeat):
+    results = {}
+    build_file = os.path.join(workdir, name + ".yaml")
+    with open(build_file, "w") as f:
+        yaml.dump(data, f, default_flow_style=False)
+
+    results["parse_file"] = measure(lambda: panbuild.parse_file(build_file, None), repeat)
+
+    with open(build_file) as f:
+        loaded = yaml.load(f, Loader=yaml.FullLoader)
+    results["parse_target"] = measure(lambda: expand(loaded), repeat)
+
+    strings = []
+    collect_option_strings(loaded, strings)
+    results["parse_pandoc_options"] = measure(
+        lambda: [panbuild.parse_pandoc_options(s) for s in strings], repeat)
+
+    dual = bool(loaded.get("dual"))
+    filters_dir = loaded.get("dual_filters_dir")
+
+    def build_commands(targets):
+        for target in targets:
+            target.build_command(dual, filters_dir, None)
+    # build_command updates targets, so each call gets fresh ones
+    results["build_command"] = measure(build_commands, repeat, lambda: expand(loaded))
+    return results
+
+
+def write_fake_pandoc(workdir):
+    if os.name == "posix":
+        path = os.path.join(workdir, "fake-pandoc")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexit 0\n")
+    else:
+        path = os.path.join(workdir, "fake-pandoc.py")
+        with open(path, "w") as f:
+            f.write("import sys\nsys.exit(0)\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+def bench_end_to_end(workdir, count, jobs, repeat):
+    data = many_targets(count)
+    build_file = os.path.join(workdir, "end_to_end.yaml")
+    with open(build_file, "w") as f:
+        yaml.dump(data, f, default_flow_style=False)
+    for name in ["a.md", "b.md"]:
+        with open(os.path.join(workdir, name), "w") as f:
+            f.write("# Chapter\n")
+    cmd = [sys.executable, os.path.join(os.path.dirname(here), "panbuild.py"),
+           "-f", build_file, "-e", write_fake_pandoc(workdir), "-B", "-j", str(jobs)]
+    devnull = open(os.devnull, "w")
+    results = {}
+    results["build"] = measure(lambda: subprocess.call(cmd, cwd=workdir, stdout=devnull), repeat)
+    results["list_targets"] = measure(
+        lambda: subprocess.call(cmd[:4] + ["-L"], cwd=workdir, stdout=devnull), repeat)
+    return results
+
+
+## Time budget (ms) for the commands that editor plugins run on every refresh
+default_startup_budget = 100
+
+
+def bench_startup(workdir, repeat):
+    """Times list commands on a small build file, run as the installed
+    panbuild script does (importing the module, so its bytecode is cached)"""
+    build_file = os.path.join(workdir, "startup.yaml")
+    with open(build_file, "w") as f:
+        yaml.dump(many_targets(3), f, default_flow_style=False)
+    code = "import sys; sys.path.insert(0, %r); import panbuild; panbuild.main()" % os.path.dirname(here)
+    cmd = [sys.executable, "-c", code, "-f", build_file]
+    devnull = open(os.devnull, "w")
+    results = {}
+    for (stage, flag) in [("list_targets", "-L"), ("list_outputs", "-o")]:
+        results[stage] = measure(lambda: subprocess.call(cmd + [flag], cwd=workdir, stdout=devnull), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for panbuild")
+    parser.add_argument("--quick", action="store_true", help="Use smaller build files and fewer runs")
+    parser.add_argument("--repeat", type=int, default=None, help="Runs per benchmark (the best one is reported)")
+    parser.add_argument("--baseline", default=os.path.join(here, "baseline.json"),
+                        help="Baseline to compare against (default: benchmarks/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Slowdown ratio reported as a regression (default: 1.25)")
+    parser.add_argument("--startup-budget", type=float, default=default_startup_budget,
+                        help="Time budget of list commands, in ms (default: %d)" % default_startup_budget)
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Jobs for the end-to-end benchmark")
+    args = parser.parse_args()
+    repeat = args.repeat or (3 if args.quick else 5)
+
+    workdir = tempfile.mkdtemp(prefix="panbuild-bench-")
+    results = {}
+    try:
+        old_cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for (name, data) in generate_cases(args.quick):
+                for (stage, seconds) in bench_case(name, data, workdir, repeat).items():
+                    results["%s/%s" % (name, stage)] = seconds
+            count = 50 if args.quick else 200
+            for (stage, seconds) in bench_end_to_end(workdir, count, args.jobs, repeat).items():
+                results["end_to_end/%s" % stage] = seconds
+            for (stage, seconds) in bench_startup(workdir, repeat).items():
+                results["startup/%s" % stage] = seconds
+        finally:
+            os.chdir(old_cwd)
+    finally:
+        shutil.rmtree(workdir, True)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+
+    regressions = []
+    print("%-40s %12s %12s %8s" % ("Benchmark", "Time (ms)", "Baseline", "Ratio"))
+    for name in sorted(results):
+        seconds = results[name]
+        if name in baseline and baseline[name] > 0:
+            ratio = seconds / baseline[name]
+            flag = " *" if ratio > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print("%-40s %12.2f %12.2f %7.2fx%s" % (name, seconds * 1000, baseline[name] * 1000, ratio, flag))
+        else:
+            print("%-40s %12.2f %12s %8s" % (name, seconds * 1000, "-", "-"))
+
+    over_budget = [name for name in sorted(results)
+                   if name.startswith("startup/") and results[name] * 1000 > args.startup_budget]
+    for name in over_budget:
+        print("%s exceeds the startup budget of %.0f ms" % (name, args.startup_budget))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"quick": args.quick, "results": results}, f, indent=1, sort_keys=True)
+        print("Baseline saved to", args.baseline)
+    elif regressions:
+        print("%d benchmark(s) slower than the baseline by more than %.0f%%"
+              % (len(regressions), (args.threshold - 1) * 100))
+        return 1
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
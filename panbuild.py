@@ -24,24 +24,141 @@
 ##############################################################################
 
 from __future__ import print_function
-import yaml 
 import sys
 import re
 import os
 import io
 import argparse
-from subprocess import Popen, PIPE, call
+import threading
+import time
+import json
 
-# shutil.which: new in version 3.3
 try:
-    from shutil import which
+    import queue
 except ImportError:
-    from shutilwhich import which
+    import Queue as queue
+
+## Modules that only some commands need (yaml, subprocess, hashlib,
+## shutil, urllib) are imported by the functions that use them, so that
+## list commands run by editors start up quickly
+
+executables={}
+
+def find_executable(name):
+	"""Memoized shutil.which(), so that PATH is searched once per process"""
+	if name not in executables:
+		# shutil.which: new in version 3.3
+		try:
+			from shutil import which
+		except ImportError:
+			from shutilwhich import which
+		executables[name]=which(name)
+	return executables[name]
+
+def load_yaml(stream):
+	"""Parses a YAML document, with libyaml's loader when available"""
+	import yaml
+	return yaml.load(stream,Loader=getattr(yaml,"CFullLoader",yaml.FullLoader))
 
 
 dual_filter="dual_md"
 teaching_filter="teaching_md"
 
+## time.process_time: new in version 3.3
+cpu_clock=getattr(time,"process_time",time.clock if hasattr(time,"clock") else time.time)
+
+class ProfileSpan:
+	def __init__(self,profiler,name,cat,args):
+		self.profiler=profiler
+		self.name=name
+		self.cat=cat
+		self.args=args
+
+	def __enter__(self):
+		self.start=time.time()
+		self.cpu_start=cpu_clock()
+		return self
+
+	def __exit__(self,exc_type,exc_value,tb):
+		self.profiler.record(self.name,self.cat,self.start,time.time(),cpu_clock()-self.cpu_start,self.args)
+		return False
+
+class NullSpan:
+	def __init__(self):
+		self.args={}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,tb):
+		return False
+
+class Profiler:
+	"""
+	Records the wall-clock and CPU time of build phases and targets. CPU
+	time of phases is that of the panbuild process; for targets and
+	filters, it is that of the child processes, when available.
+	"""
+	def __init__(self):
+		self.enabled=True
+		self.events=[]
+		self.threads={}
+		self.start=time.time()
+		self.lock=threading.Lock()
+
+	def span(self,name,cat="phase",args=None):
+		return ProfileSpan(self,name,cat,args if args is not None else {})
+
+	def record(self,name,cat,start,end,cpu,args):
+		thread=threading.current_thread()
+		with self.lock:
+			self.threads[thread.ident]=thread.name
+			self.events.append((name,cat,thread.ident,start,end,args.get("cpu",cpu),args))
+
+	def write_trace(self,path):
+		"""Writes events in the Chrome trace event format"""
+		pid=os.getpid()
+		events=[]
+		for (tid,name) in iter(self.threads.items()):
+			events.append({"name":"thread_name","ph":"M","pid":pid,"tid":tid,"args":{"name":name}})
+		for (name,cat,tid,start,end,cpu,args) in self.events:
+			event_args=dict(args)
+			event_args["cpu"]=cpu
+			events.append({"name":name,"cat":cat,"ph":"X","pid":pid,"tid":tid,
+				"ts":int((start-self.start)*1e6),"dur":int((end-start)*1e6),"args":event_args})
+		with io.open(path,'wb') as f:
+			f.write(json.dumps({"traceEvents":events,"displayTimeUnit":"ms"},indent=1).encode('utf-8'))
+
+	def print_summary(self,file=sys.stderr):
+		totals={}
+		order=[]
+		for (name,cat,tid,start,end,cpu,args) in self.events:
+			key=(cat,name)
+			if key not in totals:
+				totals[key]=[0,0.0,0.0]
+				order.append(key)
+			totals[key][0]+=1
+			totals[key][1]+=end-start
+			totals[key][2]+=cpu or 0.0
+		print("%-10s %-40s %6s %10s %10s" % ("Category","Name","Count","Wall (s)","CPU (s)"),file=file)
+		for key in order:
+			(count,wall,cpu)=totals[key]
+			print("%-10s %-40s %6d %10.3f %10.3f" % (key[0],key[1][:40],count,wall,cpu),file=file)
+		print("Total elapsed time: %.3f s" % (time.time()-self.start),file=file)
+
+class NullProfiler:
+	enabled=False
+	null_span=NullSpan()
+
+	def span(self,name,cat="phase",args=None):
+		return self.null_span
+
+## Replaced with a Profiler when --profile is given
+profiler=NullProfiler()
+
+def profile(name,cat="phase",args=None):
+	return profiler.span(name,cat,args)
+
 def get_filter_path(dir,name):
 	if dir:
 		return os.path.join(dir,name+".py")
@@ -58,12 +175,13 @@ def merge_option_dicts(to,src):
 		if key in to:
 			oldval=to[key]
 			## Multiple values for this option still exist
+			## (a new list is made, as the old one may belong to a parent target)
 			if type(oldval)==list:
 				## Child value is also a list
 				if type(value)==list:
-					oldval.extend(value)
+					to[key]=oldval+value
 				else:
-					oldval.append(value)
+					to[key]=oldval+[value]
 			else:
 				if type(value)==list:
 					newval=[oldval] ## Scalar
@@ -88,46 +206,142 @@ def merge_two_dicts(x, y):
     z.update(y)
     return z
 
-class Target:
-	def __init__(self,name,parent,variables,metadata,options,filters,preamble,input_files,output_basename,custom_command=None):
+def render_option(option,values):
+	"""Turns an option and its list of values into command-line arguments"""
+	args=[]
+	if len(option)==1:
+		for item in values:
+			if item:
+				## Short option
+				args.append("-%s" % option)
+				args.append(item)
+			else:
+				args.append("-%s" % option)
+	else:
+		for item in values:
+			## Long option
+			if item:
+				args.append("--%s=%s" % (option,item))
+			else:
+				args.append("--%s" % option)
+	return args
+
+def render_pairs(flag,pairs):
+	"""Turns a dict of variables or metadata into command-line arguments"""
+	args=[]
+	for key, value in iter(pairs.items()):
+		args.append(flag)
+		if value:
+			args.append("%s=%s" % (key,value))
+		else:
+			args.append("%s" % key)
+	return args
+
+## Extensions of output files for writers whose name is not the extension
+output_table_standalone={"latex":"pdf","beamer":"pdf","plain":"txt"}
+output_table_regular={"latex":"tex","beamer":"tex","plain":"txt"}
+
+## Identical lists of input files (or preamble files) are shared by targets
+interned_lists={}
+
+def intern_list(values):
+	key=tuple(values)
+	if key not in interned_lists:
+		interned_lists[key]=list(values)
+	return interned_lists[key]
+
+class Target(object):
+	"""
+	A target keeps only the settings defined for it (its layer), and looks
+	up the rest in the target it inherits from: its parent, or the common
+	options for top-level targets (base). The merged variables, metadata,
+	options and filters are computed the first time they are used, so large
+	target trees only pay for the targets that are actually built.
+	"""
+	__slots__=["name","parent","base","subname","outfile","input_files","output_basename","preamble",
+		"custom_command","pandoc_command","command_args","layer","merged","depends_on","dependencies","memory","chunked"]
+
+	def __init__(self,name,parent,variables,metadata,options,filters,preamble,input_files,output_basename,custom_command=None,base=None):
 		self.name=name
 		self.parent=parent
+		self.base=parent or base
 		self.outfile=None ## Established later when building command
+		base=self.base
 
 		## Override 
-		if not input_files and parent:
-			self.input_files=list(parent.input_files)
+		if not input_files and base:
+			self.input_files=base.input_files
 		else:
-			self.input_files=list(input_files) if input_files else []
+			self.input_files=intern_list(input_files) if input_files else []
 
-		if not output_basename and parent:
-			self.output_basename=parent.output_basename
+		if not output_basename and base:
+			self.output_basename=base.output_basename
 		else:
 			self.output_basename=output_basename
 
-		if not preamble and parent:
-			self.preamble=list(parent.preamble)
+		if not preamble and base:
+			self.preamble=base.preamble
 		else:
-			self.preamble=list(preamble) if preamble else []
+			self.preamble=intern_list(preamble) if preamble else []
 
-		## Inherit from parent (Merge)
 		if parent:
 			self.subname="%s/%s" % (parent.subname,name)
-			self.variables=merge_two_dicts(parent.variables,variables)
-			self.metadata=merge_two_dicts(parent.metadata,metadata)
-			self.options=merge_two_option_dicts(parent.options,options)
-			self.filters=parent.filters+filters
-
 		else:
 			self.subname=str(name)
-			self.variables=variables.copy() if variables else {}
-			self.metadata=metadata.copy() if metadata else {}
-			self.options=options.copy() if options else {}
-			self.filters=list(filters) if filters else []
+
+		## Inherited settings are merged on demand
+		self.layer=(variables or None,metadata or None,options or None,filters or None)
+		self.merged=None
 
 		self.custom_command=custom_command
 
 		self.pandoc_command=None ## For now it is left uninitialized
+		self.command_args=None ## Arguments of build_command(), set by parse_file()
+		self.depends_on=None ## Selectors of the targets whose output this one uses
+		self.dependencies=[] ## Those targets, found by resolve_dependencies()
+		self.memory=None ## Memory used by its command, if given in the build file (see get_target_memory())
+		self.chunked=False ## Whether its input files are rendered separately (see ChunkedBuilder)
+
+	def get_command(self):
+		"""
+		Returns the pandoc command of the target, which is built the first
+		time it is needed. Returns None if the target has errors, which are
+		reported when the command is built.
+		"""
+		if self.pandoc_command is None and self.command_args is not None:
+			command_args=self.command_args
+			self.command_args=None
+			with profile("build_command"):
+				self.build_command(*command_args)
+		return self.pandoc_command
+
+	def merge(self):
+		(variables,metadata,options,filters)=self.layer
+		base=self.base
+		if base:
+			self.merged=(merge_two_dicts(base.variables,variables or {}),
+				merge_two_dicts(base.metadata,metadata or {}),
+				merge_two_option_dicts(base.options,options or {}),
+				base.filters+(filters or []))
+		else:
+			self.merged=(dict(variables or {}),dict(metadata or {}),dict(options or {}),list(filters or []))
+		return self.merged
+
+	@property
+	def variables(self):
+		return (self.merged or self.merge())[0]
+
+	@property
+	def metadata(self):
+		return (self.merged or self.merge())[1]
+
+	@property
+	def options(self):
+		return (self.merged or self.merge())[2]
+
+	@property
+	def filters(self):
+		return (self.merged or self.merge())[3]
 
 	def __str__(self):
 		return "=====%s====\nName=%s\nOptions=%s\nFilters=%s\nVariables=%s\nInput files=%s\n==========\n" % (self.name,self.subname,str(self.options),str(self.filters),str(self.variables),str(self.input_files))
@@ -140,15 +354,13 @@ class Target:
 	def build_command(self,add_dual_filters=False,dual_filters_dir=None,pandoc_exec=None):
 		actual_output_file=None
 		actual_extension=None
-		output_table_standalone={"latex":"pdf","beamer":"pdf","plain":"txt"}
-		output_table_regular={"latex":"tex","beamer":"tex","plain":"txt"}
 		standalone=False
 
 		if self.custom_command is not None:
 			return self.build_custom_command()
 
 		if not self.input_files or len(self.input_files)==0:
-			print("Error: no input files have been specified for target %s" % self.subname, file=sys.stderr,end='')
+			print("Error: no input files have been specified for target %s" % self.subname, file=sys.stderr)
 			return None
 
 		cmd=[]
@@ -204,49 +416,24 @@ class Target:
 						return 	
 
 				## Just append option and value
-				if len(option)==1:
-					for item in values:
-						if item:
-							## Short option
-							cmd.append("-%s" % option)
-							cmd.append(item)
-						else:
-							cmd.append("-%s" % option)	
-				else:
-					for item in values:
-						## Long option
-						if item:
-							## Short option
-							cmd.append("--%s=%s" % (option,item))
-						else:
-							cmd.append("--%s" % option)	
+				cmd.extend(render_option(option,values))
 
 
 		## Process filters
 		if add_dual_filters:
 			## First and last filters	
-			self.filters.insert(0, get_filter_path(dual_filters_dir,dual_filter))
-			self.filters.append(get_filter_path(dual_filters_dir,teaching_filter))
+			filters=[get_filter_path(dual_filters_dir,dual_filter)]+self.filters+[get_filter_path(dual_filters_dir,teaching_filter)]
+			self.merged=self.merged[:3]+(filters,)
 
 		for filter in self.filters:
 			cmd.append("-F")
 			cmd.append(filter)
 
 		## Add variables
-		for key, value in iter(self.variables.items()):
-			cmd.append("-V")
-			if value:
-				cmd.append("%s=%s" % (key,value))
-			else:
-				cmd.append("%s" % key)
+		cmd.extend(render_pairs("-V",self.variables))
 
 		## Add metadata 
-		for key, value in iter(self.metadata.items()):
-			cmd.append("-M")
-			if value:
-				cmd.append("%s=%s" % (key,value))
-			else:
-				cmd.append("%s" % key)
+		cmd.extend(render_pairs("-M",self.metadata))
 
 		## Process output file
 		if actual_output_file:
@@ -363,26 +550,21 @@ def parse_target(data,name,parent,level,dual_dict):
 	else:
 		actual_name=name
 
-	## Just copy from parent (To inherit common options)
-	if level==1 and parent:
-		options=parent.options.copy()
-		filters=list(parent.filters)
-		variables=parent.variables.copy()
-		metadata=parent.metadata.copy()
-		input_files=list(parent.input_files)	
-		output_basename=parent.output_basename
-		preamble=list(parent.preamble)
-
-	else:
-		options={}
-		filters=[]
-		variables={}
-		metadata={}
-		input_files=None ## For error checking later
-		output_basename=None ## For error checking later		
-		preamble=[]
+	## Only the settings of this target are collected here. Inherited
+	## settings (from the parent, or from common options at level 1) are
+	## looked up by the Target object itself
+	options={}
+	filters=[]
+	variables={}
+	metadata={}
+	input_files=None ## For error checking later
+	output_basename=None ## For error checking later		
+	preamble=[]
 
 	custom_cmd=None
+	depends_on=None
+	memory=None
+	chunked=None
 
 	## Process options within the target
 	for option, value in iter(data.items()):
@@ -450,6 +632,32 @@ def parse_target(data,name,parent,level,dual_dict):
 			else:
 				print("Warning: Illegal format for custom_cmd in target %s ...: " % actual_name, file=sys.stderr)	
 				custom_cmd=None			
+		elif option=="depends_on":
+			## Targets that must be built before this one (and its subtargets)
+			if type(value) == str:
+				depends_on=[value]
+			elif type(value) == list and all([type(item) == str for item in value]):
+				depends_on=value
+			else:
+				print("Illegal format for depends_on attribute in target %s " % actual_name, file=sys.stderr)	
+				return None
+			if level==0:
+				## Every target would depend on itself
+				print("Error: depends_on cannot be given in the common options", file=sys.stderr)
+				return None
+		elif option=="memory":
+			## Memory used when building the target, such as 512M or 2G
+			try:
+				memory=parse_size(value)
+			except ValueError:
+				print("Illegal format for memory attribute in target %s " % actual_name, file=sys.stderr)	
+				return None
+		elif option=="chunked":
+			## Render each input file separately and join the results
+			if type(value) != bool:
+				print("Illegal format for chunked attribute in target %s " % actual_name, file=sys.stderr)	
+				return None
+			chunked=value
 		else:
 			### TODO:
 			## perhaps force writting targets with an initial capital letter to
@@ -464,11 +672,17 @@ def parse_target(data,name,parent,level,dual_dict):
 
 	## Build Target object
 	if level<2:
-		actual_parent=None
+		target=Target(name,None,variables,metadata,options,filters,preamble,input_files,output_basename,custom_cmd,base=parent)
 	else:
-		actual_parent=parent
-
-	target=Target(name,actual_parent,variables,metadata,options,filters,preamble,input_files,output_basename,custom_cmd)
+		target=Target(name,parent,variables,metadata,options,filters,preamble,input_files,output_basename,custom_cmd)
+	target.depends_on=depends_on
+	## Inherited from the parent (or the common options)
+	if memory is None and parent:
+		memory=parent.memory
+	target.memory=memory
+	if chunked is None and parent:
+		chunked=parent.chunked
+	target.chunked=bool(chunked)
 
 	## Hack to add dual targets automatically or patch them when in dual mode
 	if dual_dict and level==1 and name!="common":
@@ -526,7 +740,7 @@ def skipUntiLine(file,content,curline=None,regex=False):
 		return  (line ==content,line)
 
 
-def parse_yaml_header(filename):
+def parse_yaml_header(filename,sources=None):
 	try:
 		inputfile= open(filename, "r")
 	except:
@@ -546,7 +760,8 @@ def parse_yaml_header(filename):
 
 	try:
 		## Read YAML
-		yaml_data=yaml.load(document,Loader=yaml.FullLoader)	
+		with profile("load_yaml"):
+			yaml_data=load_yaml(document)	
 	except Exception as inst:
 		print("Error parsing YAML header in file", filename, file=sys.stderr)
 		print(inst)
@@ -560,9 +775,13 @@ def parse_yaml_header(filename):
 			print("panbuild_file should be a string", file=sys.stderr)
 			return 
 
+		if sources is not None:
+			sources.append(infile)
+
 		try:
 			stream=io.open(infile,'r')
-			data=yaml.load(stream,Loader=yaml.FullLoader)
+			with profile("load_yaml"):
+				data=load_yaml(stream)
 			del stream
 		except Exception as inst:
 			print(inst)
@@ -570,7 +789,8 @@ def parse_yaml_header(filename):
 		
 		return (data,False)		
 
-def parse_file(infile,pandoc_exec):
+## sources, if not None, is filled with the files the build rules come from
+def parse_file(infile,pandoc_exec,sources=None):
 	dual=False
 	lang_dict=None
 	dual_filter_dir=None
@@ -578,16 +798,20 @@ def parse_file(infile,pandoc_exec):
 	in_place=False
 	basename, ext = os.path.splitext(infile)
 
+	if sources is not None:
+		sources.append(infile)
+
 	if ext in [".md",".markdown",".mdown"]:
 		## Process yaml header inside md file
-		ret=parse_yaml_header(infile)
+		ret=parse_yaml_header(infile,sources)
 
 		if ret:
 			(data,in_place)=ret
 	else:
 		try:
 			stream=io.open(infile,'r')
-			data=yaml.load(stream,Loader=yaml.FullLoader)
+			with profile("load_yaml"):
+				data=load_yaml(stream)
 			del stream
 		except Exception as inst:
 			print(inst)
@@ -608,6 +832,8 @@ def parse_file(infile,pandoc_exec):
 	## Parse target common
 	if "pandoc_common" in data:
 		target_set=parse_target(data["pandoc_common"],"common",None,0,lang_dict)
+		if target_set is None:
+			return None
 		if len(target_set)!=1:
 			print("Error: common options cannot include subtargets", file=sys.stderr)
 			return None
@@ -630,19 +856,24 @@ def parse_file(infile,pandoc_exec):
 
 	targets=[]
 
-	for targ_name,targ_data in iter(data["pandoc_targets"].items()):
-		ret=parse_target(targ_data,targ_name,common_target_options,1,lang_dict)
-		targets.extend(ret)
+	with profile("parse_target"):
+		for targ_name,targ_data in iter(data["pandoc_targets"].items()):
+			ret=parse_target(targ_data,targ_name,common_target_options,1,lang_dict)
+			targets.extend(ret)
 
 
-	## Update commands
+	## Commands are only built for the targets that need them (see
+	## Target.get_command()), so errors in a target do not affect the rest
 	for target in targets:
-		if not target.build_command(dual,dual_filter_dir,pandoc_exec):
-			return None
+		target.command_args=[dual,dual_filter_dir,pandoc_exec]
+
+	if not resolve_dependencies(targets):
+		return None
 
 	return (data,targets)
 
 def remove_target_from_build_file(build_yaml_file,target_name,yaml_data,targets):
+	import yaml
 	#Make sure its a yaml file
 	basename, file_extension = os.path.splitext(build_yaml_file)	
 
@@ -685,6 +916,7 @@ def remove_target_from_build_file(build_yaml_file,target_name,yaml_data,targets)
 	yaml.dump(yaml_data,stream,default_flow_style=False)
 
 def append_target_to_build_file(build_yaml_file,target_name,str_options,yaml_data,existing_targets):
+	import yaml
 	#Make sure its a yaml file
 	basename, file_extension = os.path.splitext(build_yaml_file)
 
@@ -736,6 +968,7 @@ def make_list(obj):
 		return obj	
 
 def print_sample_build_yaml(args_str,options_in_yaml=False,build_yaml_file=None,target_name=None,dual=False):
+	import yaml
 	(input_files,options)=parse_pandoc_options(args_str)
 	yaml_dict={}
 	pandoc_common={}
@@ -800,26 +1033,1535 @@ def print_sample_build_yaml(args_str,options_in_yaml=False,build_yaml_file=None,
 		print(yaml.dump(yaml_dict,default_flow_style=False),end="")
 
 
+## Bookkeeping files are stored in a hidden directory next to the build file
+state_dir_name=".panbuild"
+
+def get_target_path(directory,target):
+	"""
+	Returns a path in directory for the files of a target. Each part of its
+	name becomes a directory, with parts that could point elsewhere (such
+	as "..") escaped
+	"""
+	parts=[]
+	for part in target.subname.split("/"):
+		part=re.sub(r'[\\:]',"_",part)
+		if not part.strip("."):
+			part=part.replace(".","_") or "_"
+		parts.append(part)
+	return os.path.join(directory,*parts)
+
+def get_state_path(build_file,suffix):
+	(dirname,basename)=os.path.split(os.path.abspath(build_file))
+	return os.path.join(dirname,state_dir_name,basename+suffix)
+
+def write_file_atomically(path,data):
+	dirname=os.path.dirname(path)
+	if not os.path.isdir(dirname):
+		os.makedirs(dirname)
+	tmp_path="%s.%d.tmp" % (path,os.getpid())
+	with io.open(tmp_path,'wb') as f:
+		f.write(data)
+	## os.rename() does not replace existing files on Windows
+	if os.name=="nt" and os.path.exists(path):
+		os.remove(path)
+	os.rename(tmp_path,path)
+
+def hash_file(path):
+	import hashlib
+	digest=hashlib.sha1()
+	with io.open(path,'rb') as f:
+		chunk=f.read(1<<20)
+		while chunk:
+			digest.update(chunk)
+			chunk=f.read(1<<20)
+	return digest.hexdigest()
+
+class FileHashes:
+	"""Thread-safe memo of file hashes, valid while timestamp and size do not change"""
+	def __init__(self):
+		self.hashes={}
+		self.lock=threading.Lock()
+
+	def get(self,path):
+		st=os.stat(path)
+		with self.lock:
+			entry=self.hashes.get(path)
+		if entry and entry[0]==st.st_mtime and entry[1]==st.st_size:
+			return entry[2]
+		digest=hash_file(path)
+		with self.lock:
+			self.hashes[path]=(st.st_mtime,st.st_size,digest)
+		return digest
+
+file_hashes=FileHashes()
+
+def resolve_filter_path(filter):
+	if os.path.exists(filter):
+		return filter
+	return find_executable(filter)
+
+## Pandoc options whose values name files read when building a target
+file_options=["template","css","c","bibliography","csl","citation-abbreviations",
+	"reference-doc","reference-docx","reference-odt","epub-cover-image",
+	"epub-stylesheet","epub-metadata","epub-embed-font","include-in-header","H",
+	"include-before-body","B","include-after-body","A","lua-filter","L",
+	"metadata-file","abbreviations","syntax-definition","highlight-style"]
+
+## Metadata fields that name files read by pandoc
+file_metadata=["bibliography","csl","citation-abbreviations"]
+
+## Extensions of input files scanned for references to images
+scanned_extensions=[".md",".markdown",".mdown",".mkd",".txt",".tex",".latex",".html",".htm"]
+
+image_patterns=[
+	## Markdown inline images: ![caption](path "title")
+	re.compile(r'!\[(?:[^\[\]\\]|\\.|\[[^\]]*\])*\]\(\s*(?:<([^>]+)>|([^)\s]+))'),
+	## Raw HTML and LaTeX
+	re.compile(r'<(?:img|source|video|audio|embed)\b[^>]*?\bsrc\s*=\s*["\']([^"\']+)["\']',re.IGNORECASE),
+	re.compile(r'\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}'),
+]
+
+## Markdown reference-style images: ![caption][label], ![label][] and ![label]
+image_label_pattern=re.compile(r'!\[((?:[^\[\]\\]|\\.)*)\](?:\[([^\]]*)\]|(?![\[(]))')
+## Link reference definitions (but not footnotes), which may back reference-style images
+link_definition_pattern=re.compile(r'^ {0,3}\[([^\]^][^\]]*)\]:\s*<?([^\s>]+)>?',re.MULTILINE)
+
+def normalize_label(label):
+	"""Labels of link references are matched case-insensitively, ignoring whitespace differences"""
+	return " ".join(label.split()).lower()
+
+## URLs, but not Windows drive letters
+url_regex=re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]+:')
+
+def get_option_values(options,keys):
+	values=[]
+	for key in keys:
+		if key not in options:
+			continue
+		value=options[key]
+		for item in (value if type(value)==list else [value]):
+			if item:
+				values.append(str(item))
+	return values
+
+def get_output_format(options):
+	values=get_option_values(options,["t","to","w","write"])
+	if not values:
+		return None
+	## Strip extensions such as markdown+smart
+	return re.split(r'[+-]',values[0])[0]
+
+class DependencyScanner:
+	"""
+	Finds the files a target depends on besides its input files: those
+	named by file-valued pandoc options and metadata fields, and images
+	referenced from the input files. Inputs are only rescanned when their
+	timestamp or size change.
+	"""
+	def __init__(self,cache=None):
+		self.cache=cache if cache else {}
+		self.changed=False
+
+	def scan_file(self,path):
+		"""Returns the references to images found in the file path"""
+		try:
+			st=os.stat(path)
+		except OSError:
+			return []
+		entry=self.cache.get(path)
+		if entry and entry[0]==st.st_mtime and entry[1]==st.st_size:
+			return entry[2]
+
+		refs=[]
+		try:
+			with io.open(path,'r',encoding='utf-8',errors='replace') as f:
+				text=f.read()
+		except (IOError,OSError):
+			return []
+		found=[]
+		for pattern in image_patterns:
+			for ref in pattern.findall(text):
+				if type(ref)==tuple:
+					ref=ref[0] or ref[1]
+				found.append(ref)
+		## Only the definitions of labels used by images
+		labels=set([normalize_label(label or caption) for (caption,label) in image_label_pattern.findall(text)])
+		for (label,ref) in link_definition_pattern.findall(text):
+			if normalize_label(label) in labels:
+				found.append(ref)
+		for ref in found:
+			if url_regex.match(ref) or ref.startswith('#'):
+				continue
+			ref=ref.split('#')[0].split('?')[0]
+			if ref and ref not in refs:
+				refs.append(ref)
+		self.cache[path]=[st.st_mtime,st.st_size,refs]
+		self.changed=True
+		return refs
+
+	def resolve(self,ref,search_dirs):
+		for dirname in search_dirs:
+			path=os.path.normpath(os.path.join(dirname,ref))
+			if os.path.isfile(path):
+				return path
+		return None
+
+	def get_dependencies(self,target):
+		try:
+			from urllib.parse import unquote
+		except ImportError:
+			from urllib import unquote
+		deps=[]
+		def add(path):
+			if path and path not in deps:
+				deps.append(path)
+
+		fmt=get_output_format(target.options)
+		for value in get_option_values(target.options,file_options):
+			if url_regex.match(value) and not os.path.exists(value):
+				continue
+			if os.path.isfile(value):
+				add(value)
+			elif fmt and not os.path.splitext(value)[1] and os.path.isfile(value+"."+fmt):
+				## Template names without extension
+				add(value+"."+fmt)
+
+		for key in file_metadata:
+			values=get_option_values(target.metadata,[key])
+			for value in values:
+				if os.path.isfile(value):
+					add(value)
+
+		## Images are looked up in the resource path and then next to the input
+		resource_path=get_option_values(target.options,["resource-path"])
+		if resource_path:
+			search_dirs=re.split(r'[;:]' if os.name!="nt" else r';',resource_path[0])
+		else:
+			search_dirs=["."]
+		for input in target.preamble+target.input_files:
+			if os.path.splitext(input)[1].lower() not in scanned_extensions:
+				continue
+			dirs=search_dirs+[os.path.dirname(input) or "."]
+			for ref in self.scan_file(input):
+				add(self.resolve(unquote(ref),dirs))
+		return deps
+
+def get_target_inputs(target,scanner=None):
+	"""
+	Files whose contents determine the output of a target. The build file
+	itself is not included, as any change in it that matters is reflected
+	in the target's command.
+	"""
+	inputs=[]
+	for path in target.preamble+target.input_files:
+		if path not in inputs:
+			inputs.append(path)
+	for filter in target.filters:
+		path=resolve_filter_path(filter)
+		if path and path not in inputs:
+			inputs.append(path)
+	if scanner:
+		for path in scanner.get_dependencies(target):
+			if path not in inputs:
+				inputs.append(path)
+	## Outputs of the targets it depends on
+	for dependency in target.dependencies:
+		if dependency.get_command() and dependency.outfile not in (None,"-") and dependency.outfile not in inputs:
+			inputs.append(dependency.outfile)
+	return inputs
+
+class BuildState:
+	"""
+	Keeps track of the command and the inputs used the last time each
+	target was built successfully, so as to skip targets that are up to
+	date. In timestamp mode (default) a target is up to date when its output
+	is newer than all its inputs; in hash mode the contents of the inputs
+	are compared instead.
+	"""
+	version=1
+
+	def __init__(self,build_file,use_hashes=False):
+		self.path=get_state_path(build_file,".state")
+		self.use_hashes=use_hashes
+		self.targets={}
+		self.scanner=DependencyScanner()
+		self.changed=False
+		self.load()
+
+	def load(self):
+		try:
+			with io.open(self.path,'r',encoding='utf-8') as f:
+				data=json.load(f)
+		except (IOError,OSError,ValueError):
+			return
+		if type(data)==dict and data.get("version")==self.version:
+			self.targets=data.get("targets",{})
+			self.scanner=DependencyScanner(data.get("scans"))
+
+	def save(self):
+		if not self.changed and not self.scanner.changed:
+			return
+		data={"version":self.version,"targets":self.targets,"scans":self.scanner.cache}
+		try:
+			write_file_atomically(self.path,json.dumps(data,indent=1,sort_keys=True).encode('utf-8'))
+			self.changed=False
+			self.scanner.changed=False
+		except (IOError,OSError) as inst:
+			print("Warning: could not save build state:",inst,file=sys.stderr)
+
+	def file_signature(self,path,old_signature=None):
+		"""Returns [mtime,size,hash] for path, or None if it does not exist"""
+		try:
+			st=os.stat(path)
+		except OSError:
+			return None
+		digest=None
+		if self.use_hashes:
+			## Avoid reading files that have not been touched since last time
+			if old_signature and old_signature[0]==st.st_mtime and old_signature[1]==st.st_size and old_signature[2]:
+				digest=old_signature[2]
+			else:
+				digest=hash_file(path)
+		return [st.st_mtime,st.st_size,digest]
+
+	def get_inputs(self,target):
+		"""Returns the dependency manifest of target"""
+		return get_target_inputs(target,self.scanner)
+
+	def is_up_to_date(self,target):
+		if not target.outfile or target.custom_command is not None:
+			return False
+		entry=self.targets.get(target.subname)
+		if not entry or entry.get("command")!=list(map(str,target.pandoc_command)):
+			return False
+		try:
+			out_mtime=os.stat(target.outfile).st_mtime
+		except OSError:
+			return False
+
+		old_inputs=entry.get("inputs",{})
+		inputs=self.get_inputs(target)
+		if sorted(inputs)!=sorted(old_inputs.keys()):
+			return False
+
+		for path in inputs:
+			signature=self.file_signature(path,old_inputs[path])
+			if signature is None:
+				return False
+			if self.use_hashes:
+				if signature[2]!=old_inputs[path][2]:
+					return False
+			elif signature[0]>out_mtime:
+				return False
+		return True
+
+	def snapshot(self,target):
+		"""Captures the state of the inputs right before building target"""
+		if not target.outfile or target.custom_command is not None:
+			return None
+		old_inputs=self.targets.get(target.subname,{}).get("inputs",{})
+		inputs={}
+		for path in self.get_inputs(target):
+			inputs[path]=self.file_signature(path,old_inputs.get(path))
+		return {"command":list(map(str,target.pandoc_command)),"outfile":target.outfile,"inputs":inputs}
+
+	def record(self,target,snapshot):
+		if snapshot is None:
+			return
+		## Inputs missing at build time must not match anything later
+		for path,signature in iter(snapshot["inputs"].items()):
+			if signature is None:
+				return
+		self.targets[target.subname]=snapshot
+		self.changed=True
+
+	def forget(self,target):
+		if target.subname in self.targets:
+			del self.targets[target.subname]
+			self.changed=True
+
+## Compiled build files: the targets found in a build file, along with
+## their commands, are saved in the state directory and loaded from there
+## (in a single read) by later runs, while the build file, the file
+## referenced by its panbuild_file field and the command line do not change
+build_cache_version=5
+target_attributes=["name","subname","variables","metadata","options","filters","preamble",
+	"input_files","output_basename","custom_command","outfile","pandoc_command","command_args","memory","chunked"]
+
+def get_build_cache_key(infile,pandoc_exec):
+	## Relative paths in build files depend on the working directory
+	return [build_cache_version,os.getcwd(),infile,pandoc_exec]
+
+def load_compiled_build_file(infile,pandoc_exec):
+	"""Returns (data,targets,sources) saved by a previous run, or None if outdated"""
+	path=get_state_path(infile,".compiled")
+	try:
+		with io.open(path,'rb') as f:
+			entry=json.loads(f.read().decode('utf-8'))
+		if entry["key"]!=get_build_cache_key(infile,pandoc_exec):
+			return None
+		## Hashes are only computed for files whose timestamp changed
+		for (source,mtime,size,digest) in entry["sources"]:
+			st=os.stat(source)
+			if st.st_size!=size or (st.st_mtime!=mtime and hash_file(source)!=digest):
+				return None
+		targets=[]
+		for attrs in entry["targets"]:
+			target=Target(attrs["name"],None,attrs["variables"],attrs["metadata"],attrs["options"],attrs["filters"],
+				attrs["preamble"],attrs["input_files"],attrs["output_basename"],attrs["custom_command"])
+			target.subname=attrs["subname"]
+			target.outfile=attrs["outfile"]
+			target.pandoc_command=attrs["pandoc_command"]
+			target.command_args=attrs["command_args"]
+			target.memory=attrs["memory"]
+			target.chunked=attrs["chunked"]
+			targets.append(target)
+		index=dict([(target.subname,target) for target in targets])
+		for (target,attrs) in zip(targets,entry["targets"]):
+			target.dependencies=[index[name] for name in attrs["dependencies"]]
+	except (IOError,OSError,ValueError,KeyError,TypeError):
+		return None
+	return (entry["data"],targets,[source[0] for source in entry["sources"]])
+
+def save_compiled_build_file(infile,pandoc_exec,data,targets,sources):
+	try:
+		entry={"key":get_build_cache_key(infile,pandoc_exec),"data":data,"sources":[],"targets":[]}
+		for source in sources:
+			st=os.stat(source)
+			entry["sources"].append([source,st.st_mtime,st.st_size,hash_file(source)])
+		for target in targets:
+			attrs=dict([(attr,getattr(target,attr)) for attr in target_attributes])
+			attrs["dependencies"]=[dependency.subname for dependency in target.dependencies]
+			entry["targets"].append(attrs)
+		encoded=json.dumps(entry)
+		## Some YAML values (such as dates) do not survive a round trip through JSON
+		if json.loads(encoded)!=entry:
+			return
+		write_file_atomically(get_state_path(infile,".compiled"),encoded.encode('utf-8'))
+	except (IOError,OSError,TypeError,ValueError):
+		pass
+
+def load_build_file(infile,pandoc_exec,sources=None):
+	"""Like parse_file(), but reuses the targets compiled by a previous run if possible"""
+	with profile("load_compiled"):
+		ret=load_compiled_build_file(infile,pandoc_exec)
+	if ret:
+		(data,targets,cached_sources)=ret
+		if sources is not None:
+			sources.extend(cached_sources)
+		return (data,targets)
+	new_sources=[]
+	ret=parse_file(infile,pandoc_exec,new_sources)
+	if sources is not None:
+		sources.extend(new_sources)
+	if ret:
+		save_compiled_build_file(infile,pandoc_exec,ret[0],ret[1],new_sources)
+	return ret
+
+pandoc_versions={}
+pandoc_versions_lock=threading.Lock()
+
+def get_pandoc_version(pandoc_exec):
+	"""Returns the first line of `pandoc --version` (computed once per process)"""
+	from subprocess import Popen, PIPE
+	with pandoc_versions_lock:
+		if pandoc_exec not in pandoc_versions:
+			try:
+				proc=Popen([pandoc_exec,"--version"],stdin=PIPE,stdout=PIPE,stderr=PIPE)
+				(out,err)=proc.communicate()
+				lines=decode_output(out).splitlines()
+				pandoc_versions[pandoc_exec]=lines[0] if lines else "unknown"
+			except OSError:
+				pandoc_versions[pandoc_exec]="unknown"
+		return pandoc_versions[pandoc_exec]
+
+def parse_size(size_str):
+	"""Turns sizes such as 512M or 2G into bytes"""
+	units={"K":1<<10,"M":1<<20,"G":1<<30,"T":1<<40}
+	match=re.match(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)i?B?\s*$',str(size_str),re.IGNORECASE)
+	if not match:
+		raise ValueError("Invalid size: %s" % size_str)
+	(number,unit)=match.groups()
+	return int(float(number)*units.get(unit.upper(),1))
+
+def format_size(size):
+	for unit in ["B","KB","MB","GB"]:
+		if size<1024 or unit=="GB":
+			break
+		size/=1024.0
+	return "%.1f %s" % (size,unit) if unit!="B" else "%d B" % size
+
+class OutputCache:
+	"""
+	Content-addressed store of target outputs shared by several builds
+	(e.g. across branches or CI jobs). Outputs are stored under a key that
+	hashes the normalized command, the pandoc version and the contents of
+	all inputs and dependencies. The least recently used entries are
+	evicted when the size of the cache exceeds its limit.
+	"""
+	default_size="1G"
+
+	def __init__(self,path,max_size=None):
+		self.path=os.path.abspath(path)
+		self.objects_dir=os.path.join(self.path,"objects")
+		self.max_size=parse_size(max_size if max_size else self.default_size)
+		self.lock=threading.Lock()
+
+	def can_store(self,target):
+		return target.outfile and target.outfile!="-" and target.custom_command is None
+
+	def get_key(self,target,inputs):
+		"""Returns None if some input is missing"""
+		import hashlib
+		cmd=list(map(str,target.pandoc_command))
+		digest=hashlib.sha256()
+		digest.update(get_pandoc_version(cmd[0]).encode('utf-8'))
+		## The location of the pandoc executable does not matter
+		cmd[0]="pandoc"
+		digest.update(json.dumps(cmd).encode('utf-8'))
+		for path in inputs:
+			try:
+				file_hash=file_hashes.get(path)
+			except (IOError,OSError):
+				return None
+			digest.update(("\0%s\0%s" % (path,file_hash)).encode('utf-8'))
+		return digest.hexdigest()
+
+	def object_path(self,key):
+		return os.path.join(self.objects_dir,key[:2],key)
+
+	def fetch(self,key,outfile):
+		"""Hard links (or copies) a cached output to outfile if present"""
+		import shutil
+		src=self.object_path(key)
+		if not os.path.exists(src):
+			return False
+		try:
+			if os.path.lexists(outfile):
+				os.remove(outfile)
+			try:
+				os.link(src,outfile)
+			except (OSError,AttributeError):
+				shutil.copy2(src,outfile)
+			## Keep track of usage for LRU eviction
+			os.utime(src,None)
+			return True
+		except (IOError,OSError) as inst:
+			print("Warning: could not retrieve %s from cache: %s" % (outfile,inst),file=sys.stderr)
+			return False
+
+	def store(self,key,outfile):
+		import shutil
+		dst=self.object_path(key)
+		try:
+			if not os.path.isdir(os.path.dirname(dst)):
+				try:
+					os.makedirs(os.path.dirname(dst))
+				except OSError:
+					if not os.path.isdir(os.path.dirname(dst)):
+						raise
+			tmp_path="%s.%d.%d.tmp" % (dst,os.getpid(),threading.current_thread().ident)
+			shutil.copy2(outfile,tmp_path)
+			os.utime(tmp_path,None)
+			if os.name=="nt" and os.path.exists(dst):
+				os.remove(dst)
+			os.rename(tmp_path,dst)
+		except (IOError,OSError) as inst:
+			print("Warning: could not store %s in cache: %s" % (outfile,inst),file=sys.stderr)
+
+	def entries(self):
+		"""Returns a list of (last use,size,path) tuples"""
+		entries=[]
+		if not os.path.isdir(self.objects_dir):
+			return entries
+		for dirname in os.listdir(self.objects_dir):
+			subdir=os.path.join(self.objects_dir,dirname)
+			if not os.path.isdir(subdir):
+				continue
+			for name in os.listdir(subdir):
+				path=os.path.join(subdir,name)
+				try:
+					st=os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime,st.st_size,path))
+		return entries
+
+	def prune(self,max_size=None):
+		"""Evicts least recently used entries. Returns (entries,bytes) removed"""
+		if max_size is None:
+			max_size=self.max_size
+		with self.lock:
+			entries=sorted(self.entries())
+			total=sum([entry[1] for entry in entries])
+			removed=0
+			freed=0
+			for (mtime,size,path) in entries:
+				if total<=max_size:
+					break
+				try:
+					os.remove(path)
+				except OSError:
+					continue
+				total-=size
+				removed+=1
+				freed+=size
+		return (removed,freed)
+
+	def print_stats(self):
+		entries=self.entries()
+		total=sum([entry[1] for entry in entries])
+		print("Cache directory:",self.path)
+		print("Entries:",len(entries))
+		print("Size: %s (limit %s)" % (format_size(total),format_size(self.max_size)))
+		if entries:
+			print("Last used:",time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(max(entries)[0])))
+
+## Options that affect how pandoc reads the input files
+reader_options=set(["f","from","r","read","tab-stop","preserve-tabs","p",
+	"indented-code-classes","default-image-extension","file-scope",
+	"abbreviations","track-changes","strip-comments","extract-media",
+	"metadata-file","M","metadata","bibliography","csl",
+	"citation-abbreviations","shift-heading-level-by","base-header-level",
+	"parse-raw","R","old-dashes","normalize"])
+
+## Options needed both when reading and when writing
+common_options=set(["data-dir","resource-path","verbose","quiet","trace",
+	"sandbox","request-header","no-check-certificate","smart","S"])
+
+## Options that add filters to the chain
+filter_options={"F":"json","filter":"json","L":"lua","lua-filter":"lua","C":"citeproc","citeproc":"citeproc"}
+
+## Interpreters pandoc uses for non-executable filters
+filter_interpreters={".py":["python"],".hs":["runhaskell"],".pl":["perl"],
+	".rb":["ruby"],".php":["php"],".js":["node"],".r":["Rscript"]}
+
+def get_filter_command(path):
+	ext=os.path.splitext(path)[1].lower()
+	if not os.access(path,os.X_OK) and ext in filter_interpreters:
+		return filter_interpreters[ext]+[path]
+	return [path]
+
+def run_json_filter(cmd,fmt,data,pandoc_version):
+	"""Runs a JSON filter the way pandoc does. Returns (exitcode,stdout,stderr)"""
+	from subprocess import Popen, PIPE
+	env=dict(os.environ)
+	match=re.search(r'([0-9][0-9.]*)',pandoc_version)
+	if match:
+		env["PANDOC_VERSION"]=match.group(1)
+	proc=Popen(cmd+[fmt],stdin=PIPE,stdout=PIPE,stderr=PIPE,env=env)
+	(out,err,cpu)=communicate(proc,data)
+	return (proc.returncode,out,err)
+
+def filter_key_for(plan,filter):
+	return json.dumps([plan["filter_key"],filter])
+
+def get_filter_interpreter(path):
+	"""Returns the interpreter that runs a filter script, if any"""
+	cmd=get_filter_command(path)
+	if len(cmd)==2:
+		return find_executable(cmd[0])
+	try:
+		with io.open(path,'rb') as f:
+			line=f.readline(256).decode('utf-8','replace').strip()
+	except (IOError,OSError):
+		return None
+	if not line.startswith("#!"):
+		return None
+	words=line[2:].split()
+	if not words:
+		return None
+	if os.path.basename(words[0])=="env" and len(words)>1:
+		return find_executable(words[1])
+	return words[0]
+
+def serve_filters():
+	"""
+	Main loop of a filter server process. The server reads requests from
+	its standard input (one JSON object per line) and runs each filter in
+	a forked child, so each run starts from a fresh copy of an interpreter
+	that has already imported the modules the filter needs. The child runs
+	the script as __main__, just like `python filter.py FORMAT` would.
+	"""
+	import runpy
+	import traceback
+	requests=io.open(os.dup(0),'rb')
+	responses=io.open(os.dup(1),'wb')
+	devnull=os.open(os.devnull,os.O_RDWR)
+	os.dup2(devnull,0)
+	os.dup2(devnull,1)
+	warm=set()
+
+	for module in ["pandocfilters","panflute"]:
+		try:
+			__import__(module)
+		except Exception:
+			pass
+
+	line=requests.readline()
+	while line:
+		request=json.loads(line.decode('utf-8'))
+		path=request["filter"]
+		if path not in warm:
+			warm.add(path)
+			warm_up_filter(path)
+		pid=os.fork()
+		if pid==0:
+			exitcode=1
+			try:
+				for (fd,name,mode) in [(0,"input",os.O_RDONLY),(1,"output",os.O_WRONLY|os.O_CREAT|os.O_TRUNC),(2,"errors",os.O_WRONLY|os.O_CREAT|os.O_TRUNC)]:
+					os.dup2(os.open(request[name],mode,0o600),fd)
+				sys.stdin=io.TextIOWrapper(io.open(0,'rb',closefd=False))
+				sys.stdout=io.TextIOWrapper(io.open(1,'wb',closefd=False))
+				sys.stderr=io.TextIOWrapper(io.open(2,'wb',closefd=False))
+				os.environ.update(request["env"])
+				sys.argv=[path,request["format"]]
+				sys.path[0]=os.path.dirname(os.path.abspath(path))
+				try:
+					runpy.run_path(path,run_name="__main__")
+					exitcode=0
+				except SystemExit as inst:
+					if inst.code is None:
+						exitcode=0
+					elif isinstance(inst.code,int):
+						exitcode=inst.code
+					else:
+						print(inst.code,file=sys.stderr)
+						exitcode=1
+				except BaseException:
+					traceback.print_exc()
+				sys.stdout.flush()
+				sys.stderr.flush()
+			finally:
+				os._exit(exitcode)
+		(pid,status)=os.waitpid(pid,0)
+		if os.WIFEXITED(status):
+			exitcode=os.WEXITSTATUS(status)
+		else:
+			exitcode=-1
+		responses.write((json.dumps({"exitcode":exitcode})+"\n").encode('utf-8'))
+		responses.flush()
+		line=requests.readline()
+
+def warm_up_filter(path):
+	"""Imports the modules a filter script imports at the top level"""
+	import ast
+	try:
+		with io.open(path,'rb') as f:
+			tree=ast.parse(f.read(),path)
+	except Exception:
+		return
+	sys.path.insert(0,os.path.dirname(os.path.abspath(path)))
+	try:
+		for node in tree.body:
+			if isinstance(node,ast.Import):
+				names=[alias.name for alias in node.names]
+			elif isinstance(node,ast.ImportFrom) and node.module and not node.level:
+				names=[node.module]
+			else:
+				continue
+			for name in names:
+				try:
+					__import__(name)
+				except Exception:
+					pass
+	finally:
+		sys.path.pop(0)
+
+class FilterHost:
+	"""
+	Runs Python JSON filters on a pool of warm filter server processes
+	(see serve_filters()) instead of starting a new interpreter each time.
+	Only filters that would be run by this very Python interpreter are
+	hosted; the rest, and every filter on platforms without fork(), are
+	run as external commands.
+	"""
+	def __init__(self,size=1):
+		self.size=max(1,size)
+		self.idle=queue.Queue()
+		self.servers=[]
+		self.lock=threading.Lock()
+		self.hostable={}
+		self.python=os.path.realpath(sys.executable) if sys.executable else None
+
+	def can_host(self,path):
+		if not hasattr(os,"fork") or getattr(sys,"frozen",False) or not self.python:
+			return False
+		with self.lock:
+			if path not in self.hostable:
+				interpreter=get_filter_interpreter(path)
+				self.hostable[path]=bool(interpreter) and os.path.realpath(interpreter)==self.python
+			return self.hostable[path]
+
+	def acquire(self):
+		from subprocess import Popen, PIPE
+		with self.lock:
+			if self.idle.empty() and len(self.servers)<self.size:
+				server=Popen([sys.executable,os.path.abspath(__file__),"--filter-server"],stdin=PIPE,stdout=PIPE)
+				self.servers.append(server)
+				return server
+		return self.idle.get()
+
+	def run(self,path,fmt,data,pandoc_version,tmp_prefix):
+		"""Same interface as run_json_filter()"""
+		files={}
+		for name in ["input","output","errors"]:
+			files[name]="%s.%d.%s" % (tmp_prefix,threading.current_thread().ident,name)
+		with io.open(files["input"],'wb') as f:
+			f.write(data)
+		env={}
+		match=re.search(r'([0-9][0-9.]*)',pandoc_version)
+		if match:
+			env["PANDOC_VERSION"]=match.group(1)
+		request=dict(files,filter=path,format=fmt,env=env)
+
+		server=self.acquire()
+		try:
+			server.stdin.write((json.dumps(request)+"\n").encode('utf-8'))
+			server.stdin.flush()
+			response=json.loads(server.stdout.readline().decode('utf-8'))
+		except (IOError,OSError,ValueError):
+			## Fall back to an external process if the server is gone
+			with self.lock:
+				self.servers.remove(server)
+			return run_json_filter(get_filter_command(path),fmt,data,pandoc_version)
+		self.idle.put(server)
+
+		with io.open(files["output"],'rb') as f:
+			out=f.read()
+		with io.open(files["errors"],'rb') as f:
+			err=f.read()
+		for name in files.values():
+			os.remove(name)
+		return (response["exitcode"],out,err)
+
+	def close(self):
+		for server in self.servers:
+			server.stdin.close()
+			server.wait()
+		self.servers=[]
+
+def run_workers(worker,count,tokens=None):
+	"""
+	Runs worker on count threads and waits for them to finish. Threads
+	beyond the first need a job slot of the workspace build, if tokens (see
+	JobTokens) are given, so fewer of them may be started: workers must
+	share the items they process.
+	"""
+	threads=[]
+	borrowed=0
+	for i in range(count):
+		if i>0 and tokens:
+			if not tokens.acquire():
+				break
+			borrowed+=1
+		thread=threading.Thread(target=worker)
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	for i in range(borrowed):
+		tokens.release()
+
+def make_stage_plan(target):
+	"""
+	Splits the options of a target into those of the reader, filter and
+	writer stages of pandoc. Returns None for targets that cannot be split
+	"""
+	if target.custom_command is not None or not target.pandoc_command or target.outfile=="-":
+		return None
+	pandoc_exec=target.pandoc_command[0]
+	reader=[]
+	common=[]
+	writer=[]
+	chain=[]
+	for option, val in iter(target.options.items()):
+		values=val if type(val)==list else [val]
+		if option in ("o","output"):
+			continue
+		elif option in filter_options:
+			for item in values:
+				chain.append((filter_options[option],item,render_option(option,[item])))
+		elif option in reader_options:
+			reader.extend(render_option(option,values))
+		elif option in common_options:
+			common.extend(render_option(option,values))
+		else:
+			writer.extend(render_option(option,values))
+	for filter in target.filters:
+		chain.append(("json",filter,["-F",filter]))
+	reader.extend(render_pairs("-M",target.metadata))
+	writer.extend(render_pairs("-V",target.variables))
+
+	## Format pandoc passes to filters
+	fmt=get_output_format(target.options)
+	if not fmt:
+		fmt="latex" if target.outfile.endswith(".pdf") else os.path.splitext(target.outfile)[1][1:]
+
+	## JSON filters that panbuild can run itself
+	hosted=[]
+	for (kind,filter,args) in chain:
+		path=resolve_filter_path(filter) if kind=="json" else None
+		if not path:
+			break
+		hosted.append(path)
+
+	inputs=target.preamble+target.input_files
+	reader_key=json.dumps([pandoc_exec,reader,common,inputs])
+	filter_key=json.dumps([reader_key,hosted,fmt])
+	return {"exec":pandoc_exec,"reader":reader,"common":common,"writer":writer,
+		"chain":chain,"hosted":hosted,"format":fmt,"inputs":inputs,
+		"reader_key":reader_key,"filter_key":filter_key}
+
+class SharedAstBuilder:
+	"""
+	Splits the command of each target into a reader stage (pandoc -t json),
+	a filter stage and a writer stage (pandoc -f json), so that targets
+	sharing the same input files and reader options read their input only
+	once. Filters receive the output format as an argument, so the JSON
+	filters at the beginning of the chain are run by panbuild itself and
+	shared among targets with the same chain and output format; the rest
+	of the chain (Lua filters, citeproc, filters not found) runs in the
+	writer stage. Targets that would not share anything are built with
+	their regular command.
+
+	When file_cache is enabled, ASTs are kept across builds, keyed by the
+	contents of the input files and the reader options. All the input
+	files of a target are read at once, since link references, footnotes
+	and abbreviations may cross files (and --file-scope prefixes
+	identifiers with the name of their file, which a merge of ASTs read
+	separately would not do).
+
+	When a FilterHost is given, Python filters run by panbuild go through
+	it, and targets with such filters are split into stages even if they
+	share nothing with other targets.
+	"""
+	## Unused entries of the AST cache are removed after a week
+	file_cache_max_age=7*24*3600
+
+	def __init__(self,build_file,file_cache=False,jobs=1,filter_host=None,tokens=None):
+		self.work_dir=get_state_path(build_file,".ast")
+		self.file_cache_dir=get_state_path(build_file,".ast-cache") if file_cache else None
+		self.jobs=max(1,jobs)
+		self.tokens=tokens
+		self.filter_host=filter_host
+		self.plans={}
+		self.products={}
+		self.lock=threading.Lock()
+
+	def make_plan(self,target):
+		return make_stage_plan(target)
+
+	def prepare(self,targets):
+		"""Decides which targets share their reader and filter stages"""
+		plans={}
+		reader_count={}
+		filter_count={}
+		for target in targets:
+			plan=self.make_plan(target)
+			if plan:
+				plans[target.subname]=plan
+				reader_count[plan["reader_key"]]=reader_count.get(plan["reader_key"],0)+1
+				filter_count[plan["filter_key"]]=filter_count.get(plan["filter_key"],0)+1
+		for (name,plan) in iter(plans.items()):
+			hosted_filters=False
+			if self.filter_host:
+				for filter in plan["hosted"]:
+					if self.filter_host.can_host(filter):
+						hosted_filters=True
+			## The cache pays off across builds, even for a single target
+			if reader_count[plan["reader_key"]]<2 and not self.file_cache_dir and not hosted_filters:
+				continue
+			## Let pandoc run filters that would not be shared
+			if not plan["hosted"] or (filter_count[plan["filter_key"]]<2 and not hosted_filters):
+				plan["hosted"]=[]
+			self.plans[name]=plan
+
+	def handles(self,target):
+		return target.subname in self.plans
+
+	def profiled(self,name,func,*args):
+		with profile(name,"stage"):
+			return func(*args)
+
+	def produce(self,key,func):
+		"""Runs func only once per key, even if several threads ask for it"""
+		with self.lock:
+			entry=self.products.get(key)
+			owner=entry is None
+			if owner:
+				entry=[threading.Event(),None]
+				self.products[key]=entry
+		if owner:
+			try:
+				entry[1]=func()
+			except OSError as inst:
+				entry[1]=(None,-1,None,str(inst))
+			entry[0].set()
+		else:
+			entry[0].wait()
+		return entry[1]
+
+	def product_path(self,key,suffix):
+		import hashlib
+		if not os.path.isdir(self.work_dir):
+			try:
+				os.makedirs(self.work_dir)
+			except OSError:
+				if not os.path.isdir(self.work_dir):
+					raise
+		return os.path.join(self.work_dir,hashlib.sha1(key.encode('utf-8')).hexdigest()+suffix)
+
+	def read_inputs(self,plan):
+		path=self.product_path(plan["reader_key"],".json")
+		if self.file_cache_dir:
+			self.make_file_cache_dir()
+			(exitcode,err,ast_path)=self.read_file(plan,plan["inputs"])
+			return (ast_path,exitcode,None,err)
+		cmd=[plan["exec"]]+plan["reader"]+plan["common"]+["-t","json","-o",path]+plan["inputs"]
+		(exitcode,out,err)=capture_pandoc(cmd)
+		return (path if exitcode==0 else None,exitcode,out,err)
+
+	def make_file_cache_dir(self):
+		if not os.path.isdir(self.file_cache_dir):
+			try:
+				os.makedirs(self.file_cache_dir)
+			except OSError:
+				if not os.path.isdir(self.file_cache_dir):
+					raise
+
+	def read_file(self,plan,inputs):
+		"""Reads the given input files at once. Returns (exitcode,stderr,path of the cached AST)"""
+		import hashlib
+		try:
+			content_hashes=[file_hashes.get(input) for input in inputs]
+		except (IOError,OSError) as inst:
+			return (-1,str(inst),None)
+		key=json.dumps([get_pandoc_version(plan["exec"]),plan["reader"],plan["common"],inputs,content_hashes])
+		path=os.path.join(self.file_cache_dir,hashlib.sha1(key.encode('utf-8')).hexdigest()+".json")
+		if os.path.exists(path):
+			os.utime(path,None)
+			return (0,None,path)
+		tmp_path="%s.%d.%d.tmp" % (path,os.getpid(),threading.current_thread().ident)
+		cmd=[plan["exec"]]+plan["reader"]+plan["common"]+["-t","json","-o",tmp_path]+inputs
+		(exitcode,out,err)=capture_pandoc(cmd)
+		if exitcode!=0:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			return (exitcode,err,None)
+		if os.name=="nt" and os.path.exists(path):
+			os.remove(path)
+		os.rename(tmp_path,path)
+		return (0,err,path)
+
+	def run_filters(self,plan,ast_path):
+		path=self.product_path(plan["filter_key"],".json")
+		with io.open(ast_path,'rb') as f:
+			data=f.read()
+		version=get_pandoc_version(plan["exec"])
+		for filter in plan["hosted"]:
+			with profile(os.path.basename(filter),"filter",{"format":plan["format"]}):
+				if self.filter_host and self.filter_host.can_host(filter):
+					(exitcode,data,err)=self.filter_host.run(filter,plan["format"],data,version,self.product_path(filter_key_for(plan,filter),""))
+				else:
+					(exitcode,data,err)=run_json_filter(get_filter_command(filter),plan["format"],data,version)
+			if exitcode!=0:
+				return (None,exitcode,None,err)
+		with io.open(path,'wb') as f:
+			f.write(data)
+		return (path,0,None,None)
+
+	def build(self,target,log=None):
+		"""Returns (exitcode,stdout,stderr)"""
+		plan=self.plans[target.subname]
+		(ast_path,exitcode,out,err)=self.produce(plan["reader_key"],lambda: self.profiled("read_inputs",self.read_inputs,plan))
+		## Output of shared stages goes to the log of each target using them
+		self.log_output(log,err)
+		if exitcode!=0:
+			return (exitcode,out,err)
+		if plan["hosted"]:
+			(ast_path,exitcode,out,err)=self.produce(plan["filter_key"],lambda: self.profiled("run_filters",self.run_filters,plan,ast_path))
+			self.log_output(log,err)
+			if exitcode!=0:
+				return (exitcode,out,err)
+
+		## Filters not run by panbuild go into the writer stage, in order
+		pending_filters=[]
+		for (kind,filter,args) in plan["chain"][len(plan["hosted"]):]:
+			pending_filters.extend(args)
+		cmd=[plan["exec"],"-f","json"]+plan["writer"]+plan["common"]+pending_filters+["-o",target.outfile,ast_path]
+		return capture_pandoc(cmd,log)
+
+	def log_output(self,log,err):
+		if not log or not err:
+			return
+		if not isinstance(err,bytes):
+			err=err.encode('utf-8')
+		for line in io.BytesIO(err):
+			log.write("err",line)
+
+	def cleanup(self):
+		import shutil
+		if os.path.isdir(self.work_dir):
+			shutil.rmtree(self.work_dir,True)
+		if self.file_cache_dir and os.path.isdir(self.file_cache_dir):
+			limit=time.time()-self.file_cache_max_age
+			for name in os.listdir(self.file_cache_dir):
+				path=os.path.join(self.file_cache_dir,name)
+				try:
+					if os.stat(path).st_mtime<limit:
+						os.remove(path)
+				except OSError:
+					pass
+
+class IncrementalPdfBuilder:
+	"""
+	Builds LaTeX-based PDF targets in two steps: pandoc generates a .tex
+	file, and the PDF engine is run on it in a build directory kept for each
+	target, where the auxiliary files (aux, toc, etc.) of the previous build
+	are reused. The engine is not run at all when neither the .tex file nor
+	the files it refers to (images, included files, extracted media) have
+	changed since the last successful build, unless the build is forced.
+	"""
+	engines=set(["pdflatex","xelatex","lualatex"])
+	## Files whose changes require running the engine again
+	aux_extensions=[".aux",".toc",".lof",".lot",".out",".nav",".snm"]
+	rerun_pattern=re.compile(br'Rerun to get|Please \(re\)run|Label\(s\) may have changed')
+	max_runs=3
+
+	def __init__(self,build_file):
+		self.build_dir=get_state_path(build_file,".latex")
+
+	def get_engine(self,target):
+		values=get_option_values(target.options,["pdf-engine","latex-engine"])
+		return values[-1] if values else "pdflatex"
+
+	def handles(self,target):
+		if target.custom_command or not target.outfile or os.path.splitext(target.outfile)[1]!=".pdf":
+			return False
+		if get_output_format(target.options) not in (None,"latex","beamer"):
+			return False
+		## Bibliographies processed by bibtex or biber are left to pandoc
+		if "natbib" in target.options or "biblatex" in target.options:
+			return False
+		return os.path.splitext(os.path.basename(self.get_engine(target)))[0] in self.engines
+
+	def get_tex_command(self,target,tex_file,media_dir):
+		cmd=[]
+		for arg in target.pandoc_command:
+			if not arg.startswith("--pdf-engine") and not arg.startswith("--latex-engine"):
+				cmd.append(arg)
+		cmd[cmd.index("-o")+1]=tex_file
+		if not get_output_format(target.options):
+			cmd[1:1]=["-t","latex"]
+		if "s" not in target.options and "standalone" not in target.options:
+			cmd.insert(1,"-s")
+		cmd.insert(1,"--extract-media=%s" % media_dir)
+		return cmd
+
+	def read_aux_files(self,base):
+		contents=[]
+		for extension in self.aux_extensions:
+			try:
+				with io.open(base+extension,'rb') as f:
+					contents.append(f.read())
+			except (IOError,OSError):
+				contents.append(None)
+		return contents
+
+	def get_file_hashes(self,target,inputs,media_dir):
+		"""
+		Returns the hashes of the files the engine reads besides the .tex
+		file: dependencies other than the input files (which make up the
+		.tex file) and the media extracted by pandoc
+		"""
+		sources=set(target.preamble+target.input_files)
+		paths=[path for path in inputs or [] if path not in sources]
+		for (dirpath,dirnames,filenames) in os.walk(media_dir):
+			paths.extend([os.path.join(dirpath,filename) for filename in filenames])
+		hashes={}
+		for path in paths:
+			try:
+				hashes[path]=file_hashes.get(path)
+			except (IOError,OSError):
+				hashes[path]=None
+		return hashes
+
+	def build(self,target,log=None,inputs=None,force=False):
+		"""
+		Returns (exitcode,stdout,stderr). inputs are the files the target
+		depends on, and force runs the engine even if nothing changed
+		"""
+		import shutil
+		work_dir=get_target_path(self.build_dir,target)
+		if not os.path.isdir(work_dir):
+			os.makedirs(work_dir)
+		base=os.path.join(work_dir,"document")
+		new_tex=base+".new.tex"
+		media_dir=os.path.join(work_dir,"media")
+		(exitcode,out,tex_err)=capture_pandoc(self.get_tex_command(target,new_tex,media_dir),log)
+		if exitcode!=0:
+			return (exitcode,out,tex_err)
+
+		with io.open(new_tex,'rb') as f:
+			tex=f.read()
+		hashes=self.get_file_hashes(target,inputs,media_dir)
+		try:
+			with io.open(base+".tex",'rb') as f:
+				unchanged=f.read()==tex
+			with io.open(base+".files.json",'r',encoding='utf-8') as f:
+				unchanged=unchanged and json.load(f)==hashes
+		except (IOError,OSError,ValueError):
+			unchanged=False
+		if unchanged and not force and os.path.exists(base+".pdf"):
+			os.remove(new_tex)
+		else:
+			if os.name=="nt" and os.path.exists(base+".tex"):
+				os.remove(base+".tex")
+			os.rename(new_tex,base+".tex")
+			## A failed run must not leave a PDF that would be reused
+			if os.path.exists(base+".pdf"):
+				os.remove(base+".pdf")
+			cmd=[self.get_engine(target),"-interaction=nonstopmode","-halt-on-error","-output-directory=%s" % work_dir]
+			cmd+=get_option_values(target.options,["pdf-engine-opt"])+[base+".tex"]
+			for run in range(self.max_runs):
+				before=self.read_aux_files(base)
+				with profile("pdf_engine","process",{"run":run+1}):
+					(exitcode,out,err)=capture_pandoc(cmd,log)
+				if exitcode!=0:
+					if os.path.exists(base+".pdf"):
+						os.remove(base+".pdf")
+					## LaTeX reports errors on stdout
+					return (exitcode,None,(err or b"")+(out or b""))
+				try:
+					with io.open(base+".log",'rb') as f:
+						rerun=self.rerun_pattern.search(f.read())
+				except (IOError,OSError):
+					rerun=None
+				if not rerun and self.read_aux_files(base)==before:
+					break
+			write_file_atomically(base+".files.json",json.dumps(hashes,sort_keys=True).encode('utf-8'))
+		shutil.copyfile(base+".pdf",target.outfile)
+		return (0,None,tex_err)
+
+## Options that prevent rendering the input files of a target separately
+chunk_unsafe_options=set(["section-divs","number-offset","reference-location","self-contained",
+	"embed-resources","C","citeproc","natbib","biblatex","file-scope"])
+
+class ChunkedBuilder:
+	"""
+	Builds HTML targets marked as chunked by rendering each input file on
+	its own, in parallel, and joining the results into the final document.
+	Each input file is read into an AST (pandoc -t json), and duplicated
+	section identifiers are renamed as pandoc does for a single document.
+	Then each AST is rendered as an HTML fragment, with its section numbers
+	offset by the top-level sections of the files before it, while the
+	standalone page (with the table of contents, which is built from the
+	headings of all files) is rendered from the headings alone, along with
+	some math and code if the files have any. Footnotes
+	are renumbered and collected at the end of the document. ASTs and
+	fragments are kept across builds, so only the files that changed (or
+	whose section numbers changed) are rendered again.
+	"""
+	writers=set(["html","html5"])
+	start_marker="<!--panbuild-chunks-->"
+	end_marker="<!--/panbuild-chunks-->"
+	note_ref_pattern=re.compile(r'((?:href="#|id=")fn(?:ref)?)([0-9]+)"')
+	note_label_pattern=re.compile(r'(role="doc-noteref"><sup>)([0-9]+)(</sup>)')
+	notes_pattern=re.compile(r'(<section id="footnotes"[^>]*>\s*<hr />\s*<ol>\n?)(.*?)(</ol>\s*</section>\n?)',re.DOTALL)
+
+	def __init__(self,build_file,jobs=1,tokens=None):
+		self.work_dir=get_state_path(build_file,".chunks")
+		self.jobs=max(1,jobs)
+		self.tokens=tokens
+
+	def handles(self,target):
+		if not target.chunked or target.custom_command or len(target.preamble+target.input_files)<2:
+			return False
+		if get_output_format(target.options) not in self.writers:
+			return False
+		for option in target.options:
+			if option in chunk_unsafe_options:
+				return False
+		return True
+
+	def run_parallel(self,func,items):
+		"""
+		Calls func, which returns (exitcode,stdout,stderr), on each item using
+		several threads. Returns the results in order
+		"""
+		results=[None]*len(items)
+		pending=list(range(len(items)))
+		lock=threading.Lock()
+		def worker():
+			while True:
+				with lock:
+					if not pending:
+						return
+					idx=pending.pop(0)
+				try:
+					results[idx]=func(items[idx])
+				except Exception as inst:
+					results[idx]=(-1,None,("%s\n" % inst).encode('utf-8'))
+		run_workers(worker,min(self.jobs,len(items)),self.tokens)
+		return results
+
+	def run_cached(self,cmd,path,log,force=False):
+		"""
+		Runs a command that writes its output to path, unless a previous
+		build did (and force is not set). Returns (exitcode,stdout,stderr)
+		"""
+		if os.path.exists(path) and not force:
+			return (0,None,None)
+		tmp_path="%s.%d.%d.tmp" % (path,os.getpid(),threading.current_thread().ident)
+		(exitcode,out,err)=capture_pandoc(cmd+["-o",tmp_path],log)
+		if exitcode==0:
+			if os.name=="nt" and os.path.exists(path):
+				os.remove(path)
+			os.rename(tmp_path,path)
+		return (exitcode,out,err)
+
+	def get_path(self,work_dir,key,suffix):
+		import hashlib
+		return os.path.join(work_dir,hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()+suffix)
+
+	def get_dependency_hashes(self,inputs,sources):
+		"""
+		Returns the hashes of the files the target depends on other than the
+		input files, such as filters, templates or bibliographies, since
+		changes in them affect every chunk
+		"""
+		hashes=[]
+		for path in inputs or []:
+			if path in sources:
+				continue
+			try:
+				hashes.append([path,file_hashes.get(path)])
+			except (IOError,OSError):
+				hashes.append([path,None])
+		return hashes
+
+	def rename_identifiers(self,docs):
+		"""Makes section identifiers unique across documents. Returns the identifiers renamed in each one"""
+		seen=set()
+		renamed=[]
+		for doc in docs:
+			changes={}
+			for block in doc["blocks"]:
+				if not isinstance(block,dict) or block.get("t")!="Header":
+					continue
+				attr=block["c"][1]
+				ident=attr[0]
+				if ident and ident in seen:
+					count=1
+					while "%s-%d" % (ident,count) in seen:
+						count+=1
+					attr[0]="%s-%d" % (ident,count)
+					changes[ident]=attr[0]
+				seen.add(attr[0])
+			renamed.append(changes)
+		return renamed
+
+	def find_head_elements(self,docs):
+		"""
+		Returns blocks with the first math and code found in the documents,
+		since the template only includes the scripts and styles they need
+		(such as MathJax or the highlighting CSS) if the page contains them
+		"""
+		found={}
+		def walk(value):
+			if isinstance(value,list):
+				for item in value:
+					walk(item)
+			elif isinstance(value,dict):
+				kind=value.get("t")
+				if kind in ("Math","Code","CodeBlock") and kind not in found:
+					found[kind]=value
+				elif kind=="CodeBlock" and not found[kind]["c"][0][1] and value["c"][0][1]:
+					## Only code with a language is highlighted
+					found[kind]=value
+				walk(value.get("c"))
+		for doc in docs:
+			walk(doc["blocks"])
+		blocks=[]
+		inlines=[found[kind] for kind in ("Math","Code") if kind in found]
+		if inlines:
+			blocks.append({"t":"Para","c":inlines})
+		if "CodeBlock" in found:
+			blocks.append(found["CodeBlock"])
+		return blocks
+
+	def count_sections(self,doc):
+		count=0
+		for block in doc["blocks"]:
+			if isinstance(block,dict) and block.get("t")=="Header" and block["c"][0]==1 and "unnumbered" not in block["c"][1][1]:
+				count+=1
+		return count
+
+	def join_fragments(self,fragments):
+		"""Concatenates HTML fragments, renumbering their footnotes, which are moved to the end"""
+		parts=[]
+		notes=[]
+		wrapper=None
+		for fragment in fragments:
+			offset=len(notes)
+			match=self.notes_pattern.search(fragment)
+			if match:
+				items=match.group(2)
+				fragment=fragment[:match.start()]+fragment[match.end():]
+				wrapper=wrapper or (match.group(1),match.group(3))
+			else:
+				items=""
+			if offset:
+				renumber=lambda m: "%s%d%s" % (m.group(1),int(m.group(2))+offset,'"')
+				fragment=self.note_ref_pattern.sub(renumber,fragment)
+				fragment=self.note_label_pattern.sub(lambda m: "%s%d%s" % (m.group(1),int(m.group(2))+offset,m.group(3)),fragment)
+				items=self.note_ref_pattern.sub(renumber,items)
+			notes.extend(re.findall(r'<li id="fn[0-9]+".*?</li>\n?',items,re.DOTALL))
+			parts.append(fragment)
+		if notes:
+			parts.append(wrapper[0]+"".join(notes)+wrapper[1])
+		return "".join(parts)
+
+	def build(self,target,log=None,inputs=None,force=False):
+		"""
+		Returns (exitcode,stdout,stderr). inputs are the files the target
+		depends on, and force renders every chunk again
+		"""
+		plan=make_stage_plan(target)
+		work_dir=get_target_path(self.work_dir,target)
+		if not os.path.isdir(work_dir):
+			os.makedirs(work_dir)
+		version=get_pandoc_version(plan["exec"])
+		dependencies=self.get_dependency_hashes(inputs,set(plan["inputs"]))
+
+		## Read each file into an AST
+		asts=[self.get_path(work_dir,[version,plan["reader"],plan["common"],input,file_hashes.get(input),dependencies],".json") for input in plan["inputs"]]
+		jobs=[([plan["exec"]]+plan["reader"]+plan["common"]+["-t","json",input],path) for (input,path) in zip(plan["inputs"],asts)]
+		with profile("read_chunks","stage"):
+			results=self.run_parallel(lambda job: self.run_cached(job[0],job[1],log,force),jobs)
+		docs=[]
+		for ((exitcode,out,err),path) in zip(results,asts):
+			if exitcode!=0:
+				return (exitcode,out,err)
+			with io.open(path,'r',encoding='utf-8') as f:
+				docs.append(json.load(f))
+		renamed=self.rename_identifiers(docs)
+
+		## Render fragments, and the page they go into
+		filters=[]
+		for (kind,filter,args) in plan["chain"]:
+			filters.extend(args)
+		writer=[arg for arg in plan["writer"] if arg not in ("-s","--standalone")]
+		standalone=len(writer)<len(plan["writer"])
+		numbered="N" in target.options or "number-sections" in target.options
+		used=set([os.path.basename(path) for path in asts])
+		jobs=[]
+		offset=0
+		for (doc,changes,path) in zip(docs,renamed,asts):
+			options=writer+plan["common"]+filters+(["--number-offset=%d" % offset] if numbered and offset else [])
+			if changes:
+				path=self.get_path(work_dir,[path,changes],".json")
+				with io.open(path,'wb') as f:
+					f.write(json.dumps(doc).encode('utf-8'))
+			jobs.append(([plan["exec"],"-f","json"]+options+[path],self.get_path(work_dir,[path,options,dependencies],".html")))
+			offset+=self.count_sections(doc)
+		if standalone:
+			headers=[block for doc in docs for block in doc["blocks"] if isinstance(block,dict) and block.get("t")=="Header"]
+			meta={}
+			for doc in docs:
+				meta.update(doc["meta"])
+			markers=[{"t":"RawBlock","c":["html",self.start_marker]},{"t":"RawBlock","c":["html",self.end_marker]}]
+			data=json.dumps(dict(docs[0],meta=meta,blocks=markers[:1]+headers+self.find_head_elements(docs)+markers[1:]))
+			path=self.get_path(work_dir,[data],".json")
+			with io.open(path,'wb') as f:
+				f.write(data.encode('utf-8'))
+			options=plan["writer"]+plan["common"]+filters
+			jobs.append(([plan["exec"],"-f","json"]+options+[path],self.get_path(work_dir,[path,options,dependencies],".html")))
+		for (cmd,path) in jobs:
+			used.add(os.path.basename(cmd[-1]))
+			used.add(os.path.basename(path))
+		with profile("render_chunks","stage"):
+			results=self.run_parallel(lambda job: self.run_cached(job[0],job[1],log,force),jobs)
+		for (exitcode,out,err) in results:
+			if exitcode!=0:
+				return (exitcode,out,err)
+
+		outputs=[]
+		for (cmd,path) in jobs:
+			with io.open(path,'r',encoding='utf-8') as f:
+				outputs.append(f.read())
+		body=self.join_fragments(outputs[:len(docs)])
+		if standalone:
+			page=outputs[-1]
+			start=page.find(self.start_marker)
+			end=page.find(self.end_marker)
+			if start<0 or end<start:
+				return (1,None,b"The template of the target does not include the body of the document\n")
+			body=page[:start]+body.rstrip("\n")+page[end+len(self.end_marker):]
+		with io.open(target.outfile,'wb') as f:
+			f.write(body.encode('utf-8'))
+
+		## Forget the chunks of previous versions of the files
+		for name in os.listdir(work_dir):
+			if name not in used:
+				try:
+					os.remove(os.path.join(work_dir,name))
+				except OSError:
+					pass
+		return (0,None,None)
+
+def prepare_output(outfile):
+	"""
+	Make sure that pandoc does not write through a hard link that points
+	to an entry of the output cache
+	"""
+	if not outfile:
+		return
+	try:
+		if os.stat(outfile).st_nlink>1:
+			os.remove(outfile)
+	except OSError:
+		pass
+
+def has_fileno(stream):
+	"""Whether a stream is backed by a file descriptor that child processes can inherit"""
+	try:
+		stream.fileno()
+		return True
+	except (AttributeError,IOError,ValueError):
+		return False
+
 def run_pandoc(cmd,ignoreErrors=False,verbose=False):
     """
     Low level function to invoke Pandoc 
     """
+    from subprocess import Popen, PIPE, call
     pandoc_path = cmd[0]
     custom_command= False
     text=''
 
     if pandoc_path=="pandoc":
-    	pandoc_path=which(pandoc_path)
+    	pandoc_path=find_executable(pandoc_path)
     else:
     	custom_command=True
 
     if not custom_command and (pandoc_path is None or not os.path.exists(pandoc_path)):
         raise OSError("Path to pandoc executable does not exist")
 
-    if verbose:
+    if verbose and has_fileno(sys.stdout) and has_fileno(sys.stderr):
     	exitcode=call(cmd)
     	if not ignoreErrors and exitcode != 0:
     		sys.exit(exitcode) 
+    elif verbose:
+    	## Output is being captured (e.g. by the build daemon)
+    	proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    	out, err = proc.communicate()
+    	exitcode = proc.returncode
+    	sys.stdout.write(decode_output(out))
+    	sys.stderr.write(decode_output(err))
+    	if not ignoreErrors and exitcode != 0:
+    		sys.exit(exitcode) 
     if not verbose:
     	proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
     	out, err = proc.communicate(input=text.encode('utf-8'))
@@ -829,12 +2571,1943 @@ def run_pandoc(cmd,ignoreErrors=False,verbose=False):
 
     return exitcode
 
+## Lines of pandoc (and LaTeX) output reported as warnings
+warning_pattern=re.compile(r'^\[WARNING\]|Warning:')
+
+class TargetLog:
+	"""
+	Log of the output of the command of a target, written to a file as the
+	command runs. Only the last lines of each stream and the first warnings
+	are kept in memory, so memory use does not depend on how much the
+	command prints. The file is rotated when it grows too large, keeping a
+	few of the previous parts. Warnings are passed to on_warning (if given)
+	as soon as they are found.
+	"""
+	max_size=1<<20
+	backups=2
+	tail_lines=50
+	max_warnings=100
+	max_line=8192
+
+	def __init__(self,path,on_warning=None):
+		import collections
+		self.path=path
+		self.on_warning=on_warning
+		self.file=None
+		self.size=0
+		self.lock=threading.Lock()
+		self.tails={"out":collections.deque(maxlen=self.tail_lines),"err":collections.deque(maxlen=self.tail_lines)}
+		self.lines={"out":0,"err":0}
+		self.warnings=[]
+		self.warning_count=0
+
+	def open(self):
+		## Parts left by previous builds
+		for suffix in [".%d" % i for i in range(1,self.backups+1)]:
+			try:
+				os.remove(self.path+suffix)
+			except OSError:
+				pass
+		dirname=os.path.dirname(self.path)
+		if not os.path.isdir(dirname):
+			try:
+				os.makedirs(dirname)
+			except OSError:
+				if not os.path.isdir(dirname):
+					raise
+		self.file=io.open(self.path,'wb')
+
+	def rotate(self):
+		self.file.close()
+		for i in range(self.backups,0,-1):
+			source=self.path+(".%d" % (i-1) if i>1 else "")
+			if os.path.exists(source):
+				if os.name=="nt" and os.path.exists(self.path+".%d" % i):
+					os.remove(self.path+".%d" % i)
+				os.rename(source,self.path+".%d" % i)
+		self.file=io.open(self.path,'wb')
+		self.size=0
+
+	def write(self,stream,line):
+		"""Adds a line (or a piece of a long line) printed by the command to stream ('out' or 'err')"""
+		with self.lock:
+			if self.file is None:
+				self.open()
+			elif self.size>=self.max_size:
+				self.rotate()
+			self.file.write(line)
+			self.size+=len(line)
+			self.tails[stream].append(line)
+			self.lines[stream]+=1
+			if stream!="err":
+				return
+			text=decode_output(line).rstrip()
+			if not warning_pattern.search(text):
+				return
+			self.warning_count+=1
+			if len(self.warnings)<self.max_warnings:
+				self.warnings.append(text)
+		if self.on_warning:
+			self.on_warning(text)
+
+	def read(self,stream,pipe):
+		for line in iter(lambda: pipe.readline(self.max_line),b''):
+			self.write(stream,line)
+		pipe.close()
+
+	def tail(self,stream):
+		"""Returns the last lines printed to stream, or None if there were none"""
+		return b''.join(self.tails[stream]) or None
+
+	def truncated(self):
+		return max(self.lines.values())>self.tail_lines
+
+	def close(self):
+		if self.file:
+			self.file.close()
+			return
+		## The command printed nothing: remove the log of a previous build
+		try:
+			os.remove(self.path)
+		except OSError:
+			return
+		for suffix in [".%d" % i for i in range(1,self.backups+1)]:
+			try:
+				os.remove(self.path+suffix)
+			except OSError:
+				pass
+
+def capture_pandoc(cmd,log=None):
+	"""
+	Invoke a pandoc command keeping its output apart from that of other
+	commands running at the same time. Returns (exitcode,stdout,stderr).
+	If a TargetLog is given, the output is streamed into it (which is left
+	open for further commands), and only its last lines are returned.
+	"""
+	from subprocess import Popen, PIPE
+	pandoc_path = cmd[0]
+
+	if pandoc_path=="pandoc":
+		pandoc_path=find_executable(pandoc_path)
+		if pandoc_path is None or not os.path.exists(pandoc_path):
+			raise OSError("Path to pandoc executable does not exist")
+
+	with profile(os.path.basename(cmd[0]),"process") as span:
+		with profile("spawn","spawn"):
+			proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+		(out,err,cpu) = communicate(proc,''.encode('utf-8'),log)
+		span.args["cpu"]=cpu
+	if log:
+		return (proc.returncode,log.tail("out"),log.tail("err"))
+	return (proc.returncode,out,err)
+
+## CPU time of the child processes run by each thread, while profiling
+child_usage=threading.local()
+
+def communicate(proc,data=None,log=None):
+	"""
+	Like Popen.communicate(), but also returns the CPU time used by the
+	child process (None if unknown). CPU time is only collected while
+	profiling, on systems that provide wait4(). If a TargetLog is given,
+	the output is written to it instead of being returned.
+	"""
+	profiling=profiler.enabled and hasattr(os,"wait4")
+	if not profiling and not log:
+		(out,err)=proc.communicate(input=data)
+		return (out,err,None)
+
+	output={"out":None,"err":None}
+	def read_output(name,stream):
+		output[name]=stream.read()
+		stream.close()
+	read=log.read if log else read_output
+	readers=[threading.Thread(target=read,args=("out",proc.stdout)),threading.Thread(target=read,args=("err",proc.stderr))]
+	for reader in readers:
+		reader.start()
+	try:
+		if data:
+			proc.stdin.write(data)
+		proc.stdin.close()
+	except (IOError,OSError):
+		pass
+	for reader in readers:
+		reader.join()
+	if not profiling:
+		proc.wait()
+		return (None,None,None)
+	(pid,status,usage)=os.wait4(proc.pid,0)
+	if os.WIFSIGNALED(status):
+		proc.returncode=-os.WTERMSIG(status)
+	else:
+		proc.returncode=os.WEXITSTATUS(status)
+	cpu=usage.ru_utime+usage.ru_stime
+	child_usage.cpu=getattr(child_usage,"cpu",0.0)+cpu
+	return (output["out"],output["err"],cpu)
+
+## Options of pandoc that pandoc-server accepts (the name of its field, and
+## whether it takes a number). Targets using other options are run as
+## usual, as are those with filters or binary inputs and outputs
+server_options={"f":("from",False),"from":("from",False),"r":("from",False),"read":("from",False),
+	"t":("to",False),"to":("to",False),"w":("to",False),"write":("to",False),
+	"s":("standalone",False),"standalone":("standalone",False),
+	"toc":("table-of-contents",False),"table-of-contents":("table-of-contents",False),"toc-depth":("toc-depth",True),
+	"N":("number-sections",False),"number-sections":("number-sections",False),"section-divs":("section-divs",False),
+	"wrap":("wrap",False),"columns":("columns",True),"tab-stop":("tab-stop",True),
+	"shift-heading-level-by":("shift-heading-level-by",True),"top-level-division":("top-level-division",False),
+	"ascii":("ascii",False),"reference-links":("reference-links",False),"html-q-tags":("html-q-tags",False),
+	"id-prefix":("identifier-prefix",False),"i":("incremental",False),"incremental":("incremental",False),
+	"slide-level":("slide-level",True)}
+server_readers={"md":"markdown","markdown":"markdown","txt":"markdown","rst":"rst","org":"org",
+	"tex":"latex","html":"html","htm":"html","textile":"textile"}
+server_binary_writers=set(["docx","odt","epub","epub2","epub3","pptx","pdf"])
+
+def get_server_request(target):
+	"""
+	Translates the command of a target into a request for pandoc-server,
+	or returns None if the server cannot build it
+	"""
+	if target.custom_command or target.filters or not target.outfile:
+		return None
+	request={"variables":{},"metadata":{}}
+	for (option,value) in iter(target.options.items()):
+		if option in ("o","output"):
+			continue
+		if option not in server_options:
+			return None
+		(field,numeric)=server_options[option]
+		value=value[-1] if type(value)==list else value
+		if value is None:
+			value=True
+		elif numeric:
+			try:
+				value=int(value)
+			except ValueError:
+				return None
+		request[field]=value
+	writer=request.get("to")
+	if not isinstance(writer,str) or re.split(r'[+-]',writer)[0] in server_binary_writers:
+		return None
+	if os.path.splitext(target.outfile)[1]==".pdf":
+		return None
+	inputs=target.preamble+target.input_files
+	if "from" not in request:
+		readers=set([server_readers.get(os.path.splitext(input)[1][1:].lower()) for input in inputs])
+		if len(readers)!=1 or None in readers:
+			return None
+		request["from"]=readers.pop()
+	for (key,value) in iter(target.variables.items()):
+		request["variables"][key]=str(value) if value else "true"
+	for (key,value) in iter(target.metadata.items()):
+		request["metadata"][key]=str(value) if value else True
+	return (request,inputs)
+
+class PandocServer:
+	"""
+	A pandoc-server process, started the first time it is needed and kept
+	running until panbuild exits (so the build daemon reuses it for all
+	its builds). Each worker thread keeps its own connection to it.
+	"""
+	start_timeout=10
+
+	def __init__(self,pandoc_exec):
+		self.pandoc_exec=pandoc_exec
+		self.proc=None
+		self.port=None
+		self.available=True
+		self.lock=threading.Lock()
+		self.connections=threading.local()
+
+	def start(self):
+		import socket
+		from subprocess import Popen
+		sock=socket.socket()
+		sock.bind(("127.0.0.1",0))
+		self.port=sock.getsockname()[1]
+		sock.close()
+		devnull=open(os.devnull,"w")
+		try:
+			self.proc=Popen([self.pandoc_exec,"server","--port",str(self.port)],stdout=devnull,stderr=devnull)
+		except OSError:
+			return False
+		deadline=time.time()+self.start_timeout
+		while time.time()<deadline and self.proc.poll() is None:
+			try:
+				socket.create_connection(("127.0.0.1",self.port),1).close()
+				return True
+			except (IOError,OSError):
+				time.sleep(0.05)
+		self.stop()
+		return False
+
+	def stop(self):
+		if self.proc and self.proc.poll() is None:
+			self.proc.terminate()
+			self.proc.wait()
+		self.proc=None
+
+	def ensure_started(self):
+		with self.lock:
+			if self.available and self.proc is None:
+				self.available=self.start()
+				if not self.available:
+					print("Warning: pandoc server could not be started, running pandoc for each target", file=sys.stderr)
+			return self.available
+
+	def post(self,request):
+		"""
+		Returns (status,body) of the response of the server to a request.
+		A request that fails (on a connection the server may have closed,
+		for instance) is sent once more on a new connection. Errors are
+		raised as IOError
+		"""
+		try:
+			import http.client as httplib
+		except ImportError:
+			import httplib
+		for attempt in range(2):
+			connection=getattr(self.connections,"connection",None)
+			if connection is None:
+				connection=httplib.HTTPConnection("127.0.0.1",self.port)
+				self.connections.connection=connection
+			try:
+				connection.request("POST","/",json.dumps(request),{"Content-Type":"application/json","Accept":"application/json"})
+				response=connection.getresponse()
+				return (response.status,response.read())
+			except (httplib.HTTPException,IOError,OSError) as inst:
+				connection.close()
+				self.connections.connection=None
+				if attempt>0:
+					raise IOError("pandoc server: %s" % (inst or inst.__class__.__name__))
+
+	def build(self,target,request,inputs):
+		"""
+		Builds a target translated by get_server_request(). Returns
+		(exitcode,stdout,stderr), or None if the server is not available
+		"""
+		if not self.ensure_started():
+			return None
+		request=dict(request)
+		try:
+			request["text"]="\n\n".join([io.open(input,encoding='utf-8').read() for input in inputs])
+		except (IOError,OSError,ValueError) as inst:
+			return (1,None,("%s\n" % inst).encode('utf-8'))
+		with profile("pandoc-server","process"):
+			try:
+				(status,body)=self.post(request)
+			except (IOError,OSError,ValueError):
+				## Connection errors: the server may have died
+				if self.proc and self.proc.poll() is not None:
+					with self.lock:
+						self.available=False
+				return None
+		try:
+			response=json.loads(decode_output(body))
+		except ValueError:
+			response=None
+		if status!=200 or not isinstance(response,dict) or "output" not in response:
+			return (1,None,body.rstrip()+b"\n")
+		messages="".join(["[%s] %s\n" % (message.get("verbosity","INFO"),message.get("message","")) for message in response.get("messages",[])])
+		output=response["output"]
+		if response.get("base64"):
+			import base64
+			data=base64.b64decode(output)
+		else:
+			## pandoc ends non-standalone outputs with a newline
+			if not request.get("standalone") and not output.endswith("\n"):
+				output+="\n"
+			data=output.encode('utf-8')
+		with io.open(target.outfile,'wb') as f:
+			f.write(data)
+		return (0,None,messages.encode('utf-8') or None)
+
+pandoc_servers={}
+pandoc_servers_lock=threading.Lock()
+
+def get_pandoc_server(pandoc_exec):
+	"""Returns the server for a pandoc executable, shut down when panbuild exits"""
+	with pandoc_servers_lock:
+		if not pandoc_servers:
+			import atexit
+			atexit.register(stop_pandoc_servers)
+		if pandoc_exec not in pandoc_servers:
+			pandoc_servers[pandoc_exec]=PandocServer(pandoc_exec)
+		return pandoc_servers[pandoc_exec]
+
+def stop_pandoc_servers():
+	for server in pandoc_servers.values():
+		server.stop()
+
+def get_default_jobs():
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError,NotImplementedError):
+		return 1
+
+def decode_output(data):
+	if data is None:
+		return ""
+	if isinstance(data,bytes):
+		return data.decode('utf-8','replace')
+	return data
+
+def format_duration(seconds):
+	if seconds<60:
+		return "%.1f s" % seconds
+	return "%dm %02ds" % (seconds//60,seconds%60)
+
+def estimate_build_time(durations,jobs):
+	"""Time needed to run jobs with the given durations on a number of workers, longest first"""
+	loads=[0.0]*max(1,min(jobs,len(durations)))
+	for duration in sorted(durations,reverse=True):
+		loads[loads.index(min(loads))]+=duration
+	return max(loads)
+
+class BuildHistory:
+	"""
+	Duration, exit code and output size of the recent builds of each
+	target, stored in an SQLite database in the state directory. Used to
+	start the slowest targets first and to estimate build times.
+	"""
+	max_entries=50 ## Builds kept per target
+	samples=5 ## Builds averaged in estimates
+
+	def __init__(self,build_file):
+		self.path=get_state_path(build_file,".history.sqlite")
+		self.db=None
+		self.estimates=None
+		self.recorded=set()
+
+	def connect(self,create=False):
+		"""Returns the database connection, or None if there is no history"""
+		if self.db is None and (create or os.path.exists(self.path)):
+			try:
+				import sqlite3
+			except ImportError:
+				return None
+			try:
+				if not os.path.isdir(os.path.dirname(self.path)):
+					os.makedirs(os.path.dirname(self.path))
+				self.db=sqlite3.connect(self.path,timeout=10)
+				self.db.execute("CREATE TABLE IF NOT EXISTS builds (target TEXT, started REAL, duration REAL, exitcode INTEGER, size INTEGER, cached INTEGER)")
+				self.db.execute("CREATE INDEX IF NOT EXISTS builds_by_target ON builds (target,started)")
+			except (sqlite3.Error,OSError) as inst:
+				print("Warning: build history not available (%s)" % inst, file=sys.stderr)
+				self.db=None
+		return self.db
+
+	def get_estimates(self):
+		"""Returns the expected duration of the targets built before"""
+		if self.estimates is None:
+			self.estimates={}
+			db=self.connect()
+			if db:
+				durations={}
+				for (name,duration) in db.execute("SELECT target,duration FROM builds WHERE exitcode=0 AND cached=0 ORDER BY started DESC"):
+					samples=durations.setdefault(name,[])
+					if len(samples)<self.samples:
+						samples.append(duration)
+				for (name,samples) in iter(durations.items()):
+					self.estimates[name]=sum(samples)/len(samples)
+		return self.estimates
+
+	def record(self,result):
+		db=self.connect(True)
+		if not db or result.duration is None:
+			return
+		target=result.target
+		size=None
+		if target.outfile and os.path.isfile(target.outfile):
+			size=os.path.getsize(target.outfile)
+		db.execute("INSERT INTO builds VALUES (?,?,?,?,?,?)",(target.subname,result.started,result.duration,result.exitcode,size,int(result.cached)))
+		self.recorded.add(target.subname)
+
+	def save(self):
+		if not self.db:
+			return
+		for name in self.recorded:
+			self.db.execute("DELETE FROM builds WHERE target=? AND rowid NOT IN (SELECT rowid FROM builds WHERE target=? ORDER BY started DESC LIMIT ?)",(name,name,self.max_entries))
+		self.recorded=set()
+		self.db.commit()
+		self.estimates=None
+
+	def get_builds(self,name):
+		"""Returns (started,duration,exitcode,size,cached) for past builds of a target, oldest first"""
+		db=self.connect()
+		if not db:
+			return []
+		return list(db.execute("SELECT started,duration,exitcode,size,cached FROM builds WHERE target=? ORDER BY started",(name,)))
+
+	def print_report(self,name):
+		builds=self.get_builds(name)
+		print("%s:" % name)
+		if not builds:
+			print("  No builds recorded")
+			return
+		for (started,duration,exitcode,size,cached) in builds:
+			status="Cached" if cached else ("Success" if exitcode==0 else "Failed")
+			print("  %s %10s  %-8s %10s" % (time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(started)),
+				format_duration(duration),status,format_size(size) if size is not None else "-"))
+		durations=[duration for (started,duration,exitcode,size,cached) in builds if exitcode==0 and not cached]
+		recent=durations[-self.samples:]
+		if recent:
+			line="  Average of the last %d builds: %s" % (len(recent),format_duration(sum(recent)/len(recent)))
+			previous=durations[-2*self.samples:-self.samples]
+			if previous and sum(previous)>0:
+				change=(sum(recent)/len(recent))/(sum(previous)/len(previous))-1
+				line+=" (%d%% %s than the %d builds before)" % (abs(change)*100,"slower" if change>=0 else "faster",len(previous))
+			print(line)
+
+class BuildResult:
+	def __init__(self,target,exitcode,out=None,err=None,up_to_date=False,cached=False):
+		self.target=target
+		self.exitcode=exitcode
+		self.out=out
+		self.err=err
+		self.up_to_date=up_to_date
+		self.cached=cached
+		self.started=None
+		self.duration=None ## Set for targets actually built
+		self.log=None ## TargetLog of the command, if its output was logged
+		self.same_as=None ## Target built in its place, as it runs the same command
+		self.skipped=False ## Not started because of the failure of another target
+
+class BuildScheduler:
+	"""
+	Runs the commands of the selected targets on a bounded pool of worker
+	threads. A target is not started until the targets it depends on (if
+	selected) have been built, so targets must be given in an order where
+	dependencies come first (see sort_targets()). The outcome of each target
+	is reported in that order, no matter the order in which they complete.
+	"""
+	## Warnings of each target shown in the summary printed at the end
+	summary_warnings=10
+
+	def __init__(self,targets,jobs=1,verbose=False,keep_going=False,state=None,force=False,cache=None,ast_builder=None,history=None,memory=None,log_dir=None,use_server=False,pdf_builder=None,chunked_builder=None,tokens=None):
+		self.targets=targets
+		self.jobs=max(1,jobs)
+		self.verbose=verbose
+		self.keep_going=keep_going
+		self.state=state
+		self.force=force
+		self.cache=cache
+		self.ast_builder=ast_builder
+		self.done=queue.Queue()
+		self.results={}
+		self.snapshots={}
+		self.next_report=0
+		self.selected=set(targets)
+		self.exitcodes={}
+		self.history=history
+		self.estimates=history.get_estimates() if history else {}
+		## Targets without history are expected to take an average time
+		self.default_estimate=sum(self.estimates.values())/len(self.estimates) if self.estimates else 0.0
+		self.up_to_date={}
+		self.built=set()
+		## Jobs are only started while their expected memory fits in the budget
+		self.memory=memory
+		self.memory_used=0
+		self.reserved={}
+		## The output of commands goes to a log file per target
+		self.log_dir=log_dir
+		self.output_lock=threading.Lock()
+		self.logged=[]
+		self.use_server=use_server
+		self.pdf_builder=pdf_builder
+		self.chunked_builder=chunked_builder
+		## Targets running the same command are built once
+		(self.same_as,self.conflicts)=find_duplicate_targets(targets)
+		## Targets writing the same output file are built one after the other
+		self.same_output={}
+		for target in targets:
+			if target in self.conflicts:
+				group=self.same_output.setdefault(self.conflicts[target],[self.conflicts[target]])
+				group.append(target)
+				self.same_output[target]=group
+		## In workspace builds, jobs beyond the first take slots from the workspace
+		self.tokens=tokens
+		self.borrowed=0
+
+	## Sequential runs keep the output of the command on the terminal
+	def live_output(self):
+		return self.jobs==1
+
+	def run_job(self,idx,target,inputs):
+		child_usage.cpu=0.0
+		started=time.time()
+		## run() waits for a result of every job, so one is posted no matter what fails
+		result=None
+		try:
+			with profile(target.subname,"target") as span:
+				result=self.build_target(target,inputs)
+				if profiler.enabled:
+					span.args["cpu"]=child_usage.cpu
+					span.args["exitcode"]=result.exitcode
+		except Exception as inst:
+			result=BuildResult(target,-1,None,"%s\n" % inst)
+		finally:
+			if result is None:
+				result=BuildResult(target,-1)
+			result.started=started
+			result.duration=time.time()-started
+			self.done.put((idx,result))
+
+	def build_target(self,target,inputs):
+		try:
+			key=None
+			if self.cache and self.cache.can_store(target):
+				with profile("cache_lookup","cache"):
+					key=self.cache.get_key(target,inputs)
+					if key and self.cache.fetch(key,target.outfile):
+						return BuildResult(target,0,cached=True)
+			prepare_output(target.outfile)
+			## Incremental PDF and chunked builds take precedence over sharing ASTs
+			if self.pdf_builder and self.pdf_builder.handles(target):
+				result=self.build_logged(target,lambda target,log: self.pdf_builder.build(target,log,inputs,self.force))
+			elif self.chunked_builder and self.chunked_builder.handles(target):
+				result=self.build_logged(target,lambda target,log: self.chunked_builder.build(target,log,inputs,self.force))
+			elif self.ast_builder and self.ast_builder.handles(target):
+				result=self.build_logged(target,self.ast_builder.build)
+			elif self.verbose and self.live_output():
+				exitcode=run_pandoc(target.pandoc_command,True,True)
+				result=BuildResult(target,exitcode)
+			else:
+				log=self.create_log(target)
+				try:
+					ret=self.build_on_server(target) if self.use_server else None
+					if ret is None:
+						(exitcode,out,err)=capture_pandoc(target.pandoc_command,log)
+					else:
+						(exitcode,out,err)=ret
+						if log:
+							for line in io.BytesIO(err or b""):
+								log.write("err",line)
+				finally:
+					if log:
+						log.close()
+				result=BuildResult(target,exitcode,out,err)
+				result.log=log
+			if key and result.exitcode==0 and os.path.exists(target.outfile):
+				with profile("cache_store","cache"):
+					self.cache.store(key,target.outfile)
+		except OSError as inst:
+			result=BuildResult(target,-1,None,str(inst))
+		return result
+
+	def build_logged(self,target,build):
+		"""Builds a target with build(target,log), which returns (exitcode,stdout,stderr)"""
+		log=self.create_log(target)
+		try:
+			(exitcode,out,err)=build(target,log)
+		finally:
+			if log:
+				log.close()
+		result=BuildResult(target,exitcode,out,err)
+		result.log=log
+		return result
+
+	def build_on_server(self,target):
+		"""Returns (exitcode,stdout,stderr), or None if pandoc-server cannot build the target"""
+		translated=get_server_request(target)
+		if translated is None:
+			return None
+		pandoc_exec=target.pandoc_command[0]
+		if pandoc_exec=="pandoc":
+			pandoc_exec=find_executable(pandoc_exec)
+			if pandoc_exec is None:
+				return None
+		(request,inputs)=translated
+		return get_pandoc_server(pandoc_exec).build(target,request,inputs)
+
+	def create_log(self,target):
+		if not self.log_dir:
+			return None
+		path=get_target_path(self.log_dir,target)+".log"
+		return TargetLog(path,None if self.live_output() else lambda line: self.print_warning(target,line))
+
+	def print_warning(self,target,line):
+		"""Shows warnings as they are found while building targets in parallel"""
+		with self.output_lock:
+			print("%s: %s" % (target.subname,line), file=sys.stderr)
+			sys.stderr.flush()
+
+	def print_warning_summary(self):
+		logs=[result.log for result in self.logged if result.log.warning_count>0]
+		if not logs:
+			return
+		print("%d warning(s) in %d target(s):" % (sum([log.warning_count for log in logs]),len(logs)), file=sys.stderr)
+		for result in self.logged:
+			log=result.log
+			if log.warning_count==0:
+				continue
+			print("  %s (see %s):" % (result.target.subname,os.path.relpath(log.path)), file=sys.stderr)
+			for line in log.warnings[:self.summary_warnings]:
+				print("    %s" % line, file=sys.stderr)
+			if log.warning_count>self.summary_warnings:
+				print("    ... and %d more" % (log.warning_count-self.summary_warnings), file=sys.stderr)
+		sys.stderr.flush()
+
+	def announce(self,target):
+		if self.verbose:
+			print("Building target %s" % target.subname)
+			if target.pandoc_command:
+				print("Command:",' '.join(map(str,target.pandoc_command)))
+		else:
+			print("Building target %s ..." % target.subname,end="")
+		sys.stdout.flush()
+
+	def report(self,result):
+		## Skipped targets are only counted
+		if result.skipped:
+			return
+		if not self.live_output() or result.up_to_date:
+			self.announce(result.target)
+			if self.verbose and result.out:
+				print(decode_output(result.out),end="")
+		if result.up_to_date:
+			print("Up to date")
+		elif result.cached:
+			print("Success (cached)")
+		elif result.same_as and result.exitcode==0:
+			print("Success (same command as %s)" % result.same_as.subname)
+		elif result.exitcode==0:
+			print("Success")
+		else:
+			print("Failed")
+		sys.stdout.flush()
+		if result.err and (result.exitcode!=0 or self.verbose):
+			with self.output_lock:
+				if result.log and result.log.truncated():
+					print("Last lines of the output (see %s):" % os.path.relpath(result.log.path),file=sys.stderr)
+				print(decode_output(result.err),end="",file=sys.stderr)
+				sys.stderr.flush()
+		if result.log:
+			self.logged.append(result)
+
+	def finish(self,idx,result):
+		self.exitcodes[result.target]=result.exitcode
+		self.results[idx]=result
+		self.flush_reports()
+
+	def estimate(self,target):
+		return self.estimates.get(target.subname,self.default_estimate)
+
+	def get_dependencies(self,target):
+		"""Returns the targets to build before the given one"""
+		if target in self.same_as:
+			return target.dependencies+[self.same_as[target]]
+		if target in self.conflicts:
+			return target.dependencies+[self.conflicts[target]]
+		return target.dependencies
+
+	def finish_duplicate(self,idx,target):
+		"""Reports a target whose command was run for another target"""
+		if self.state and not self.force and self.is_up_to_date(target):
+			self.finish(idx,BuildResult(target,0,up_to_date=True))
+			return 0
+		if self.live_output():
+			self.announce(target)
+		same_as=self.same_as[target]
+		result=BuildResult(target,self.exitcodes[same_as])
+		result.same_as=same_as
+		if result.exitcode!=0:
+			result.err="Not built because %s failed\n" % same_as.subname
+		if self.state:
+			if result.exitcode==0:
+				self.state.record(target,self.state.snapshot(target))
+			else:
+				self.state.forget(target)
+		self.finish(idx,result)
+		return result.exitcode
+
+	def next_ready(self,pending):
+		"""
+		Returns the position in pending of the next target to start among
+		those whose dependencies are done and whose memory fits in what is
+		left of the budget: the one expected to take longest or, for
+		sequential builds (whose output is not reordered), the first
+		"""
+		best=None
+		for (pos,(idx,target)) in enumerate(pending):
+			for dependency in self.get_dependencies(target):
+				if dependency in self.selected and dependency not in self.exitcodes:
+					break
+			else:
+				## Targets larger than the whole budget are built alone
+				if self.memory and self.memory_used>0 and self.memory_used+get_target_memory(target)>self.memory:
+					continue
+				if not self.estimates or self.live_output():
+					return pos
+				if best is None or self.estimate(target)>best[1]:
+					best=(pos,self.estimate(target))
+		return best[0] if best else None
+
+	def is_up_to_date(self,target):
+		"""
+		Checks the state of a target once per build: the answer found when
+		estimating the build time is reused, unless a target it depends on
+		has been built since
+		"""
+		known=self.up_to_date.get(target)
+		if known is None or (known and [dependency for dependency in self.get_dependencies(target) if dependency in self.built]):
+			known=self.state.is_up_to_date(target)
+		self.up_to_date[target]=known
+		return known
+
+	def print_conflicts(self):
+		for target in self.targets:
+			if target in self.conflicts:
+				print("Warning: targets %s and %s both write %s, so they are built one after the other" % (self.conflicts[target].subname,target.subname,target.outfile), file=sys.stderr)
+		sys.stderr.flush()
+
+	def print_estimate(self):
+		"""Prints the expected build time, based on the history of the targets that must be built"""
+		durations=[]
+		known=False
+		for target in self.targets:
+			if not target.get_command():
+				continue
+			if self.state and not self.force and self.is_up_to_date(target):
+				continue
+			known=known or target.subname in self.estimates
+			durations.append(self.estimate(target))
+		if known:
+			print("Estimated build time: %s" % format_duration(estimate_build_time(durations,self.jobs)), file=sys.stderr)
+			sys.stderr.flush()
+
+	def flush_reports(self):
+		while self.next_report in self.results:
+			self.report(self.results.pop(self.next_report))
+			self.next_report+=1
+
+	def return_tokens(self,running):
+		"""Gives back the workspace slots not needed by the running jobs"""
+		while self.borrowed>max(running-1,0):
+			self.tokens.release()
+			self.borrowed-=1
+
+	def run(self):
+		"""
+		Returns 0 if all targets were built successfully, or the exit code
+		of the first failing target otherwise
+		"""
+		pending=list(enumerate(self.targets))
+		running=0
+		status=0
+		skipped=0
+
+		if self.estimates:
+			self.print_estimate()
+		self.print_conflicts()
+
+		while pending or running>0:
+			while pending and running<self.jobs and (status==0 or self.keep_going):
+				pos=self.next_ready(pending)
+				if pos is None:
+					break
+				if self.tokens and self.borrowed<running:
+					if not self.tokens.acquire():
+						break
+					self.borrowed+=1
+				(idx,target)=pending.pop(pos)
+				if target in self.same_as:
+					exitcode=self.finish_duplicate(idx,target)
+					if exitcode!=0:
+						status=status or (exitcode if exitcode>0 else 1)
+					continue
+				failed=[dependency.subname for dependency in target.dependencies if self.exitcodes.get(dependency,0)!=0]
+				if failed or not target.get_command():
+					## Errors in the command were reported when building it
+					if self.live_output():
+						self.announce(target)
+					err="Not built because %s failed\n" % ", ".join(failed) if failed else None
+					self.finish(idx,BuildResult(target,2,err=err))
+					status=status or 2
+					continue
+				with profile("check_target","check",{"target":target.subname}):
+					if self.state:
+						if not self.force and self.is_up_to_date(target):
+							self.finish(idx,BuildResult(target,0,up_to_date=True))
+							continue
+						self.snapshots[idx]=self.state.snapshot(target)
+						inputs=self.state.get_inputs(target)
+					else:
+						inputs=get_target_inputs(target,DependencyScanner())
+				if self.live_output():
+					self.announce(target)
+				if self.memory:
+					self.reserved[idx]=get_target_memory(target)
+					self.memory_used+=self.reserved[idx]
+				worker=threading.Thread(target=self.run_job,args=(idx,target,inputs),name=target.subname)
+				worker.daemon=True
+				worker.start()
+				running+=1
+
+			if self.tokens:
+				self.return_tokens(running)
+
+			## Do not launch more jobs after a failure
+			if status!=0 and not self.keep_going:
+				skipped+=len(pending)
+				## Their results keep the report of the targets that follow them going
+				for (idx,target) in pending:
+					self.results[idx]=BuildResult(target,2)
+					self.results[idx].skipped=True
+				pending=[]
+				if running==0:
+					break
+
+			if running==0:
+				if pending:
+					## Not possible if dependencies come first
+					raise RuntimeError("Targets are not sorted by their dependencies")
+				continue
+			(idx,result)=self.done.get()
+			running-=1
+			self.built.add(result.target)
+			self.memory_used-=self.reserved.pop(idx,0)
+			if self.history:
+				self.history.record(result)
+			if result.exitcode!=0 and status==0:
+				status=result.exitcode if result.exitcode>0 else 1
+			if self.state:
+				if result.exitcode==0:
+					self.state.record(result.target,self.snapshots.pop(idx))
+					## Other targets writing the same file are no longer up to date
+					for other in self.same_output.get(result.target,[]):
+						if other is not result.target:
+							self.state.forget(other)
+				else:
+					self.state.forget(result.target)
+			self.finish(idx,result)
+		self.flush_reports()
+
+		if skipped>0:
+			print("%d target(s) not built due to previous errors" % skipped, file=sys.stderr)
+		self.print_warning_summary()
+
+		if self.cache:
+			self.cache.prune()
+
+		return status
+
+def run_cache_command(args):
+	if not args.cache_dir:
+		print("No cache directory specified (use --cache-dir or set PANBUILD_CACHE_DIR)", file=sys.stderr)
+		return 2
+	try:
+		cache=OutputCache(args.cache_dir,args.cache_size)
+	except ValueError as inst:
+		print(inst, file=sys.stderr)
+		return 2
+
+	command=args.targets[1] if len(args.targets)>1 else "stats"
+	if command=="stats":
+		cache.print_stats()
+	elif command=="prune":
+		(removed,freed)=cache.prune()
+		print("Removed %d entries (%s)" % (removed,format_size(freed)))
+	else:
+		print("Unknown cache command '%s' (expected stats or prune)" % command, file=sys.stderr)
+		return 3
+	return 0
+
+def find_duplicate_targets(targets):
+	"""
+	Returns two dicts, mapping targets to an earlier target: the targets
+	whose command is identical to that of the earlier target (so building
+	the latter is enough), and those whose command overwrites the output
+	file of the earlier target (the last one before them that writes it)
+	with different contents
+	"""
+	same_as={}
+	conflicts={}
+	commands={}
+	outputs={}
+	for target in targets:
+		cmd=target.get_command()
+		if not cmd:
+			continue
+		key=tuple(cmd)
+		if key in commands:
+			same_as[target]=commands[key]
+			continue
+		commands[key]=target
+		if target.outfile and target.outfile!="-":
+			path=os.path.normcase(os.path.normpath(target.outfile))
+			if path in outputs:
+				conflicts[target]=outputs[path]
+			outputs[path]=target
+	return (same_as,conflicts)
+
+def materialize_targets(targets):
+	"""Builds the commands of the given targets. Returns the targets with errors"""
+	return [target for target in targets if not target.get_command()]
+
+def format_target_list(targets,verbose=False,list_output=False):
+	"""Targets with errors in their command are left out when listing commands or outputs"""
+	lines=[]
+	for target in targets:
+		if (verbose or list_output) and not target.get_command():
+			continue
+		if verbose:
+			lines.append(target.subname+": "+' '.join(map(str,target.pandoc_command)))
+		elif list_output:
+			lines.append("%s: %s" % (target.subname,target.outfile))
+		else:
+			lines.append(target.subname)
+	return lines
+
+def print_target_list(targets,verbose=False,list_output=False):
+	"""Returns 2 if some targets were left out due to errors, and 0 otherwise"""
+	lines=format_target_list(targets,verbose,list_output)
+	for line in lines:
+		print(line)
+	return 2 if len(lines)<len(targets) else 0
+
+def clean_targets(targets):
+	"""Returns 2 if the output of some targets is unknown due to errors, and 0 otherwise"""
+	failed=materialize_targets(targets)
+	for target in targets:
+		if target.outfile and target not in failed:
+			try:
+				os.remove(target.outfile)
+				print("Removing file",target.outfile)
+			except OSError:
+				pass
+	return 2 if failed else 0
+
+def enable_profiling(trace_file):
+	"""The report is generated at exit, no matter which path the program takes"""
+	import atexit
+	global profiler
+	profiler=Profiler()
+	def report():
+		profiler.print_summary()
+		try:
+			profiler.write_trace(trace_file)
+			print("Trace written to",trace_file,file=sys.stderr)
+		except (IOError,OSError) as inst:
+			print("Could not write trace file:",inst,file=sys.stderr)
+	atexit.register(report)
+
+def get_target_formats(target):
+	"""
+	Returns the names by which the output format of a target can be
+	selected: its pandoc writer and the extension of its output file
+	"""
+	options=target.options
+	writer=get_output_format(options)
+	formats=set([writer]) if writer else set()
+	outfile=target.outfile
+	if not outfile:
+		values=get_option_values(options,["o","output"])
+		outfile=values[0] if values else None
+	if outfile:
+		formats.add(os.path.splitext(outfile)[1][1:])
+	elif not writer:
+		formats.add("pdf")
+	elif "s" in options or "standalone" in options:
+		formats.add(output_table_standalone.get(writer,writer))
+	else:
+		formats.add(output_table_regular.get(writer,writer))
+	return formats
+
+## Memory expected to be used by pandoc (and the PDF engine) for each output
+## format, when not given by the memory attribute of targets (see --memory)
+memory_estimates={"pdf":1<<30,"docx":256<<20,"odt":256<<20,"epub":256<<20,"pptx":256<<20}
+default_memory_estimate=128<<20
+
+def get_target_memory(target):
+	"""Returns the memory (in bytes) expected to be used to build a target"""
+	if target.memory is not None:
+		return target.memory
+	if target.custom_command:
+		return default_memory_estimate
+	return max([memory_estimates.get(name,default_memory_estimate) for name in get_target_formats(target)])
+
+def get_target_index(targets):
+	"""Maps target names to targets (the first one, if duplicated)"""
+	index={}
+	for target in targets:
+		index.setdefault(target.subname,target)
+	return index
+
+def match_targets(targets,index,selector):
+	"""Returns the targets matched by a selector given in the command line"""
+	if selector in index:
+		return [index[selector]]
+	if selector.startswith("re:"):
+		try:
+			regex=re.compile("(?:%s)\\Z" % selector[3:])
+		except re.error as inst:
+			print("Invalid regular expression '%s': %s" % (selector[3:],inst), file=sys.stderr)
+			return []
+		return [target for target in targets if regex.match(target.subname)]
+	if selector.startswith("format:"):
+		fmt=selector[7:]
+		return [target for target in targets if fmt in get_target_formats(target)]
+	if re.search(r'[*?[]',selector):
+		import fnmatch
+		return [target for target in targets if fnmatch.fnmatchcase(target.subname,selector)]
+	## The name of a target with subtargets selects all of them
+	prefix=selector.rstrip("/")+"/"
+	return [target for target in targets if target.subname.startswith(prefix)]
+
+def select_targets(targets,names,ignore_missing=False):
+	"""
+	Returns the targets selected by the user (all if none), or None on
+	error (unless ignore_missing is set, names that match no target are
+	errors). Besides target names, the user may give the name of a target
+	with subtargets (to select all of them), glob patterns over target
+	names (e.g. PDF/* or */EN), regular expressions matching whole names
+	(re:PATTERN) and output formats (format:pdf)
+	"""
+	if len(names)==0:
+		return sort_targets(targets)[0]
+	index=get_target_index(targets)
+	selected_targets=[]
+	selected=set()
+	for selector in names:
+		matches=match_targets(targets,index,selector)
+		if not matches and ignore_missing:
+			continue
+		if not matches:
+			print("Target '%s' does not exist in build file" % selector, file=sys.stderr)
+			return None
+		for target in matches:
+			if target not in selected:
+				selected.add(target)
+				selected_targets.append(target)
+	## Targets are built after those they depend on
+	return sort_targets(selected_targets)[0]
+
+def sort_targets(targets):
+	"""
+	Returns (ordered,cycle): the given targets, along with those they
+	depend on (directly or not), placing each target after its
+	dependencies and keeping the given order otherwise. In case of a
+	circular dependency, ordered is None and cycle lists the targets in it.
+	"""
+	ordered=[]
+	## 1 while visiting the dependencies of a target, 2 afterwards
+	visited={}
+	for root in targets:
+		if root in visited:
+			continue
+		visited[root]=1
+		stack=[(root,iter(root.dependencies))]
+		while stack:
+			(target,dependencies)=stack[-1]
+			dependency=next(dependencies,None)
+			if dependency is None:
+				stack.pop()
+				visited[target]=2
+				ordered.append(target)
+			elif dependency not in visited:
+				visited[dependency]=1
+				stack.append((dependency,iter(dependency.dependencies)))
+			elif visited[dependency]==1:
+				path=[item[0] for item in stack]
+				return (None,path[path.index(dependency):]+[dependency])
+	return (ordered,None)
+
+def resolve_dependencies(targets):
+	"""
+	Links each target to those given in the depends_on attribute of the
+	target or its parents, which may be any selector accepted in the
+	command line. Returns False on errors, such as circular dependencies.
+	"""
+	index=get_target_index(targets)
+	for target in targets:
+		target.dependencies=[]
+		node=target
+		while node:
+			for selector in node.depends_on or []:
+				matches=match_targets(targets,index,selector)
+				if not matches:
+					print("Error: target %s depends on '%s', which does not exist" % (target.subname,selector), file=sys.stderr)
+					return False
+				for dependency in matches:
+					if dependency not in target.dependencies:
+						target.dependencies.append(dependency)
+			node=node.parent
+	(ordered,cycle)=sort_targets(targets)
+	if cycle:
+		print("Error: circular dependency between targets: %s" % " -> ".join([target.subname for target in cycle]), file=sys.stderr)
+		return False
+	return True
+
+class BuildSession:
+	"""
+	Settings and bookkeeping shared by the builds performed by a single
+	panbuild process (several of them in watch mode)
+	"""
+	def __init__(self,args):
+		self.args=args
+		if args.jobs is None:
+			self.jobs=get_default_jobs()
+		else:
+			self.jobs=args.jobs
+		self.state=BuildState(args.build_file,args.hash)
+		self.cache=None
+		if args.cache_dir:
+			self.cache=OutputCache(args.cache_dir,args.cache_size)
+		self.history=BuildHistory(args.build_file)
+		tokens_path=os.environ.get("PANBUILD_JOB_TOKENS")
+		self.tokens=JobTokens(tokens_path) if tokens_path else None
+
+	def build(self,targets):
+		args=self.args
+		## Targets with errors are reported as failed by the scheduler
+		materialize_targets(targets)
+		ast_builder=None
+		filter_host=None
+		if args.host_filters:
+			filter_host=FilterHost(self.jobs)
+		pdf_builder=IncrementalPdfBuilder(args.build_file) if args.incremental_pdf else None
+		chunked_builder=ChunkedBuilder(args.build_file,self.jobs,self.tokens)
+		if args.share_ast or args.ast_cache or filter_host:
+			ast_builder=SharedAstBuilder(args.build_file,args.ast_cache,self.jobs,filter_host,self.tokens)
+			ast_builder.prepare([target for target in targets if not (pdf_builder and pdf_builder.handles(target)) and not chunked_builder.handles(target)])
+
+		scheduler=BuildScheduler(targets,self.jobs,args.verbose,args.keep_going,self.state,args.always_build,self.cache,ast_builder,self.history,args.memory,
+			None if args.no_logs else get_state_path(args.build_file,".logs"),args.pandoc_server,pdf_builder,
+			chunked_builder,self.tokens)
+		with profile("build"):
+			status=scheduler.run()
+		if ast_builder:
+			ast_builder.cleanup()
+		if filter_host:
+			filter_host.close()
+		with profile("save_state"):
+			self.state.save()
+			self.history.save()
+		return status
+
+class PollingWatcher:
+	"""Detects changes in a set of files by checking their timestamps periodically"""
+	def __init__(self,interval=0.5):
+		self.interval=interval
+		self.signatures={}
+
+	def signature(self,path):
+		try:
+			st=os.stat(path)
+			return (st.st_mtime,st.st_size)
+		except OSError:
+			return None
+
+	def set_paths(self,paths):
+		signatures={}
+		for path in paths:
+			if path in self.signatures:
+				signatures[path]=self.signatures[path]
+			else:
+				signatures[path]=self.signature(path)
+		self.signatures=signatures
+
+	def wait(self,timeout=None):
+		"""Returns the set of files changed before timeout expires (None means forever)"""
+		deadline=None if timeout is None else time.time()+timeout
+		while True:
+			changed=set()
+			for (path,old) in iter(self.signatures.items()):
+				new=self.signature(path)
+				if new!=old:
+					self.signatures[path]=new
+					changed.add(path)
+			if changed:
+				return changed
+			if deadline is not None and time.time()>=deadline:
+				return changed
+			if deadline is None:
+				time.sleep(self.interval)
+			else:
+				time.sleep(max(0,min(self.interval,deadline-time.time())))
+
+	def close(self):
+		pass
+
+class InotifyWatcher:
+	"""
+	Detects changes in a set of files through Linux's inotify API. The
+	directories containing the files are watched rather than the files
+	themselves, so that editors that save files by replacing them are
+	also handled.
+	"""
+	events=0x2|0x4|0x8|0x40|0x80|0x100|0x200 ## MODIFY|ATTRIB|CLOSE_WRITE|MOVED_FROM|MOVED_TO|CREATE|DELETE
+
+	def __init__(self):
+		import ctypes
+		import ctypes.util
+		import select
+		import struct
+		self.ctypes=ctypes
+		self.select=select
+		self.struct=struct
+		self.libc=ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+		self.fd=self.libc.inotify_init()
+		if self.fd<0:
+			raise OSError(ctypes.get_errno(),"inotify_init failed")
+		self.watches={} ## Directory -> watch descriptor
+		self.dirs={} ## Watch descriptor -> directory
+		self.paths=set()
+
+	def set_paths(self,paths):
+		self.paths=set([os.path.abspath(path) for path in paths])
+		dirs=set([os.path.dirname(path) for path in self.paths])
+		for dirname in list(self.watches.keys()):
+			if dirname not in dirs:
+				self.libc.inotify_rm_watch(self.fd,self.watches[dirname])
+				del self.dirs[self.watches.pop(dirname)]
+		for dirname in dirs:
+			if dirname in self.watches or not os.path.isdir(dirname):
+				continue
+			wd=self.libc.inotify_add_watch(self.fd,dirname.encode(sys.getfilesystemencoding()),self.events)
+			if wd>=0:
+				self.watches[dirname]=wd
+				self.dirs[wd]=dirname
+
+	def wait(self,timeout=None):
+		(ready,_,_)=self.select.select([self.fd],[],[],timeout)
+		changed=set()
+		if not ready:
+			return changed
+		data=os.read(self.fd,64*1024)
+		offset=0
+		while offset+16<=len(data):
+			(wd,mask,cookie,length)=self.struct.unpack_from("iIII",data,offset)
+			name=data[offset+16:offset+16+length].rstrip(b"\0").decode(sys.getfilesystemencoding(),"replace")
+			offset+=16+length
+			if wd in self.dirs:
+				path=os.path.join(self.dirs[wd],name)
+				if path in self.paths:
+					changed.add(path)
+		return changed
+
+	def close(self):
+		os.close(self.fd)
+
+def create_watcher():
+	if sys.platform.startswith("linux"):
+		try:
+			return InotifyWatcher()
+		except (OSError,AttributeError,ImportError):
+			pass
+	return PollingWatcher()
+
+def watch_and_build(session,targets,selected_targets,sources,debounce=0.3):
+	"""
+	Rebuilds the targets affected by changes in the files they depend on.
+	Changes to the build file cause it to be parsed again; then only the
+	targets whose command changed are rebuilt.
+	"""
+	args=session.args
+	watcher=create_watcher()
+	try:
+		while True:
+			inputs=set()
+			for target in selected_targets:
+				for path in session.state.get_inputs(target):
+					inputs.add(os.path.abspath(path))
+			source_paths=set([os.path.abspath(path) for path in sources])
+			watcher.set_paths(list(inputs|source_paths))
+			print("Watching %d files for changes (press Ctrl+C to stop)" % len(inputs|source_paths))
+			sys.stdout.flush()
+
+			## Wait for a burst of changes to settle
+			changed=watcher.wait()
+			while True:
+				more=watcher.wait(debounce)
+				if not more:
+					break
+				changed|=more
+
+			affected=set()
+			if changed & source_paths:
+				new_sources=[]
+				ret=load_build_file(args.build_file,args.pandoc_exe,new_sources)
+				if not ret:
+					print("Errors found in build file; waiting for further changes", file=sys.stderr)
+					continue
+				old_commands=dict([(target.subname,target.pandoc_command) for target in selected_targets])
+				(yaml_data,new_targets)=ret
+				new_selected=select_targets(new_targets,args.targets)
+				if new_selected is None:
+					continue
+				(selected_targets,sources)=(new_selected,new_sources)
+				for target in selected_targets:
+					if old_commands.get(target.subname)!=target.get_command():
+						affected.add(target)
+
+			for target in selected_targets:
+				for path in session.state.get_inputs(target):
+					if os.path.abspath(path) in changed:
+						affected.add(target)
+						break
+
+			if affected:
+				session.build([target for target in selected_targets if target in affected])
+	except KeyboardInterrupt:
+		pass
+	finally:
+		watcher.close()
+
+## Requests of clients are forwarded along with these command-line options
+daemon_args=["build_file","list_targets","list_output","verbose","pandoc_exe",
+	"jobs","keep_going","always_build","hash","share_ast","ast_cache","host_filters",
+	"cache_dir","cache_size","memory","pandoc_server","incremental_pdf","no_logs","targets"]
+
+## The daemon exits after this many seconds without requests
+daemon_idle_timeout=1800
+
+def get_daemon_socket_path():
+	"""
+	Returns the path of the socket of the build daemon, which lives in a
+	directory only accessible to the user, or None if that directory is
+	not safe to use
+	"""
+	path=os.environ.get("PANBUILD_SOCKET")
+	if path:
+		return path
+	runtime_dir=os.environ.get("XDG_RUNTIME_DIR")
+	if runtime_dir and os.path.isdir(runtime_dir):
+		return os.path.join(runtime_dir,"panbuild.sock")
+	import tempfile, stat
+	uid=os.getuid() if hasattr(os,"getuid") else 0
+	directory=os.path.join(tempfile.gettempdir(),"panbuild-%d" % uid)
+	try:
+		os.mkdir(directory,0o700)
+	except OSError:
+		pass
+	try:
+		info=os.lstat(directory)
+	except OSError:
+		return None
+	## Anyone else could replace the socket otherwise
+	if not stat.S_ISDIR(info.st_mode) or info.st_uid!=uid or info.st_mode & 0o077:
+		print("Warning: %s is not a private directory, the build daemon is disabled" % directory, file=sys.stderr)
+		return None
+	return os.path.join(directory,"daemon.sock")
+
+def send_daemon_request(path,request,timeout=None):
+	"""Returns the response of the daemon listening on path, or None if it is not running"""
+	import socket
+	sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except (OSError,IOError):
+		sock.close()
+		return None
+	try:
+		sock.settimeout(timeout)
+		sock.sendall((json.dumps(request)+"\n").encode('utf-8'))
+		chunks=[]
+		chunk=sock.recv(65536)
+		while chunk:
+			chunks.append(chunk)
+			chunk=sock.recv(65536)
+		return json.loads(b"".join(chunks).decode('utf-8'))
+	except (OSError,IOError,ValueError):
+		return None
+	finally:
+		sock.close()
+
+def get_panbuild_command():
+	"""Returns the command that runs panbuild itself"""
+	if getattr(sys,"frozen",False):
+		return [sys.executable]
+	return [sys.executable,os.path.abspath(__file__)]
+
+def start_daemon():
+	from subprocess import Popen
+	cmd=get_panbuild_command()+["--daemon"]
+	devnull=open(os.devnull,'r+')
+	kwargs={}
+	if hasattr(os,"setsid"):
+		kwargs["preexec_fn"]=os.setsid
+	Popen(cmd,stdin=devnull,stdout=devnull,stderr=devnull,close_fds=True,**kwargs)
+
+def run_daemon_client(args):
+	"""
+	Forwards the request to the build daemon, starting it if necessary.
+	Returns the exit code, or None if the request must be served locally.
+	"""
+	if not hasattr(__import__("socket"),"AF_UNIX"):
+		return None
+	path=get_daemon_socket_path()
+	if path is None:
+		return None
+	## Requests run in the directory of the client, so paths are sent as given
+	request={"command":"run","cwd":os.getcwd(),"args":{}}
+	for name in daemon_args:
+		request["args"][name]=getattr(args,name)
+
+	response=send_daemon_request(path,request)
+	if response is None:
+		try:
+			start_daemon()
+		except OSError:
+			return None
+		deadline=time.time()+5
+		while response is None and time.time()<deadline:
+			time.sleep(0.05)
+			response=send_daemon_request(path,request)
+		if response is None:
+			return None
+	sys.stdout.write(response.get("stdout",""))
+	sys.stderr.write(response.get("stderr",""))
+	return response.get("status",1)
+
+class BuildDaemon:
+	"""
+	Serves panbuild requests over a Unix domain socket, using a simple
+	protocol: each connection carries one JSON request terminated by a
+	newline, and gets back a JSON object with the exit status and the
+	output the command would have printed. Parsed build files are kept in
+	memory as long as the files they come from do not change. Queries
+	served from memory run concurrently; anything else (parsing, builds,
+	clean) runs one request at a time, as it requires changing the working
+	directory of the process.
+	"""
+	def __init__(self,socket_path):
+		self.socket_path=socket_path
+		self.build_files={}
+		self.exec_lock=threading.Lock()
+		self.last_request=time.time()
+		self.running=True
+
+	def get_targets(self,cwd,args):
+		"""Returns the targets of the build file if still valid in memory"""
+		key=(cwd,args.build_file,args.pandoc_exe)
+		entry=self.build_files.get(key)
+		if not entry:
+			return None
+		for (path,mtime,size) in entry[0]:
+			try:
+				st=os.stat(path)
+				if st.st_mtime!=mtime or st.st_size!=size:
+					return None
+			except OSError:
+				return None
+		return entry[1]
+
+	def parse(self,cwd,args):
+		sources=[]
+		ret=load_build_file(args.build_file,args.pandoc_exe,sources)
+		if not ret:
+			return None
+		signature=[]
+		for path in sources:
+			path=os.path.abspath(path)
+			st=os.stat(path)
+			signature.append((path,st.st_mtime,st.st_size))
+		self.build_files[(cwd,args.build_file,args.pandoc_exe)]=(signature,ret[1])
+		return ret[1]
+
+	def list_targets(self,args,targets):
+		lines=format_target_list(targets,args.verbose,args.list_output)
+		status=2 if len(lines)<len(targets) else 0
+		return {"status":status,"stdout":"".join([line+"\n" for line in lines]),"stderr":""}
+
+	def execute(self,request,args):
+		"""Runs a request that requires the working directory of the client"""
+		try:
+			from StringIO import StringIO
+		except ImportError:
+			from io import StringIO
+		(old_stdout,old_stderr,old_cwd)=(sys.stdout,sys.stderr,os.getcwd())
+		(sys.stdout,sys.stderr)=(StringIO(),StringIO())
+		status=0
+		try:
+			os.chdir(request["cwd"])
+			targets=self.get_targets(request["cwd"],args)
+			if targets is None:
+				targets=self.parse(request["cwd"],args)
+			if targets is None:
+				status=2
+			elif args.list_targets or args.list_output:
+				status=print_target_list(targets,args.verbose,args.list_output)
+			elif "clean" in args.targets:
+				status=clean_targets(targets)
+			else:
+				selected_targets=select_targets(targets,args.targets)
+				if selected_targets is None:
+					status=3
+				else:
+					status=BuildSession(args).build(selected_targets)
+		except Exception as inst:
+			print("Error:",inst,file=sys.stderr)
+			status=1
+		finally:
+			(out,err)=(sys.stdout.getvalue(),sys.stderr.getvalue())
+			(sys.stdout,sys.stderr)=(old_stdout,old_stderr)
+			os.chdir(old_cwd)
+		return {"status":status,"stdout":out,"stderr":err}
+
+	def handle(self,request):
+		command=request.get("command")
+		if command=="ping":
+			return {"status":0}
+		if command=="shutdown":
+			self.running=False
+			return {"status":0}
+		if command!="run":
+			return {"status":1,"stderr":"Unknown request\n"}
+
+		args=argparse.Namespace(**request["args"])
+		if args.list_targets or args.list_output:
+			targets=self.get_targets(request["cwd"],args)
+			## Building commands may report errors, which requires execute()
+			if targets is not None and not (args.verbose or args.list_output):
+				return self.list_targets(args,targets)
+			if targets is not None and not [target for target in targets if target.command_args is not None]:
+				return self.list_targets(args,targets)
+		with self.exec_lock:
+			return self.execute(request,args)
+
+	def serve_connection(self,conn):
+		try:
+			data=b""
+			while not data.endswith(b"\n"):
+				chunk=conn.recv(65536)
+				if not chunk:
+					break
+				data+=chunk
+			try:
+				response=self.handle(json.loads(data.decode('utf-8')))
+			except (ValueError,KeyError,TypeError) as inst:
+				response={"status":1,"stderr":"Invalid request: %s\n" % inst}
+			conn.sendall(json.dumps(response).encode('utf-8'))
+		except (OSError,IOError):
+			pass
+		finally:
+			conn.close()
+
+	def serve(self):
+		import socket
+		if os.path.exists(self.socket_path):
+			## Another daemon may be running already
+			if send_daemon_request(self.socket_path,{"command":"ping"},1) is not None:
+				print("A panbuild daemon is already listening on",self.socket_path,file=sys.stderr)
+				return 1
+			os.remove(self.socket_path)
+		sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		old_umask=os.umask(0o077)
+		try:
+			sock.bind(self.socket_path)
+		finally:
+			os.umask(old_umask)
+		sock.listen(16)
+		sock.settimeout(1.0)
+		try:
+			while self.running and time.time()-self.last_request<daemon_idle_timeout:
+				try:
+					(conn,addr)=sock.accept()
+				except socket.timeout:
+					continue
+				conn.settimeout(None)
+				self.last_request=time.time()
+				worker=threading.Thread(target=self.serve_connection,args=(conn,))
+				worker.daemon=True
+				worker.start()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			sock.close()
+			try:
+				os.remove(self.socket_path)
+			except OSError:
+				pass
+		return 0
+
+def run_daemon():
+	if not hasattr(__import__("socket"),"AF_UNIX"):
+		print("The build daemon is not supported on this platform", file=sys.stderr)
+		return 2
+	path=get_daemon_socket_path()
+	if path is None:
+		return 2
+	return BuildDaemon(path).serve()
+
+class JobTokenServer:
+	"""
+	Hands out the job slots of a workspace build (see run_workspace()) to
+	the panbuild processes building each of its build files, over a Unix
+	domain socket. Each process holds one slot while it runs, and borrows
+	more to build several targets at the same time: it sends "+" to ask for
+	one (and gets back "1", or "0" if none is free), and "-" to give it
+	back. Slots still borrowed when a connection is closed are freed.
+	"""
+	def __init__(self,jobs):
+		import socket
+		import tempfile
+		self.free=jobs
+		self.cond=threading.Condition()
+		self.running=True
+		self.dir=tempfile.mkdtemp(prefix="panbuild-")
+		self.path=os.path.join(self.dir,"jobs.sock")
+		self.sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		self.sock.bind(self.path)
+		self.sock.listen(16)
+		self.sock.settimeout(1.0)
+		thread=threading.Thread(target=self.serve)
+		thread.daemon=True
+		thread.start()
+
+	def acquire(self,wait=True):
+		with self.cond:
+			while self.free==0:
+				if not wait:
+					return False
+				self.cond.wait()
+			self.free-=1
+			return True
+
+	def release(self):
+		with self.cond:
+			self.free+=1
+			self.cond.notify()
+
+	def serve(self):
+		import socket
+		while self.running:
+			try:
+				(conn,addr)=self.sock.accept()
+			except socket.timeout:
+				continue
+			except (OSError,IOError):
+				break
+			conn.settimeout(None)
+			worker=threading.Thread(target=self.serve_connection,args=(conn,))
+			worker.daemon=True
+			worker.start()
+
+	def serve_connection(self,conn):
+		borrowed=0
+		try:
+			data=conn.recv(64)
+			while data:
+				for request in bytearray(data):
+					if request==ord("+"):
+						granted=self.acquire(False)
+						borrowed+=granted
+						conn.sendall(b"1" if granted else b"0")
+					elif request==ord("-") and borrowed>0:
+						borrowed-=1
+						self.release()
+				data=conn.recv(64)
+		except (OSError,IOError):
+			pass
+		finally:
+			conn.close()
+			for i in range(borrowed):
+				self.release()
+
+	def close(self):
+		import shutil
+		self.running=False
+		self.sock.close()
+		shutil.rmtree(self.dir,True)
+
+class JobTokens:
+	"""
+	Borrows job slots from the workspace build that started this process
+	(see JobTokenServer). If the workspace cannot be reached, no slot is
+	granted, so targets are built one at a time.
+	"""
+	def __init__(self,path):
+		import socket
+		## Requests come from the scheduler and from the threads of builders
+		self.lock=threading.Lock()
+		self.sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		try:
+			self.sock.connect(path)
+		except (OSError,IOError):
+			self.sock.close()
+			self.sock=None
+
+	def acquire(self):
+		if self.sock is None:
+			return False
+		with self.lock:
+			try:
+				self.sock.sendall(b"+")
+				return self.sock.recv(1)==b"1"
+			except (OSError,IOError):
+				return False
+
+	def release(self):
+		if self.sock is None:
+			return
+		with self.lock:
+			try:
+				self.sock.sendall(b"-")
+			except (OSError,IOError):
+				pass
+
+def has_build_rules(path):
+	"""Tells whether the YAML header of a Markdown file defines pandoc_targets"""
+	try:
+		with io.open(path,"r",encoding="utf-8",errors="replace") as inputfile:
+			if not re.match(r"^--*\r?\n$",inputfile.readline()):
+				return False
+			for line in inputfile:
+				if re.match(r"^(--*|\.\.*)\r?\n$",line):
+					break
+				if line.startswith("pandoc_targets:"):
+					return True
+	except (IOError,OSError):
+		pass
+	return False
+
+def find_build_files(directory,name):
+	"""
+	Returns the build files found in directory and its subdirectories, in a
+	stable order: files with the given name, and Markdown files whose YAML
+	header defines their own targets. Hidden directories are skipped.
+	"""
+	found=[]
+	for (dirpath,dirnames,filenames) in os.walk(directory):
+		dirnames[:]=sorted([dirname for dirname in dirnames if not dirname.startswith(".")])
+		for filename in sorted(filenames):
+			path=os.path.join(dirpath,filename)
+			if filename==name:
+				found.append(path)
+			elif os.path.splitext(filename)[1] in [".md",".markdown",".mdown"] and has_build_rules(path):
+				found.append(path)
+	return found
+
+## Options passed on to the panbuild processes of a workspace build
+workspace_flags=["verbose","keep_going","always_build","hash","share_ast","ast_cache","host_filters",
+	"pandoc_server","incremental_pdf","no_logs","list_targets","list_output","list_dependencies"]
+
+def get_workspace_options(args,jobs):
+	options=["--"+name.replace("_","-") for name in workspace_flags if getattr(args,name)]
+	options+=["-j",str(jobs)]
+	if args.pandoc_exe:
+		## Relative paths would be resolved from the directory of each build file
+		pandoc_exe=args.pandoc_exe
+		if os.sep in pandoc_exe or (os.altsep and os.altsep in pandoc_exe):
+			pandoc_exe=os.path.abspath(pandoc_exe)
+		options+=["-e",pandoc_exe]
+	if args.cache_dir:
+		options+=["--cache-dir",os.path.abspath(args.cache_dir)]
+	if args.cache_size:
+		options+=["--cache-size",str(args.cache_size)]
+	if args.memory:
+		options+=["--memory",str(args.memory)]
+	return options
+
+def run_workspace(args):
+	"""
+	Builds the selected targets of every build file found in the workspace
+	directory. Commands run in the directory of their build file, so each
+	build file is handled by a panbuild process of its own, and all of
+	them share a single pool of job slots. Returns 0 if all build files
+	were built successfully, or the exit code of the first failing one.
+	"""
+	from subprocess import Popen, PIPE
+	import tempfile, shutil
+	if not os.path.isdir(args.workspace):
+		print("Workspace directory %s does not exist" % args.workspace, file=sys.stderr)
+		return 2
+	build_files=find_build_files(args.workspace,os.path.basename(args.build_file))
+	if not build_files:
+		print("No build files found in %s" % args.workspace, file=sys.stderr)
+		return 2
+
+	jobs=get_default_jobs() if args.jobs is None else max(1,args.jobs)
+	env=dict(os.environ)
+	## The daemon would not share the job slots of the workspace
+	env.pop("PANBUILD_USE_DAEMON",None)
+	if hasattr(__import__("socket"),"AF_UNIX"):
+		slots=JobTokenServer(jobs)
+		env["PANBUILD_JOB_TOKENS"]=slots.path
+	else:
+		slots=threading.Semaphore(jobs)
+		jobs=1
+	cmd=get_panbuild_command()+get_workspace_options(args,jobs)
+	## Processes whose build file has none of the selected targets leave
+	## a marker file (rather than an exit status, which any command may use)
+	markers=tempfile.mkdtemp(prefix="panbuild-workspace-")
+
+	results={}
+	done=queue.Queue()
+
+	def build(idx,path):
+		marker=os.path.join(markers,str(idx))
+		options=["--ignore-missing-targets",marker] if args.targets else []
+		try:
+			proc=Popen(cmd+options+["-f",os.path.basename(path)]+args.targets,cwd=os.path.dirname(path) or ".",env=env,stdout=PIPE,stderr=PIPE)
+			(out,err)=proc.communicate()
+			results[idx]=(proc.returncode,out,err,os.path.exists(marker))
+		except OSError as inst:
+			results[idx]=(1,b"",str(inst).encode('utf-8'),False)
+		finally:
+			slots.release()
+			done.put(idx)
+
+	def launch():
+		## Each process holds a slot until it exits
+		for (idx,path) in enumerate(build_files):
+			slots.acquire()
+			worker=threading.Thread(target=build,args=(idx,path))
+			worker.daemon=True
+			worker.start()
+
+	launcher=threading.Thread(target=launch)
+	launcher.daemon=True
+	launcher.start()
+
+	status=0
+	failed=[]
+	skipped=0
+	next_report=0
+	try:
+		for i in range(len(build_files)):
+			done.get()
+			## Output is shown in the order build files were found
+			while next_report in results:
+				(exitcode,out,err,no_targets)=results.pop(next_report)
+				path=os.path.relpath(build_files[next_report])
+				next_report+=1
+				## Build files without the requested targets are skipped quietly
+				if no_targets:
+					skipped+=1
+					continue
+				print("== %s" % path)
+				sys.stdout.write(decode_output(out))
+				sys.stdout.flush()
+				sys.stderr.write(decode_output(err))
+				sys.stderr.flush()
+				if exitcode!=0:
+					failed.append(path)
+					status=status or exitcode
+	finally:
+		if isinstance(slots,JobTokenServer):
+			slots.close()
+		shutil.rmtree(markers,ignore_errors=True)
+
+	if skipped==len(build_files):
+		print("No build file in %s has targets matching %s" % (args.workspace,", ".join(args.targets)), file=sys.stderr)
+		return 3
+	summary="%d build file(s): %d succeeded, %d failed" % (len(build_files)-skipped,len(build_files)-skipped-len(failed),len(failed))
+	if skipped:
+		summary+=", %d without matching targets" % skipped
+	print(summary)
+	for path in failed:
+		print("  Failed: %s" % path)
+	return status
+
 def main():
 	## Prepare parser
 	parser = argparse.ArgumentParser(description='Panbuild, a YAML-based builder for Pandoc')
 	parser.add_argument("-f","--build-file",default="build.yaml",help='Indicates which file contains the build rules. If omitted, panbuild searches for rules in "build.yaml"')
 	parser.add_argument("-L","--list-targets",action='store_true',help="List targets found in build file")
 	parser.add_argument("-o","--list-output",action='store_true',help="List the name of the output file for each target")
+	parser.add_argument("--list-dependencies",action='store_true',help="List the files each target depends on, including images, templates and other files referenced from options and input files")
 	parser.add_argument("-v","--verbose",action='store_true',help="Enable verbose mode")
 	parser.add_argument("-e","--pandoc-exe",help="Used to point to pandoc executable. It will be used instead of the pandoc command in the PATH")
 	parser.add_argument("-S","--sample-build-file",help="Print a sample build file for the pandoc options passed as a parameter. Format PANDOC_OPTIONS ::= '[list-input-files] REST_OF_OPTIONS' ", metavar="PANDOC_OPTIONS")	
@@ -842,10 +4515,46 @@ def main():
 	parser.add_argument("-a","--append-target",help="Add a new target (with options passed as a parameters) to a existing build file. Note: input files will be ignored when including options")	
 	parser.add_argument("-r","--remove-target",help="Remove target from existing build file.")		
 	parser.add_argument("-D","--dual-mode",action='store_true',help="Dual markdown mode")
+	parser.add_argument("-j","--jobs",type=int,default=None,help="Number of targets to build in parallel (default: number of CPUs)")
+	parser.add_argument("-k","--keep-going",action='store_true',help="Keep building the remaining targets after a target fails")
+	parser.add_argument("-B","--always-build",action='store_true',help="Build selected targets even if they are up to date")
+	parser.add_argument("--hash",action='store_true',help="Compare the contents of input files rather than their timestamps to find out whether targets are up to date")
+	parser.add_argument("--share-ast",action='store_true',help="Read the input files only once for all targets that share them (along with reader options and filters), and run only the writer stage of pandoc for each target")
+	parser.add_argument("--ast-cache",action='store_true',help="Like --share-ast, but the AST of the input files is cached across builds, so that they are only read again when they change")
+	parser.add_argument("--history",metavar="TARGET",help="Show the duration, status and output size of the recent builds of a target (or of the targets matched by a pattern), along with the trend of its build time")
+	parser.add_argument("-w","--watch",action='store_true',help="Keep running after building the selected targets, and rebuild those affected by changes in their input files, their dependencies or the build file")
+	parser.add_argument("--daemon",action='store_true',help="Run as a build daemon serving requests from panbuild clients (see --use-daemon) over a local socket")
+	parser.add_argument("--use-daemon",action='store_true',default=bool(os.environ.get("PANBUILD_USE_DAEMON")),help="Forward list, build and clean requests to the build daemon, starting it if necessary (default if $PANBUILD_USE_DAEMON is set)")
+	parser.add_argument("--host-filters",action='store_true',help="Run Python filters on warm worker processes owned by panbuild, rather than starting a new interpreter for each filter and target (implies running pandoc's reader and writer stages separately)")
+	parser.add_argument("--filter-server",action='store_true',help=argparse.SUPPRESS)
+	parser.add_argument("--ignore-missing-targets",metavar="MARKER",help=argparse.SUPPRESS)
+	parser.add_argument("--profile",action='store_true',help="Measure the time spent in each build phase, target and filter. A summary is printed at exit, and a trace (in Chrome's trace event format) is written to the file given by --trace-file")
+	parser.add_argument("--trace-file",default="panbuild-trace.json",help="File where the trace is written when profiling (default: panbuild-trace.json)")
+	parser.add_argument("--cache-dir",default=os.environ.get("PANBUILD_CACHE_DIR"),help="Directory where the outputs of targets are cached and reused across builds (default: $PANBUILD_CACHE_DIR, if set). Use 'panbuild cache stats' or 'panbuild cache prune' to inspect or shrink the cache")
+	parser.add_argument("--cache-size",default=os.environ.get("PANBUILD_CACHE_SIZE"),help="Maximum size of the output cache, such as 500M or 2G (default: %s)" % OutputCache.default_size)
+	parser.add_argument("--pandoc-server",action='store_true',default=bool(os.environ.get("PANBUILD_PANDOC_SERVER")),help="Build the targets that pandoc-server supports (text inputs and outputs, without filters or PDF output) by sending requests to a single 'pandoc server' process, rather than starting pandoc for each of them (default if $PANBUILD_PANDOC_SERVER is set)")
+	parser.add_argument("--incremental-pdf",action='store_true',default=bool(os.environ.get("PANBUILD_INCREMENTAL_PDF")),help="Build PDF files through LaTeX in two steps, keeping the .tex file and the auxiliary files of the PDF engine of each target, so that the engine is run fewer times, or not at all if the .tex file did not change (default if $PANBUILD_INCREMENTAL_PDF is set)")
+	parser.add_argument("--no-logs",action='store_true',default=bool(os.environ.get("PANBUILD_NO_LOGS")),help="Do not write the output of commands to a log file per target (in .panbuild/<build file>.logs), keeping it in memory instead. Warnings are then only shown once each target is built (default if $PANBUILD_NO_LOGS is set)")
+	parser.add_argument("--memory",default=os.environ.get("PANBUILD_MEMORY"),help="Memory available to parallel builds, such as 4G (default: $PANBUILD_MEMORY, if set). Targets are not started while the memory expected to be used by those being built (1G for PDF outputs, less for other formats, or the memory attribute of targets) would exceed it")
+	parser.add_argument("--workspace",metavar="DIR",help="Build the selected targets (or all targets) of every build file found in DIR and its subdirectories: files named like the build file (see -f) and Markdown files whose YAML header defines pandoc_targets. Build files are built at the same time, sharing the jobs given by -j")
 	parser.add_argument('targets', metavar='TARGETS',nargs='*', help='a target name (must be defined in the build file)')	
 	args=parser.parse_args(sys.argv[1:])
 
 
+	if args.filter_server:
+		serve_filters()
+		sys.exit(0)
+
+	if args.memory:
+		try:
+			args.memory=parse_size(args.memory)
+		except ValueError as inst:
+			print(inst, file=sys.stderr)
+			sys.exit(2)
+
+	if args.profile:
+		enable_profiling(args.trace_file)
+
 	## Generate sample
 	if args.sample_build_file:
 		if len(args.targets)==0:
@@ -854,7 +4563,28 @@ def main():
 			print_sample_build_yaml(args.sample_build_file,args.use_yaml_options,args.build_file,args.targets[0],dual=args.dual_mode)
 		sys.exit(0)
 
-	ret=parse_file(args.build_file,args.pandoc_exe)
+	## Built-in cache command
+	if len(args.targets)>0 and args.targets[0]=="cache":
+		sys.exit(run_cache_command(args))
+
+	if args.daemon:
+		sys.exit(run_daemon())
+
+	if args.workspace:
+		if args.watch or args.append_target or args.remove_target or args.history:
+			print("--workspace cannot be used with --watch, --append-target, --remove-target or --history", file=sys.stderr)
+			sys.exit(2)
+		sys.exit(run_workspace(args))
+
+	## Forward the request to the build daemon, if possible
+	if args.use_daemon and not (args.append_target or args.remove_target or args.list_dependencies or args.history or args.watch):
+		ret=run_daemon_client(args)
+		if ret is not None:
+			sys.exit(ret)
+
+	sources=[]
+	with profile("parse_file"):
+		ret=load_build_file(args.build_file,args.pandoc_exe,sources)
 
 	if not ret:
 		sys.exit(2)
@@ -881,60 +4611,56 @@ def main():
 		remove_target_from_build_file(args.build_file,args.remove_target,yaml_data,targets)
 		sys.exit(0)
 		
-	## Print targets
-	if args.list_targets or args.list_output:
+	## Print dependency manifest of each target
+	if args.list_dependencies:
+		state=BuildState(args.build_file)
+		failed=materialize_targets(targets)
 		for target in targets:
-			for i,item in enumerate(target.pandoc_command):
-				if type(item) not in [unicode,str]:
-					print(item,type(item))
-					target.pandoc_command[i]=str(item)
-			if args.verbose:
-				print(target.subname+": "+' '.join(target.pandoc_command))
-			elif args.list_output:
-				print(target.subname+": "+target.outfile)
-			else:
-				print(target.subname)
+			if target not in failed:
+				print(target.subname+": "+' '.join(state.get_inputs(target)))
+		state.save()
+		sys.exit(2 if failed else 0)
+
+	## Report the build times of targets
+	if args.history:
+		matches=match_targets(targets,get_target_index(targets),args.history)
+		if not matches:
+			print("Target '%s' does not exist in build file" % args.history, file=sys.stderr)
+			sys.exit(3)
+		history=BuildHistory(args.build_file)
+		for target in matches:
+			history.print_report(target.subname)
 		sys.exit(0)
 
+	## Print targets
+	if args.list_targets or args.list_output:
+		sys.exit(print_target_list(targets,args.verbose,args.list_output))
+
 	## Built-in clean target
 	if "clean" in args.targets:
-		for target in targets:
-			if target.outfile:
-				try:
-					os.remove(target.outfile)
-					print("Removing file",target.outfile)
-				except OSError:
-					pass
-		sys.exit(0)
+		sys.exit(clean_targets(targets))
 
 	## Check if user-provided targets are valid
-	selected_targets=[]
-
-	if len(args.targets)==0:
-		selected_targets=targets
-	else:
-		for target_name in args.targets:
-			res=list(filter(lambda x: x.subname == target_name, targets))	
-			if not res or res==[]:
-				print("Target '%s' does not exist in build file" % target_name, file=sys.stderr)
-				sys.exit(3)
-			else:
-				selected_targets.append(res[0])
+	selected_targets=select_targets(targets,args.targets,bool(args.ignore_missing_targets))
+	if selected_targets is None:
+		sys.exit(3)
+	if not selected_targets and args.targets:
+		## Tell the workspace build that this build file was skipped
+		open(args.ignore_missing_targets,"w").close()
+		sys.exit(0)
 
 	## Invoke pandoc for selected targets
-	for target in selected_targets:
-		if args.verbose:
-			print("Building target %s" % target.subname)
-			print("Command:",' '.join(map(str,target.pandoc_command)))
-		else:
-			print("Building target %s ..." % target.subname,end="")
-			sys.stdout.flush()
-		errcode=run_pandoc(target.pandoc_command,False,args.verbose)
-		if errcode==0:
-			print("Success")
-		else:
-			print("Failed")
-	sys.exit(0)
+	try:
+		session=BuildSession(args)
+	except ValueError as inst:
+		print(inst, file=sys.stderr)
+		sys.exit(2)
+
+	status=session.build(selected_targets)
+
+	if args.watch:
+		watch_and_build(session,targets,selected_targets,sources)
+	sys.exit(status)
 
 
 		
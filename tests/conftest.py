@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+panbuild_script = os.path.join(os.path.dirname(here), "panbuild.py")
+fake_pandoc = os.path.join(here, "fake_pandoc.py")
+
+
+class Project:
+    def __init__(self, path):
+        self.path = path
+        self.log = os.path.join(str(path), "pandoc.log")
+
+    def write(self, name, content):
+        full = os.path.join(str(self.path), name)
+        with open(full, "w") as f:
+            f.write(content)
+        return full
+
+    def read(self, name):
+        with open(os.path.join(str(self.path), name)) as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(str(self.path), name))
+
+    def invocations(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def panbuild(self, *args):
+        env = dict(os.environ, FAKE_PANDOC_LOG=self.log)
+        cmd = [sys.executable, panbuild_script, "-e", fake_pandoc] + list(args)
+        return subprocess.run(cmd, cwd=str(self.path), env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+
+@pytest.fixture
+def project(tmp_path):
+    return Project(tmp_path)
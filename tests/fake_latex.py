@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# A minimal stand-in for pdflatex used by the test suite. The "PDF" is a
+# copy of the .tex file, and the .aux file lists its section headings, so
+# a second run is needed whenever they change (as with a table of
+# contents). A .tex file containing "\fail" makes it fail like LaTeX does.
+# Every invocation is appended to the file named by $FAKE_PANDOC_LOG.
+from __future__ import print_function
+import os
+import sys
+
+
+def main(argv):
+    out_dir = "."
+    for arg in argv:
+        if arg.startswith("-output-directory="):
+            out_dir = arg.split("=", 1)[1]
+    tex_file = argv[-1]
+    base = os.path.join(out_dir, os.path.splitext(os.path.basename(tex_file))[0])
+
+    log = os.environ.get("FAKE_PANDOC_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write("engine %s\n" % os.path.basename(tex_file))
+
+    with open(tex_file) as f:
+        tex = f.read()
+    if "\\fail" in tex:
+        print("! Undefined control sequence.")
+        return 1
+
+    previous = None
+    if os.path.exists(base + ".aux"):
+        with open(base + ".aux") as f:
+            previous = f.read()
+    headings = "".join(line + "\n" for line in tex.splitlines() if line.startswith("#"))
+    with open(base + ".pdf", "w") as f:
+        f.write(tex)
+    with open(base + ".aux", "w") as f:
+        f.write(headings)
+    with open(base + ".log", "w") as f:
+        if previous is not None and previous != headings:
+            f.write("LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
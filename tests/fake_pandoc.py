@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# A minimal stand-in for the pandoc executable used by the test suite.
+# Documents are represented like pandoc's JSON AST, with one string per
+# input file as "blocks" and -M values in "meta". JSON filters (-F) receive
+# and return that representation, and writers other than json output the
+# blocks followed by a "to=FORMAT" line.
+# A couple of metadata switches simulate slow or failing commands:
+#   -M sleep=SECONDS   wait before writing the output
+#   -M fail            exit with an error
+#   -M warn=TEXT       print "[WARNING] TEXT" to stderr
+#   -M noise=LINES     print that many lines to stderr
+#   -M touch=PATH      create an empty file
+#   -M wait_for=PATH   wait (up to 10 seconds) until the file exists, or fail
+# Note that panbuild splits "key=value" option strings, so the sleep switch
+# must be given through the metadata attribute of a target.
+# Every invocation is appended to the file named by $FAKE_PANDOC_LOG.
+# With $FAKE_PANDOC_HEADERS set, lines starting with "#" are read as Header
+# blocks, which writers number (with -N and --number-offset) and show with
+# their identifier if it is not the one derived from their text. Lines
+# like "$x$" are read as math, and lines starting with "```LANG " as code
+# blocks; standalone outputs start with "<math-script>" and "<highlight-css>"
+# lines if the document has math or code with a language (as pandoc's
+# templates do).
+# `fake_pandoc.py server --port PORT` runs a minimal pandoc-server, which
+# logs each request as "server-request FROM TO". Metadata `drop=ID` makes it
+# close the connection without replying to the first request with that ID.
+from __future__ import print_function
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+with_value = set(["o", "t", "f", "F", "V", "M", "c", "H", "B", "A", "L"])
+
+
+def auto_id(title):
+    return title.lower().replace(" ", "-")
+
+
+def read_blocks(text):
+    if not os.environ.get("FAKE_PANDOC_HEADERS"):
+        return [text]
+    blocks = []
+    for line in text.splitlines(True):
+        if line.startswith("$") and line.rstrip().endswith("$"):
+            blocks.append({"t": "Para", "c": [{"t": "Math", "c": [{"t": "InlineMath"}, line.strip()[1:-1]]}]})
+        elif line.startswith("```"):
+            (lang, _, code) = line[3:].partition(" ")
+            blocks.append({"t": "CodeBlock", "c": [["", [lang] if lang else [], []], code.rstrip("\n")]})
+        elif line.startswith("#"):
+            level = len(line) - len(line.lstrip("#"))
+            title = line[level:].strip()
+            blocks.append({"t": "Header", "c": [level, [auto_id(title), [], []],
+                                                [{"t": "Str", "c": title}]]})
+        elif blocks and not isinstance(blocks[-1], dict):
+            blocks[-1] += line
+        else:
+            blocks.append(line)
+    return blocks
+
+
+def write_blocks(blocks, options):
+    counter = int(options.get("number-offset", ["0"])[0])
+    parts = []
+    for block in blocks:
+        if not isinstance(block, dict):
+            parts.append(block)
+        elif block["t"] == "Para":
+            parts.append("".join("$%s$" % inline["c"][1] for inline in block["c"] if inline["t"] == "Math") + "\n")
+        elif block["t"] == "CodeBlock":
+            parts.append("<code>%s</code>\n" % block["c"][1])
+        elif block["t"] == "RawBlock":
+            parts.append(block["c"][1] + "\n")
+        elif block["t"] == "Header":
+            level, attr, inlines = block["c"]
+            title = "".join(inline["c"] for inline in inlines)
+            number = ""
+            if "N" in options and level == 1:
+                counter += 1
+                number = "%d " % counter
+            suffix = " {#%s}" % attr[0] if attr[0] != auto_id(title) else ""
+            parts.append("#" * level + " " + number + title + suffix + "\n")
+    if "s" in options or "standalone" in options:
+        text = json.dumps(blocks)
+        if '"Math"' in text:
+            parts.insert(0, "<math-script>\n")
+        if re.search(r'"CodeBlock", "c": \[\["[^"]*", \["', text):
+            parts.insert(0, "<highlight-css>\n")
+    return "".join(parts)
+
+
+def serve(port):
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    dropped = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length"))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            log = os.environ.get("FAKE_PANDOC_LOG")
+            if log:
+                with open(log, "a") as f:
+                    f.write("server-request %s %s\n" % (request.get("from"), request.get("to")))
+            metadata = request.get("metadata", {})
+            if "drop" in metadata and metadata["drop"] not in dropped:
+                dropped.add(metadata["drop"])
+                self.close_connection = True
+                return
+            if "fail" in metadata:
+                self.reply(500, b"fake pandoc failure")
+                return
+            messages = []
+            if "warn" in metadata:
+                messages.append({"verbosity": "WARNING", "message": metadata["warn"]})
+            output = request["text"] + "to=%s" % request["to"]
+            self.reply(200, json.dumps({"output": output, "base64": False,
+                                        "messages": messages}).encode("utf-8"))
+
+        def reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    Server(("127.0.0.1", port), Handler).serve_forever()
+
+
+def main(argv):
+    if "--version" in argv:
+        print("pandoc 0.0-fake")
+        return 0
+
+    if argv[:1] == ["server"]:
+        log = os.environ.get("FAKE_PANDOC_LOG")
+        if log:
+            with open(log, "a") as f:
+                f.write(" ".join(argv) + "\n")
+        serve(int(argv[argv.index("--port") + 1]))
+        return 0
+
+    options = {}
+    inputs = []
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--"):
+            key, _, val = arg[2:].partition("=")
+            options.setdefault(key, []).append(val)
+        elif arg.startswith("-") and len(arg) == 2:
+            val = args.pop(0) if arg[1] in with_value and args else ""
+            options.setdefault(arg[1], []).append(val)
+        else:
+            inputs.append(arg)
+
+    log = os.environ.get("FAKE_PANDOC_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(" ".join(argv) + "\n")
+
+    out = options.get("o", [None])[0]
+    fmt = options.get("t", [None])[0]
+    if fmt is None:
+        fmt = "latex" if out and out.endswith(".pdf") else "pdf"
+
+    if options.get("f", [None])[0] == "json":
+        with open(inputs[0]) as f:
+            doc = json.load(f)
+    else:
+        doc = {"pandoc-api-version": [1, 23], "meta": {},
+               "blocks": [block for name in inputs for block in read_blocks(open(name).read())]}
+
+    for item in options.get("M", []):
+        key, _, val = item.partition("=")
+        if key == "sleep":
+            time.sleep(float(val))
+        elif key == "fail":
+            print("fake pandoc failure", file=sys.stderr)
+            return 3
+        elif key == "warn":
+            print("[WARNING] %s" % val, file=sys.stderr)
+        elif key == "touch":
+            open(val, "w").close()
+        elif key == "wait_for":
+            deadline = time.time() + 10
+            while not os.path.exists(val):
+                if time.time() > deadline:
+                    print("fake pandoc timeout waiting for %s" % val, file=sys.stderr)
+                    return 4
+                time.sleep(0.02)
+        elif key == "noise":
+            for i in range(int(val)):
+                print("noise line %d %s" % (i, "x" * 60), file=sys.stderr)
+        else:
+            doc["meta"][key] = val
+
+    for name in options.get("F", []):
+        proc = subprocess.Popen([sys.executable, name, fmt],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        data = proc.communicate(json.dumps(doc).encode("utf-8"))[0]
+        doc = json.loads(data.decode("utf-8"))
+
+    if fmt == "json":
+        text = json.dumps(doc)
+    else:
+        text = write_blocks(doc["blocks"], options) + "to=%s\n" % fmt
+    if out is None or out == "-":
+        sys.stdout.write(text)
+    else:
+        with open(out, "w") as f:
+            f.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
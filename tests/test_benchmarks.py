@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+bench_script = os.path.join(os.path.dirname(here), "benchmarks", "bench_panbuild.py")
+
+
+def test_benchmarks_compare_against_baseline(tmp_path):
+    baseline = str(tmp_path / "baseline.json")
+    cmd = [sys.executable, bench_script, "--quick", "--repeat", "1", "--baseline", baseline,
+           "--startup-budget", "10000"]
+
+    ret = subprocess.run(cmd + ["--save-baseline"], capture_output=True, universal_newlines=True)
+    assert ret.returncode == 0, ret.stderr
+    assert "many_targets/parse_pandoc_options" in ret.stdout
+    assert os.path.exists(baseline)
+
+    # A generous threshold keeps timing noise from failing the test
+    ret = subprocess.run(cmd + ["--threshold", "100"], capture_output=True, universal_newlines=True)
+    assert ret.returncode == 0, ret.stderr
+    assert "end_to_end/build" in ret.stdout
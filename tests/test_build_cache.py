@@ -0,0 +1,41 @@
+import os
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+"""
+
+
+def test_compiled_build_file_is_reused_until_sources_change(project):
+    project.write("build.yaml", BUILD_FILE)
+    assert project.panbuild("-L").stdout == "HTML\n"
+    assert project.exists(".panbuild/build.yaml.compiled")
+
+    ret = project.panbuild("-o", "--profile", "--trace-file", "trace.json")
+    assert ret.stdout == "HTML: book.html\n"
+    assert "load_compiled" in ret.stderr
+    assert "parse_target" not in ret.stderr
+
+    # Same size and a new timestamp: detected by the contents hash
+    path = project.write("build.yaml", BUILD_FILE.replace("HTML", "EPUB").replace("html", "epub"))
+    os.utime(path, (1, 1))
+    assert project.panbuild("-o").stdout == "EPUB: book.epub\n"
+
+    # The command line is part of the key
+    assert project.panbuild("-L", "-v").stdout.startswith("EPUB: ")
+    ret = project.panbuild("-L", "-v", "-e", "other-pandoc")
+    assert ret.stdout.startswith("EPUB: other-pandoc ")
+
+
+def test_compiled_build_file_tracks_panbuild_file(project):
+    project.write("doc.md", "---\npanbuild_file: rules.yaml\n---\n# Title\n")
+    project.write("rules.yaml", BUILD_FILE)
+    assert project.panbuild("-f", "doc.md", "-L").stdout == "HTML\n"
+
+    project.write("rules.yaml", BUILD_FILE + "  TXT:\n    options: -t plain\n")
+    assert project.panbuild("-f", "doc.md", "-L").stdout == "HTML\nTXT\n"
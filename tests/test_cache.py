@@ -0,0 +1,53 @@
+import os
+import shutil
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+"""
+
+
+def test_outputs_are_reused_from_cache(project, tmp_path_factory):
+    cache_dir = str(tmp_path_factory.mktemp("cache"))
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild("--cache-dir", cache_dir).returncode == 0
+    assert len(project.invocations()) == 2
+
+    os.remove(os.path.join(str(project.path), "book.html"))
+    shutil.rmtree(os.path.join(str(project.path), ".panbuild"))
+    ret = project.panbuild("--cache-dir", cache_dir, "-j", "1")
+    assert ret.stdout.splitlines() == [
+        "Building target HTML ...Success (cached)",
+        "Building target TXT ...Success (cached)",
+    ]
+    assert len(project.invocations()) == 2
+    assert project.read("book.html") == "# One\nto=html\n"
+
+    project.write("chapter1.md", "# One, revised\n")
+    project.panbuild("--cache-dir", cache_dir, "HTML")
+    assert len(project.invocations()) == 3
+    assert project.read("book.html") == "# One, revised\nto=html\n"
+
+
+def test_cache_stats_and_prune(project, tmp_path_factory):
+    cache_dir = str(tmp_path_factory.mktemp("cache"))
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+    project.panbuild("--cache-dir", cache_dir)
+
+    ret = project.panbuild("--cache-dir", cache_dir, "cache", "stats")
+    assert "Entries: 2" in ret.stdout
+
+    ret = project.panbuild("--cache-dir", cache_dir, "--cache-size", "0", "cache", "prune")
+    assert ret.stdout == "Removed 2 entries (29 B)\n"
+    ret = project.panbuild("--cache-dir", cache_dir, "cache", "stats")
+    assert "Entries: 0" in ret.stdout
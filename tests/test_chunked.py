@@ -0,0 +1,151 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - c1.md
+  - c2.md
+  - c3.md
+  chunked: true
+pandoc_targets:
+  BOOK:
+    options: -t html -s -N --toc -o book.html
+  DOC:
+    options: -t docx -o book.docx
+"""
+
+
+def test_chunked_rendering(project, monkeypatch):
+    monkeypatch.setenv("FAKE_PANDOC_HEADERS", "1")
+    project.write("c1.md", "# Intro\nText one\n")
+    project.write("c2.md", "# Intro\nText two\n## Details\n")
+    project.write("c3.md", "# End\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2")
+    assert ret.returncode == 0
+    invocations = project.invocations()
+    assert len([line for line in invocations if line.startswith("-t json")]) == 3
+    assert len([line for line in invocations if "--number-offset=1" in line]) == 1
+    assert len([line for line in invocations if "--number-offset=2" in line]) == 1
+    # Formats that cannot be joined are built as usual
+    assert len([line for line in invocations if "book.docx" in line]) == 1
+
+    # Sections are numbered across files, and identifiers are unique
+    assert project.read("book.html") == (
+        "# 1 Intro\nText one\nto=html\n"
+        "# 2 Intro {#intro-1}\nText two\n## Details\nto=html\n"
+        "# 3 End\nto=html\nto=html\n")
+
+    # Only the modified file is read and rendered again
+    count = len(project.invocations())
+    project.write("c3.md", "# End\nMore text\n")
+    assert project.panbuild("BOOK").returncode == 0
+    assert len(project.invocations()) == count + 2
+    assert project.read("book.html").endswith("# 3 End\nMore text\nto=html\nto=html\n")
+
+    # New sections change the numbers of the files that follow
+    count = len(project.invocations())
+    project.write("c1.md", "# Intro\n# Extra\nText one\n")
+    assert project.panbuild("BOOK").returncode == 0
+    new = project.invocations()[count:]
+    assert len([line for line in new if line.startswith("-t json")]) == 1
+    assert len([line for line in new if line.startswith("-f json")]) == 4
+    assert "# 4 End\nMore text\n" in project.read("book.html")
+
+
+
+def test_chunked_page_keeps_math_and_highlighting(project, monkeypatch):
+    monkeypatch.setenv("FAKE_PANDOC_HEADERS", "1")
+    project.write("c1.md", "# Intro\n$E=mc^2$\n")
+    project.write("c2.md", "# Code\n```\nplain\n")
+    project.write("c3.md", "# End\n```python x = 1\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild("BOOK").returncode == 0
+    book = project.read("book.html")
+    # The template adds the scripts and styles that the page needs
+    assert book.startswith("<highlight-css>\n<math-script>\n")
+    assert book.count("$E=mc^2$") == 1
+    assert book.count("<code>x = 1</code>") == 1
+
+
+def test_chunks_are_rendered_again_when_filters_change_or_forced(project):
+    project.write("c1.md", "One\n")
+    project.write("c2.md", "Two\n")
+    project.write("tag.py", "import json, sys\ndoc = json.load(sys.stdin)\ndoc['blocks'].append('v1')\njson.dump(doc, sys.stdout)\n")
+    project.write("build.yaml", """
+pandoc_common:
+  input_files:
+  - c1.md
+  - c2.md
+  chunked: true
+  filters:
+  - tag.py
+pandoc_targets:
+  HTML:
+    options: -t html -o book.html
+""")
+
+    assert project.panbuild().returncode == 0
+    assert project.read("book.html") == "One\nv1to=html\nTwo\nv1to=html\n"
+
+    # The filter is part of the key of every chunk
+    project.write("tag.py", project.read("tag.py").replace("v1", "v2"))
+    assert project.panbuild().returncode == 0
+    assert project.read("book.html") == "One\nv2to=html\nTwo\nv2to=html\n"
+
+    # Forced builds do not reuse chunks
+    count = len(project.invocations())
+    assert project.panbuild("-B").returncode == 0
+    assert len(project.invocations()) == count + 4
+
+
+NOTES = """<section id="footnotes" class="footnotes footnotes-end-of-document"
+role="doc-endnotes">
+<hr />
+<ol>
+%s</ol>
+</section>
+"""
+
+
+def fragment(text, notes):
+    refs = "".join('<a href="#fn%d" class="footnote-ref" id="fnref%d"\nrole="doc-noteref"><sup>%d</sup></a>'
+                   % (i, i, i) for i in range(1, notes + 1))
+    items = "".join('<li id="fn%d"><p>%s %d<a href="#fnref%d" class="footnote-back"\nrole="doc-backlink">^</a></p></li>\n'
+                    % (i, text, i, i) for i in range(1, notes + 1))
+    return "<p>%s%s</p>\n" % (text, refs) + (NOTES % items if notes else "")
+
+
+def test_footnotes_are_renumbered_across_fragments():
+    import panbuild
+    builder = panbuild.ChunkedBuilder("build.yaml")
+    joined = builder.join_fragments([fragment("A", 2), fragment("B", 0), fragment("C", 1)])
+    expected = fragment("A", 2).split("<section")[0] + fragment("B", 0)
+    expected += '<p>C<a href="#fn3" class="footnote-ref" id="fnref3"\nrole="doc-noteref"><sup>3</sup></a></p>\n'
+    items = fragment("A", 2).split("<ol>\n")[1].split("</ol>")[0]
+    items += '<li id="fn3"><p>C 1<a href="#fnref3" class="footnote-back"\nrole="doc-backlink">^</a></p></li>\n'
+    assert joined == expected + NOTES % items
+
+
+def test_errors_in_workers_fail_the_chunk():
+    import panbuild
+    builder = panbuild.ChunkedBuilder("build.yaml", 2)
+
+    def render(item):
+        if item == "bad":
+            raise ValueError("broken chunk")
+        return (0, None, None)
+    results = builder.run_parallel(render, ["good", "bad"])
+    assert results == [(0, None, None), (-1, None, b"broken chunk\n")]
+
+
+def test_chunked_takes_precedence_over_shared_ast(project, monkeypatch):
+    monkeypatch.setenv("FAKE_PANDOC_HEADERS", "1")
+    project.write("c1.md", "# Intro\n")
+    project.write("c2.md", "# Middle\n")
+    project.write("c3.md", "# End\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild("--ast-cache", "BOOK").returncode == 0
+    assert "# 3 End\n" in project.read("book.html")
+    assert len([line for line in project.invocations() if "--number-offset=2" in line]) == 1
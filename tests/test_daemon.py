@@ -0,0 +1,122 @@
+import json
+import os
+import socket
+import time
+
+import pytest
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+"""
+
+
+def shutdown(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({"command": "shutdown"}).encode("utf-8") + b"\n")
+        sock.recv(1024)
+    finally:
+        sock.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+def test_client_starts_and_uses_daemon(project, monkeypatch):
+    socket_path = os.path.join(str(project.path), "daemon.sock")
+    monkeypatch.setenv("PANBUILD_SOCKET", socket_path)
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    try:
+        ret = project.panbuild("--use-daemon", "-o")
+        assert ret.returncode == 0
+        assert ret.stdout == "HTML: book.html\nTXT: book.txt\n"
+        assert os.path.exists(socket_path)
+
+        ret = project.panbuild("--use-daemon", "TXT")
+        assert ret.stdout == "Building target TXT ...Success\n"
+        assert project.read("book.txt") == "# One\nto=plain\n"
+
+        # Changes to the build file are noticed by the daemon
+        time.sleep(0.01)
+        project.write("build.yaml", BUILD_FILE.replace("  TXT:", "  TEXT:"))
+        ret = project.panbuild("--use-daemon", "-L")
+        assert ret.stdout == "HTML\nTEXT\n"
+
+        ret = project.panbuild("--use-daemon", "MISSING")
+        assert ret.returncode == 3
+        assert "Target 'MISSING' does not exist" in ret.stderr
+    finally:
+        if os.path.exists(socket_path):
+            shutdown(socket_path)
+
+
+SELF_CONTAINED = """---
+pandoc_targets:
+  HTML:
+    options: -t html
+---
+# Notes
+"""
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+def test_daemon_uses_build_file_path_as_given(project, monkeypatch):
+    socket_path = os.path.join(str(project.path), "daemon.sock")
+    monkeypatch.setenv("PANBUILD_SOCKET", socket_path)
+    project.write("notes.md", SELF_CONTAINED)
+
+    try:
+        local = project.panbuild("-f", "notes.md", "-o")
+        ret = project.panbuild("--use-daemon", "-f", "notes.md", "-o")
+        assert ret.returncode == 0
+        assert ret.stdout == local.stdout
+        assert str(project.path) not in ret.stdout
+    finally:
+        if os.path.exists(socket_path):
+            shutdown(socket_path)
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="requires Unix permissions")
+def test_socket_lives_in_a_private_directory(tmpdir, monkeypatch):
+    import tempfile
+    import panbuild
+    monkeypatch.delenv("PANBUILD_SOCKET", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+
+    path = panbuild.get_daemon_socket_path()
+    directory = os.path.dirname(path)
+    assert directory == os.path.join(str(tmpdir), "panbuild-%d" % os.getuid())
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    # Directories that other users can access are not used
+    os.chmod(directory, 0o777)
+    assert panbuild.get_daemon_socket_path() is None
+
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmpdir))
+    assert panbuild.get_daemon_socket_path() == os.path.join(str(tmpdir), "panbuild.sock")
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+def test_daemon_sends_verbose_output(project, monkeypatch):
+    socket_path = os.path.join(str(project.path), "daemon.sock")
+    monkeypatch.setenv("PANBUILD_SOCKET", socket_path)
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE.replace("    options: -t plain\n", "    options: -t plain\n    metadata:\n      warn: careful\n"))
+
+    try:
+        ret = project.panbuild("--use-daemon", "-v", "TXT")
+        assert ret.returncode == 0
+        assert "[WARNING] careful" in ret.stderr
+    finally:
+        if os.path.exists(socket_path):
+            shutdown(socket_path)
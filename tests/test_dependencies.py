@@ -0,0 +1,85 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  DOCX:
+    options: -t docx -o report.docx
+    depends_on: FIGURES
+  FIGURES:
+    options: -t html -o figures.html
+    metadata:
+      sleep: 0.3
+  TXT:
+    options: -t plain -o notes.txt
+"""
+
+
+def test_targets_run_after_their_dependencies(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    # Selecting a target also builds the targets it depends on, first
+    ret = project.panbuild("-j", "4", "DOCX")
+    assert ret.returncode == 0, ret.stderr
+    assert ret.stdout.splitlines() == ["Building target FIGURES ...Success",
+                                       "Building target DOCX ...Success"]
+    outputs = [line.split(" -o ")[1].split()[0] for line in project.invocations()]
+    assert outputs.index("figures.html") < outputs.index("report.docx")
+
+    # Rebuilding a dependency makes its dependents out of date
+    assert "Up to date" in project.panbuild("DOCX").stdout.splitlines()[1]
+    project.panbuild("-B", "FIGURES")
+    assert project.panbuild("DOCX").stdout.splitlines()[1] == "Building target DOCX ...Success"
+
+
+def test_failed_dependency_and_cycles(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE.replace("sleep: 0.3", "fail: true"))
+
+    ret = project.panbuild("-k")
+    assert ret.returncode != 0
+    assert "Building target TXT ...Success" in ret.stdout
+    assert "Building target DOCX ...Failed" in ret.stdout
+    assert "Not built because FIGURES failed" in ret.stderr
+
+    project.write("build.yaml", BUILD_FILE.replace("    metadata:\n", "    depends_on: DOCX\n    metadata:\n"))
+    ret = project.panbuild("-L")
+    assert ret.returncode == 2
+    assert "circular dependency between targets: DOCX -> FIGURES -> DOCX" in ret.stderr
+
+
+def test_failure_reported_while_dependents_wait(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  A:
+    options: -t html -o a.html
+    metadata:
+      sleep: 0.5
+  B:
+    options: -t docx -o b.docx
+    depends_on: A
+  C:
+    options: -t plain -o c.txt
+    metadata:
+      fail: true
+  D:
+    options: -t rst -o d.rst
+""")
+    ret = project.panbuild("-j", "4")
+    assert ret.returncode == 3
+    assert "Building target C ...Failed" in ret.stdout
+    assert "Building target D ...Success" in ret.stdout
+    assert "fake pandoc failure" in ret.stderr
+
+
+def test_depends_on_is_rejected_in_common_options(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE.replace("pandoc_common:\n", "pandoc_common:\n  depends_on: FIGURES\n"))
+    ret = project.panbuild("-L")
+    assert ret.returncode != 0
+    assert "depends_on cannot be given in the common options" in ret.stderr
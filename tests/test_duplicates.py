@@ -0,0 +1,61 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  WEB:
+    options: -t html -o index.html
+  SITE:
+    options: -t html -o index.html
+  SLOW:
+    options: -t plain -o notes.txt
+    metadata:
+      sleep: 0.5
+  FAST:
+    options: -t markdown -o notes.txt
+"""
+
+
+def test_identical_commands_run_once(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2", "WEB", "SITE")
+
+    assert ret.returncode == 0, ret.stderr
+    assert ret.stdout.splitlines() == [
+        "Building target WEB ...Success",
+        "Building target SITE ...Success (same command as WEB)",
+    ]
+    assert len(project.invocations()) == 1
+    assert project.read("index.html") == "# One\nto=html\n"
+
+    ret = project.panbuild("-j", "2", "WEB", "SITE")
+
+    assert ret.stdout.splitlines() == [
+        "Building target WEB ...Up to date",
+        "Building target SITE ...Up to date",
+    ]
+    assert len(project.invocations()) == 1
+
+
+def test_targets_writing_the_same_file_are_serialized(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2", "SLOW", "FAST")
+
+    assert ret.returncode == 0, ret.stderr
+    assert "Warning: targets SLOW and FAST both write notes.txt" in ret.stderr
+    ## FAST waits for SLOW, as in a sequential build
+    assert project.read("notes.txt") == "# One\nto=markdown\n"
+    assert len(project.invocations()) == 2
+
+    ## Each of them overwrites the output of the other
+    ret = project.panbuild("-j", "2", "SLOW", "FAST")
+
+    assert ret.stdout.splitlines() == [
+        "Building target SLOW ...Success",
+        "Building target FAST ...Success",
+    ]
+    assert len(project.invocations()) == 4
@@ -0,0 +1,91 @@
+from tests.conftest import fake_pandoc
+
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  A:
+    options: -t html -o a.html
+    metadata:
+      sleep: 0.3
+  B:
+    options: -t plain -o b.txt
+    metadata:
+      sleep: 0.05
+  C:
+    options: -t docx -o c.docx
+    metadata:
+      sleep: 0.6
+"""
+
+
+def outputs(project):
+    return [line.split(" -o ")[1].split()[0] for line in project.invocations()]
+
+
+def test_history_orders_longest_first_and_reports_trends(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2")
+    assert ret.returncode == 0
+    assert "Estimated build time" not in ret.stderr
+    assert outputs(project)[-1] == "c.docx"
+
+    # The slowest target starts first, and the shortest ones fill the gaps
+    ret = project.panbuild("-j", "2", "-B")
+    assert ret.returncode == 0
+    assert "Estimated build time: " in ret.stderr
+    assert outputs(project)[3:][-1] == "b.txt"
+    # Results are still reported in the order of the build file
+    assert [line.split()[2] for line in ret.stdout.splitlines()] == ["A", "B", "C"]
+
+    ret = project.panbuild("--history", "C")
+    assert ret.returncode == 0
+    lines = ret.stdout.splitlines()
+    assert lines[0] == "C:"
+    assert len([line for line in lines if "Success" in line]) == 2
+    assert lines[-1].startswith("  Average of the last 2 builds: ")
+
+    assert project.panbuild("--history", "D").returncode == 3
+
+
+def test_estimate_checks_each_target_once(project, monkeypatch):
+    import panbuild
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE.replace("sleep: 0.6", "sleep: 0.1"))
+    assert project.panbuild("-j", "2").returncode == 0
+
+    monkeypatch.chdir(str(project.path))
+    checked = []
+    is_up_to_date = panbuild.BuildState.is_up_to_date
+
+    def counting(self, target):
+        checked.append(target.subname)
+        return is_up_to_date(self, target)
+    monkeypatch.setattr(panbuild.BuildState, "is_up_to_date", counting)
+    targets = panbuild.select_targets(panbuild.parse_file("build.yaml", fake_pandoc)[1], [])
+    scheduler = panbuild.BuildScheduler(targets, 2, state=panbuild.BuildState("build.yaml"),
+                                        history=panbuild.BuildHistory("build.yaml"))
+
+    assert scheduler.run() == 0
+    assert sorted(checked) == ["A", "B", "C"]
+
+
+def test_failures_are_reported_when_started_out_of_order(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+    assert project.panbuild("-j", "2").returncode == 0
+
+    # C starts first, as the slowest target, and fails while B is waiting
+    project.write("build.yaml", BUILD_FILE.replace("sleep: 0.6", "fail: true"))
+    ret = project.panbuild("-j", "2", "-B")
+    assert ret.returncode == 3
+    assert ret.stdout.splitlines() == [
+        "Building target A ...Success",
+        "Building target C ...Failed",
+    ]
+    assert "fake pandoc failure" in ret.stderr
+    assert "1 target(s) not built due to previous errors" in ret.stderr
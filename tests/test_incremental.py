@@ -0,0 +1,120 @@
+import os
+import time
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  - chapter2.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+"""
+
+
+def touch_later(path):
+    later = time.time() + 10
+    os.utime(path, (later, later))
+
+
+def test_up_to_date_targets_are_skipped(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild().returncode == 0
+    assert len(project.invocations()) == 2
+
+    ret = project.panbuild()
+    assert ret.returncode == 0
+    assert ret.stdout.splitlines() == [
+        "Building target HTML ...Up to date",
+        "Building target TXT ...Up to date",
+    ]
+    assert len(project.invocations()) == 2
+
+    touch_later(project.write("chapter2.md", "# Two, revised\n"))
+    project.panbuild("HTML")
+    assert len(project.invocations()) == 3
+    assert project.read("book.html") == "# One\n# Two, revised\nto=html\n"
+
+    project.panbuild("-B", "HTML")
+    assert len(project.invocations()) == 4
+
+
+def test_command_changes_trigger_rebuild(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE)
+    project.panbuild("HTML")
+
+    project.write("build.yaml", BUILD_FILE.replace("-t html", "-t html -N"))
+    project.panbuild("HTML")
+    assert len(project.invocations()) == 2
+
+
+def test_hash_mode_ignores_touched_files(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE)
+    project.panbuild("--hash", "TXT")
+
+    touch_later(os.path.join(str(project.path), "chapter1.md"))
+    assert project.panbuild("--hash", "TXT").stdout == "Building target TXT ...Up to date\n"
+
+    project.write("chapter1.md", "# One, revised\n")
+    project.panbuild("--hash", "TXT")
+    assert len(project.invocations()) == 2
+
+
+DEPS_BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html --css=style.css --template=page
+    metadata:
+      bibliography: refs.bib
+"""
+
+
+def test_dependencies_are_discovered(project):
+    os.mkdir(os.path.join(str(project.path), "img"))
+    project.write("img/fig.png", "png")
+    project.write("img/other.png", "png")
+    project.write("style.css", "css")
+    project.write("page.html", "template")
+    project.write("refs.bib", "bib")
+    project.write("chapter1.md", "# One\n![A figure](img/fig.png)\n"
+                                 "[Not an image](img/other.png)\n"
+                                 "![Remote](https://example.com/x.png)\n")
+    project.write("build.yaml", DEPS_BUILD_FILE)
+
+    ret = project.panbuild("--list-dependencies")
+    assert ret.stdout == ("HTML: chapter1.md page.html style.css refs.bib "
+                          "img/fig.png\n")
+
+    project.panbuild("HTML")
+    touch_later(project.write("img/other.png", "png2"))
+    assert "Up to date" in project.panbuild("HTML").stdout
+    touch_later(project.write("img/fig.png", "png2"))
+    assert "Success" in project.panbuild("HTML").stdout
+
+
+def test_only_definitions_used_by_images_are_dependencies(project):
+    os.mkdir(os.path.join(str(project.path), "img"))
+    for name in ["fig.png", "logo.png", "doc.png", "note.png"]:
+        project.write("img/" + name, "png")
+    project.write("chapter1.md", "![A figure][fig] ![Logo] [a link][doc] and a note[^n]\n\n"
+                                 "[FIG]: img/fig.png\n[logo]: img/logo.png\n"
+                                 "[doc]: img/doc.png\n[^n]: img/note.png\n")
+    project.write("build.yaml", DEPS_BUILD_FILE.replace(" --css=style.css --template=page", "").replace(
+        "    metadata:\n      bibliography: refs.bib\n", ""))
+
+    ret = project.panbuild("--list-dependencies")
+    assert ret.stdout == "HTML: chapter1.md img/fig.png img/logo.png\n"
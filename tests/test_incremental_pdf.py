@@ -0,0 +1,85 @@
+import os
+
+from tests.conftest import here
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  BOOK:
+    options: -t latex -s --pdf-engine=./pdflatex -o book.pdf
+"""
+
+
+def engine_runs(project, start):
+    return [line for line in project.invocations()[start:] if line.startswith("engine ")]
+
+
+def test_incremental_pdf(project):
+    os.symlink(os.path.join(here, "fake_latex.py"), os.path.join(str(project.path), "pdflatex"))
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    # Auxiliary files are created by the first run, so the engine runs twice
+    ret = project.panbuild("--incremental-pdf")
+    assert ret.returncode == 0
+    assert len(engine_runs(project, 0)) == 2
+    assert project.read("book.pdf") == "# One\nto=latex\n"
+
+    # The engine is not run when the .tex file is the same
+    count = len(project.invocations())
+    os.utime(os.path.join(str(project.path), "chapter1.md"), None)
+    ret = project.panbuild("--incremental-pdf")
+    assert ret.returncode == 0
+    assert len(project.invocations()) == count + 1
+    assert engine_runs(project, count) == []
+
+    # Unless the build is forced
+    count = len(project.invocations())
+    ret = project.panbuild("--incremental-pdf", "-B")
+    assert ret.returncode == 0
+    assert len(engine_runs(project, count)) == 1
+
+    # Auxiliary files of the previous build are reused
+    count = len(project.invocations())
+    project.write("chapter1.md", "# One\nMore text\n")
+    ret = project.panbuild("--incremental-pdf")
+    assert ret.returncode == 0
+    assert len(engine_runs(project, count)) == 1
+    assert project.read("book.pdf") == "# One\nMore text\nto=latex\n"
+
+    # Errors of the engine are reported, and the engine runs again next time
+    project.write("chapter1.md", "# One\n\\fail\n")
+    ret = project.panbuild("--incremental-pdf")
+    assert ret.returncode == 1
+    assert "! Undefined control sequence." in ret.stderr
+    count = len(project.invocations())
+    ret = project.panbuild("--incremental-pdf", "-B")
+    assert ret.returncode == 1
+    assert len(engine_runs(project, count)) == 1
+
+
+def test_incremental_pdf_notices_changed_images(project):
+    os.symlink(os.path.join(here, "fake_latex.py"), os.path.join(str(project.path), "pdflatex"))
+    project.write("chapter1.md", "# One\n![Figure](fig.png)\n")
+    project.write("fig.png", "first")
+    project.write("build.yaml", BUILD_FILE)
+    assert project.panbuild("--incremental-pdf").returncode == 0
+
+    # The .tex file is the same, but the image it refers to is not
+    count = len(project.invocations())
+    project.write("fig.png", "second, larger")
+    ret = project.panbuild("--incremental-pdf")
+    assert ret.returncode == 0
+    assert len(engine_runs(project, count)) == 1
+
+
+def test_incremental_pdf_takes_precedence_over_ast_cache(project):
+    os.symlink(os.path.join(here, "fake_latex.py"), os.path.join(str(project.path), "pdflatex"))
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("--incremental-pdf", "--ast-cache")
+    assert ret.returncode == 0
+    assert len(engine_runs(project, 0)) == 2
@@ -0,0 +1,82 @@
+import os
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  A:
+    options: -t html -o a.html
+    metadata:
+      warn: Could not fetch resource figure.png
+  B:
+    options: -t plain -o b.txt
+  C:
+    options: -t docx -o c.docx
+    metadata:
+      noise: 20000
+      fail: true
+"""
+
+
+def test_output_is_logged_per_target(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "3", "-k")
+    assert ret.returncode == 3
+    logs = os.path.join(".panbuild", "build.yaml.logs")
+
+    # Warnings are shown as they come, and summarized at the end
+    assert "A: [WARNING] Could not fetch resource figure.png" in ret.stderr
+    summary = ret.stderr[ret.stderr.index("1 warning(s) in 1 target(s):"):]
+    assert "  A (see %s):" % os.path.join(logs, "A.log") in summary
+    assert "    [WARNING] Could not fetch resource figure.png" in summary
+    assert "[WARNING]" in project.read(os.path.join(logs, "A.log"))
+    assert not project.exists(os.path.join(logs, "B.log"))
+
+    # Only the last lines of large outputs are shown, and the log is rotated
+    assert "Last lines of the output (see %s):" % os.path.join(logs, "C.log") in ret.stderr
+    assert "noise line 19999" in ret.stderr
+    assert "noise line 0 " not in ret.stderr
+    assert project.exists(os.path.join(logs, "C.log.1"))
+    assert project.read(os.path.join(logs, "C.log")).endswith("fake pandoc failure\n")
+
+
+def test_shared_ast_output_is_logged(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2", "--share-ast", "A", "B")
+    assert ret.returncode == 0
+    assert "1 warning(s) in 1 target(s):" in ret.stderr
+    assert "[WARNING]" in project.read(os.path.join(".panbuild", "build.yaml.logs", "A.log"))
+
+
+def test_logs_can_be_turned_off(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2", "--no-logs", "A", "B")
+    assert ret.returncode == 0
+    assert not project.exists(os.path.join(".panbuild", "build.yaml.logs"))
+
+
+def test_log_paths_stay_in_the_log_directory(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  "..":
+    options: -t html -o up.html
+    X:
+      metadata:
+        warn: escaped
+""")
+
+    ret = project.panbuild("-j", "2")
+    assert ret.returncode == 0, ret.stderr
+    assert project.exists(os.path.join(".panbuild", "build.yaml.logs", "__", "X.log"))
+    assert not project.exists(os.path.join(".panbuild", "X.log"))
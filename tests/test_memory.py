@@ -0,0 +1,47 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  P1:
+    options: -o p1.pdf
+    metadata:
+      sleep: 0.5
+  P2:
+    options: -o p2.pdf
+    metadata:
+      sleep: 0.5
+  H:
+    options: -t html -o h.html
+"""
+
+
+def outputs(project):
+    return [line.split(" -o ")[1].split()[0] for line in project.invocations()]
+
+
+def test_memory_budget_limits_heavy_targets(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    # Only one PDF fits in the budget, but the HTML target runs alongside it
+    ret = project.panbuild("-j", "3", "--memory", "1536M")
+    assert ret.returncode == 0
+    assert sorted(outputs(project)[:2]) == ["h.html", "p1.pdf"]
+    assert outputs(project)[2] == "p2.pdf"
+
+    # The memory attribute overrides the estimate of the output format
+    project.write("build.yaml", BUILD_FILE.replace("  H:\n", "  H:\n    memory: 2G\n")
+                  .replace("-o p2.pdf\n", "-o p2.pdf\n    memory: 100M\n"))
+    ret = project.panbuild("-j", "3", "--memory", "1536M", "-B")
+    assert ret.returncode == 0
+    assert sorted(outputs(project)[3:5]) == ["p1.pdf", "p2.pdf"]
+    assert outputs(project)[5] == "h.html"
+
+
+def test_invalid_memory_budget(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+    ret = project.panbuild("--memory", "lots")
+    assert ret.returncode == 2
+    assert "Invalid size" in ret.stderr
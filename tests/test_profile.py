@@ -0,0 +1,31 @@
+import json
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+"""
+
+
+def test_profile_writes_summary_and_trace(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("--profile", "--trace-file", "trace.json", "-j", "2")
+    assert ret.returncode == 0
+    assert "parse_file" in ret.stderr
+    assert "build_command" in ret.stderr
+    assert "Total elapsed time" in ret.stderr
+
+    events = json.loads(project.read("trace.json"))["traceEvents"]
+    targets = [e for e in events if e["ph"] == "X" and e["cat"] == "target"]
+    assert sorted(e["name"] for e in targets) == ["HTML", "TXT"]
+    assert all(e["dur"] >= 0 and "cpu" in e["args"] for e in targets)
+    names = [e["args"]["name"] for e in events if e["ph"] == "M"]
+    assert "HTML" in names and "TXT" in names
@@ -0,0 +1,91 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: report
+pandoc_targets:
+  SLOW:
+    options: -t html -o slow.html
+    metadata:
+      sleep: 0.5
+  FAST:
+    options: -t plain
+  BROKEN:
+    options: -t docx -M fail
+"""
+
+
+def test_parallel_build_reports_in_selection_order(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "2", "SLOW", "FAST")
+
+    assert ret.returncode == 0
+    assert ret.stdout.splitlines() == [
+        "Building target SLOW ...Success",
+        "Building target FAST ...Success",
+    ]
+    assert project.read("slow.html") == "# One\nto=html\n"
+    assert project.read("report.txt") == "# One\nto=plain\n"
+
+
+def test_failed_target_sets_exit_code(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-j", "1", "BROKEN", "FAST")
+
+    assert ret.returncode == 3
+    assert ret.stdout == "Building target BROKEN ...Failed\n"
+    assert "fake pandoc failure" in ret.stderr
+    assert not project.exists("report.txt")
+
+    ret = project.panbuild("-j", "2", "-k", "BROKEN", "FAST")
+
+    assert ret.returncode == 3
+    assert project.exists("report.txt")
+
+
+OVERLAP_BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  A:
+    options: -t html -o a.html
+    metadata:
+      touch: a.started
+      wait_for: b.started
+  B:
+    options: -t plain -o b.txt
+    metadata:
+      touch: b.started
+      wait_for: a.started
+"""
+
+
+def test_parallel_jobs_overlap(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", OVERLAP_BUILD_FILE)
+
+    # Each target waits until the other one has started
+    ret = project.panbuild("-j", "2")
+
+    assert ret.returncode == 0, ret.stderr
+    assert project.exists("a.html") and project.exists("b.txt")
+
+
+def test_unexpected_errors_fail_the_target(project, monkeypatch):
+    import panbuild
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+    monkeypatch.chdir(str(project.path))
+
+    def broken(self, target, inputs):
+        raise ValueError("unexpected")
+    monkeypatch.setattr(panbuild.BuildScheduler, "build_target", broken)
+    targets = panbuild.parse_file("build.yaml", None)[1]
+    selected = panbuild.select_targets(targets, ["SLOW", "FAST"])
+
+    assert panbuild.BuildScheduler(selected, 2, keep_going=True).run() == 1
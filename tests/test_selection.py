@@ -0,0 +1,47 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  PDF:
+    options: -t latex -s
+    ES:
+      variables:
+        lang: es
+    EN:
+      variables:
+        lang: en
+  HTML:
+    options: -t html
+    ES:
+      variables:
+        lang: es
+    EN:
+      variables:
+        lang: en
+  DOCX:
+    options: -t docx -o report.docx
+"""
+
+
+def selected(project, *selectors):
+    ret = project.panbuild("-B", "-j", "1", *selectors)
+    assert ret.returncode == 0, ret.stderr
+    return [line.split()[2] for line in ret.stdout.splitlines() if line.startswith("Building target")]
+
+
+def test_select_targets_by_pattern_prefix_and_format(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    assert selected(project, "HTML/EN") == ["HTML/EN"]
+    assert selected(project, "PDF") == ["PDF/ES", "PDF/EN"]
+    assert selected(project, "*/EN") == ["PDF/EN", "HTML/EN"]
+    assert selected(project, "re:(PDF|HTML)/ES", "HTML/*") == ["PDF/ES", "HTML/ES", "HTML/EN"]
+    assert selected(project, "format:pdf") == ["PDF/ES", "PDF/EN"]
+    assert selected(project, "format:docx", "format:html") == ["DOCX", "HTML/ES", "HTML/EN"]
+
+    ret = project.panbuild("*/FR")
+    assert ret.returncode == 3
+    assert "Target '*/FR' does not exist" in ret.stderr
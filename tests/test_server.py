@@ -0,0 +1,54 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  - chapter2.md
+pandoc_targets:
+  A:
+    options: -t html -o a.html
+  B:
+    options: -t docx -o b.docx
+  C:
+    options: -t plain -o c.txt
+    metadata:
+      warn: Could not fetch resource figure.png
+  D:
+    options: -t html -o d.html
+    metadata:
+      fail: true
+"""
+
+
+def test_pandoc_server_backend(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("--pandoc-server", "-j", "2", "-k")
+    assert ret.returncode == 1
+    invocations = project.invocations()
+    assert len([line for line in invocations if line.startswith("server --port ")]) == 1
+    assert sorted(line for line in invocations if line.startswith("server-request")) == [
+        "server-request markdown html", "server-request markdown html", "server-request markdown plain"]
+    # Binary outputs are built by running pandoc
+    assert [line for line in invocations if " -o " in line] == [
+        line for line in invocations if "b.docx" in line]
+
+    assert project.read("a.html") == "# One\n\n\n# Two\nto=html\n"
+    assert "1 warning(s) in 1 target(s):" in ret.stderr
+    assert "    [WARNING] Could not fetch resource figure.png" in ret.stderr
+    assert "fake pandoc failure" in ret.stderr
+    assert ret.stdout.splitlines()[-1].endswith("Failed")
+
+
+def test_failed_requests_are_retried(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE.replace("warn: Could not fetch resource figure.png", "drop: c"))
+
+    ret = project.panbuild("--pandoc-server", "C")
+    assert ret.returncode == 0, ret.stderr
+    invocations = project.invocations()
+    assert invocations.count("server-request markdown plain") == 2
+    assert not [line for line in invocations if " -o " in line]
+    assert project.read("c.txt") == "# One\n\n\n# Two\nto=plain\n"
@@ -0,0 +1,150 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+FILTER = """
+import json
+import sys
+
+doc = json.load(sys.stdin)
+doc["blocks"] = [block.upper() for block in doc["blocks"]]
+doc["blocks"].append("[%s]" % sys.argv[1])
+json.dump(doc, sys.stdout)
+"""
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  - chapter2.md
+  filters:
+  - shout.py
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html -s
+  SLIDES:
+    options: -t html -o slides.html
+  TXT:
+    options: -t plain
+"""
+
+OUTPUTS = ["book.html", "slides.html", "book.txt"]
+
+
+def test_shared_ast_matches_regular_build(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("shout.py", FILTER)
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild().returncode == 0
+    expected = [project.read(name) for name in OUTPUTS]
+    assert expected[0] == "# ONE\n# TWO\n[html]to=html\n"
+    assert expected[2] == "# ONE\n# TWO\n[plain]to=plain\n"
+
+    for name in OUTPUTS:
+        os.remove(os.path.join(str(project.path), name))
+    os.remove(project.log)
+
+    ret = project.panbuild("--share-ast", "-B")
+    assert ret.returncode == 0
+    assert [project.read(name) for name in OUTPUTS] == expected
+
+    commands = project.invocations()
+    readers = [cmd for cmd in commands if "-t json" in cmd]
+    assert len(readers) == 1
+    assert "-F" not in readers[0]
+    writers = [cmd for cmd in commands if cmd.startswith("-f json")]
+    assert len(writers) == 3
+    # The filter only runs in the writer stage for the single plain target
+    assert ["-F" in cmd for cmd in writers].count(True) == 1
+    assert not project.exists(".panbuild/build.yaml.ast")
+
+
+def test_ast_cache_reads_all_files_at_once(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("shout.py", FILTER)
+    project.write("build.yaml", BUILD_FILE)
+
+    assert project.panbuild("--ast-cache").returncode == 0
+    assert project.read("book.html") == "# ONE\n# TWO\n[html]to=html\n"
+    readers = [cmd for cmd in project.invocations() if "-t json" in cmd]
+    assert len(readers) == 1
+    assert readers[0].endswith("chapter1.md chapter2.md")
+
+    assert project.panbuild("--ast-cache", "-B").returncode == 0
+    assert len([cmd for cmd in project.invocations() if "-t json" in cmd]) == 1
+
+
+def test_ast_cache_reads_file_scope_inputs_together(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("shout.py", FILTER)
+    project.write("build.yaml", BUILD_FILE.replace("  output_basename: book", "  options: --file-scope\n  output_basename: book"))
+
+    assert project.panbuild("--ast-cache").returncode == 0
+    assert project.read("book.html") == "# ONE\n# TWO\n[html]to=html\n"
+    readers = [cmd for cmd in project.invocations() if "-t json" in cmd]
+    assert len(readers) == 1
+    # pandoc prefixes identifiers with the name of each file
+    assert "--file-scope" in readers[0]
+    assert readers[0].endswith("chapter1.md chapter2.md")
+
+    project.write("chapter2.md", "# Two, revised\n")
+    assert project.panbuild("--ast-cache", "-B").returncode == 0
+    assert project.read("book.txt") == "# ONE\n# TWO, REVISED\n[plain]to=plain\n"
+    readers = [cmd for cmd in project.invocations() if "-t json" in cmd]
+    assert len(readers) == 2
+    assert readers[-1].endswith("chapter1.md chapter2.md")
+
+
+HOSTED_BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  filters:
+  - shout.py
+  - exit.py
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+"""
+
+EXIT_FILTER = """
+import sys
+sys.stdout.write(sys.stdin.read())
+sys.exit(int(sys.argv[1] == "plain"))
+"""
+
+
+def test_hosted_filters_match_external_filters(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("shout.py", FILTER)
+    project.write("exit.py", EXIT_FILTER.replace("plain", "none"))
+    project.write("build.yaml", HOSTED_BUILD_FILE)
+    python = os.path.realpath(sys.executable)
+    if os.path.realpath(shutil.which("python") or "") != python or not hasattr(os, "fork"):
+        pytest.skip("filters would not run on this interpreter")
+
+    assert project.panbuild("-j", "1").returncode == 0
+    expected = project.read("book.html")
+    os.remove(project.log)
+
+    assert project.panbuild("--host-filters", "-B").returncode == 0
+    assert project.read("book.html") == expected
+    assert not [cmd for cmd in project.invocations() if "-F" in cmd]
+
+    project.write("exit.py", EXIT_FILTER)
+    ret = project.panbuild("--host-filters", "-k")
+    assert ret.returncode == 1
+    assert ret.stdout.splitlines() == [
+        "Building target HTML ...Success",
+        "Building target TXT ...Failed",
+    ]
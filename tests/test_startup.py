@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+"""
+
+LIST_AND_REPORT_MODULES = """
+import sys
+sys.path.insert(0, %r)
+import panbuild
+try:
+    panbuild.main()
+except SystemExit:
+    pass
+print(" ".join(sorted(sys.modules)))
+"""
+
+
+def list_and_report_modules(project, flag):
+    code = LIST_AND_REPORT_MODULES % os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ret = subprocess.run([sys.executable, "-c", code, flag], cwd=str(project.path),
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    (listing, modules) = ret.stdout.rsplit("\n", 2)[:2]
+    return (listing, modules.split())
+
+
+def test_list_commands_skip_build_only_modules(project):
+    project.write("build.yaml", BUILD_FILE)
+
+    (listing, modules) = list_and_report_modules(project, "-L")
+    assert listing == "HTML"
+    assert "yaml" in modules
+    assert "subprocess" not in modules
+
+    # Later runs load the compiled build file instead of parsing it
+    for flag in ["-L", "-o"]:
+        (listing, modules) = list_and_report_modules(project, flag)
+        assert "HTML" in listing
+        for name in ["yaml", "subprocess", "hashlib", "urllib.parse"]:
+            assert name not in modules
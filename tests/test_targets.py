@@ -0,0 +1,67 @@
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  options: -c a.css -c b.css
+  filters:
+  - common-filter
+pandoc_targets:
+  HTML:
+    options: -t html -c html.css
+    variables:
+      lang: en
+    STANDALONE:
+      options: -s
+      filters:
+      - nested-filter
+  EPUB:
+    options: -t epub -c epub.css
+    input_files:
+    - chapter2.md
+"""
+
+
+def test_targets_inherit_settings_without_sharing_them(project):
+    project.write("build.yaml", BUILD_FILE)
+
+    ret = project.panbuild("-L", "-v")
+    commands = dict(line.split(": ", 1) for line in ret.stdout.splitlines())
+    args = dict((name, command.split()[1:]) for (name, command) in commands.items())
+
+    assert args["HTML/STANDALONE"] == ["-c", "a.css", "-c", "b.css", "-c", "html.css", "-t", "html", "-s",
+                                       "-F", "common-filter", "-F", "nested-filter", "-V", "lang=en",
+                                       "-o", "output.html", "chapter1.md"]
+    # Options added by a target never leak into its siblings
+    assert args["EPUB"] == ["-c", "a.css", "-c", "b.css", "-c", "epub.css", "-t", "epub",
+                            "-F", "common-filter", "-o", "output.epub", "chapter2.md"]
+
+
+def test_errors_only_affect_their_own_target(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("build.yaml", """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  BROKEN:
+    options: -t html -o a.html -o b.html
+""")
+
+    ret = project.panbuild("HTML")
+    assert ret.returncode == 0
+    assert project.exists("book.html")
+
+    assert project.panbuild("-L").stdout == "HTML\nBROKEN\n"
+
+    ret = project.panbuild("-o")
+    assert ret.returncode == 2
+    assert ret.stdout == "HTML: book.html\n"
+    assert "Multiple output files detected in command for target BROKEN" in ret.stderr
+
+    ret = project.panbuild("-k", "-j", "1", "-B")
+    assert ret.returncode == 2
+    assert "Building target HTML ...Success" in ret.stdout
+    assert "Building target BROKEN ...Failed" in ret.stdout
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import time
+
+from tests.conftest import fake_pandoc, panbuild_script
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+  output_basename: book
+pandoc_targets:
+  HTML:
+    options: -t html
+  TXT:
+    options: -t plain
+    input_files:
+    - chapter2.md
+"""
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_watch_rebuilds_affected_targets(project):
+    project.write("chapter1.md", "# One\n")
+    project.write("chapter2.md", "# Two\n")
+    project.write("build.yaml", BUILD_FILE)
+
+    env = dict(os.environ, FAKE_PANDOC_LOG=project.log)
+    proc = subprocess.Popen([sys.executable, panbuild_script, "-e", fake_pandoc, "--watch"],
+                            cwd=str(project.path), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        assert wait_for(lambda: len(project.invocations()) == 2)
+        time.sleep(0.5)
+
+        project.write("chapter2.md", "# Two, revised\n")
+        assert wait_for(lambda: len(project.invocations()) == 3)
+        assert wait_for(lambda: project.read("book.txt") == "# Two, revised\nto=plain\n")
+        assert project.invocations()[-1].endswith("chapter2.md")
+
+        time.sleep(0.5)
+        project.write("build.yaml", BUILD_FILE.replace("-t html", "-t html -N"))
+        assert wait_for(lambda: len(project.invocations()) == 4)
+        assert "-N" in project.invocations()[-1]
+        time.sleep(0.5)
+        assert len(project.invocations()) == 4
+    finally:
+        proc.terminate()
+        proc.wait()
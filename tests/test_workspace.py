@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+
+BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - chapter1.md
+pandoc_targets:
+  HTML:
+    options: -t html -o %(name)s.html
+    metadata:
+      sleep: %(sleep)s
+  TXT:
+    options: -t plain -o %(name)s.txt
+    metadata:
+      sleep: %(sleep)s
+"""
+
+SELF_CONTAINED = """---
+title: Notes
+pandoc_targets:
+  HTML:
+    options: -t html -o notes.html
+---
+# Notes
+"""
+
+
+def add_document(project, name, sleep=0.01, build_file=BUILD_FILE):
+    os.makedirs(os.path.join(str(project.path), "docs", name))
+    project.write("docs/%s/chapter1.md" % name, "# %s\n" % name)
+    project.write("docs/%s/build.yaml" % name, build_file % {"name": name, "sleep": sleep})
+
+
+def test_workspace_builds_all_build_files(project):
+    add_document(project, "a")
+    add_document(project, "b")
+    project.write("docs/notes.md", SELF_CONTAINED)
+    os.makedirs(os.path.join(str(project.path), ".hidden"))
+    project.write(".hidden/build.yaml", "not: [valid")
+
+    ret = project.panbuild("--workspace", "docs", "-j", "2")
+
+    assert ret.returncode == 0, ret.stderr
+    assert ret.stdout.splitlines() == [
+        "== docs/notes.md",
+        "Building target HTML ...Success",
+        "== docs/a/build.yaml",
+        "Building target HTML ...Success",
+        "Building target TXT ...Success",
+        "== docs/b/build.yaml",
+        "Building target HTML ...Success",
+        "Building target TXT ...Success",
+        "3 build file(s): 3 succeeded, 0 failed",
+    ]
+    assert project.read("docs/a/a.html") == "# a\nto=html\n"
+    assert project.read("docs/b/b.txt") == "# b\nto=plain\n"
+    assert project.exists("docs/notes.html")
+
+
+def test_workspace_shares_the_job_limit(project):
+    for name in ["a", "b"]:
+        add_document(project, name, sleep=0.5)
+
+    started = time.time()
+    ret = project.panbuild("--workspace", "docs", "-j", "2")
+
+    assert ret.returncode == 0, ret.stderr
+    ## Four targets, two at a time
+    assert time.time() - started >= 1.0
+    assert len(project.invocations()) == 4
+
+
+def test_workspace_summary_and_exit_code(project):
+    add_document(project, "a")
+    add_document(project, "b", build_file=BUILD_FILE.replace("-t plain", "-t plain -M fail"))
+    project.write("docs/c.md", "---\ntitle: Not a build file\n---\n")
+
+    ret = project.panbuild("--workspace", "docs", "TXT")
+
+    assert ret.returncode == 3
+    assert ret.stdout.splitlines()[-2:] == [
+        "2 build file(s): 1 succeeded, 1 failed",
+        "  Failed: docs/b/build.yaml",
+    ]
+    assert "fake pandoc failure" in ret.stderr
+    assert not project.exists("docs/a/a.html")
+
+    ret = project.panbuild("--workspace", "docs", "PDF")
+
+    assert ret.returncode == 3
+    assert "No build file in docs has targets matching PDF" in ret.stderr
+
+
+CHUNKED_BUILD_FILE = """
+pandoc_common:
+  input_files:
+  - c1.md
+  - c2.md
+  chunked: true
+pandoc_targets:
+  HTML:
+    options: -t html -o %(name)s.html
+    metadata:
+      sleep: %(sleep)s
+"""
+
+
+def test_workspace_slots_cover_chunked_targets(project):
+    for name in ["a", "b"]:
+        add_document(project, name, sleep=1.5, build_file=CHUNKED_BUILD_FILE)
+        project.write("docs/%s/c1.md" % name, "# One\n")
+        project.write("docs/%s/c2.md" % name, "# Two\n")
+
+    started = time.time()
+    ret = project.panbuild("--workspace", "docs", "-j", "2")
+
+    assert ret.returncode == 0, ret.stderr
+    ## Each document holds one slot, so its files are read one at a time
+    assert time.time() - started >= 3.0
+    assert len([line for line in project.invocations() if "-t json" in line]) == 4
+
+
+def test_workspace_reports_commands_exiting_with_any_status(project):
+    add_document(project, "a", build_file="""
+pandoc_targets:
+  CHECK:
+    custom_cmd: %s check.py
+""" % sys.executable)
+    project.write("docs/a/check.py", "import sys\nsys.exit(4)\n")
+    add_document(project, "b")
+
+    ret = project.panbuild("--workspace", "docs", "CHECK")
+
+    assert ret.returncode == 4
+    assert ret.stdout.splitlines() == [
+        "== docs/a/build.yaml",
+        "Building target CHECK ...Failed",
+        "1 build file(s): 0 succeeded, 1 failed, 1 without matching targets",
+        "  Failed: docs/a/build.yaml",
+    ]